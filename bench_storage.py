@@ -0,0 +1,255 @@
+"""Микробенчмарк хранилища: импорт кодов, выдача, /left и /report — без Telegram.
+
+База создаётся во временном каталоге и удаляется после прогона. Результат —
+JSON (stdout или --out), чтобы сравнивать прогоны между коммитами:
+
+    python bench_storage.py --drops 10 --codes 10000 --claims 50000 --concurrency 200
+    python bench_storage.py --group-commit-ms 3 --out before.json
+    python bench_storage.py --backend memory
+    python bench_storage.py --foreign-writer-ms 5   # второй писатель держит блокировку (SQLITE_BUSY)
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import List
+
+from memory_storage import MemoryStorage
+from storage import SqliteStorage, Storage
+
+
+def percentiles(samples: List[float]) -> dict:
+    """p50/p95/p99/max в миллисекундах."""
+    if not samples:
+        return {}
+    ordered = sorted(samples)
+
+    def at(p: float) -> float:
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000, 3)
+
+    return {"p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99), "max_ms": round(ordered[-1] * 1000, 3)}
+
+
+def git_revision() -> str:
+    try:
+        out = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, timeout=10,
+        )
+        return out.stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def make_storage(args, db_path: str) -> Storage:
+    if args.backend == "memory":
+        return MemoryStorage(db_path, snapshot_interval=0, global_one_per_user=args.global_one_per_user)
+    return SqliteStorage(
+        db_path,
+        readers=args.readers,
+        group_commit_ms=args.group_commit_ms,
+        group_commit_max=args.group_commit_max,
+        claim_cache_size=args.claim_cache_size,
+        global_one_per_user=args.global_one_per_user,
+    )
+
+
+def code_chunks(prefix: str, count: int, chunk_size: int):
+    for start in range(0, count, chunk_size):
+        yield [f"{prefix}{i:010d}" for i in range(start, min(count, start + chunk_size))]
+
+
+class ForeignWriter(threading.Thread):
+    """Второй писатель в ту же базу: держит блокировку записи `hold_ms` из каждых `period_ms`."""
+
+    def __init__(self, db_path: str, hold_ms: float, period_ms: float):
+        super().__init__(name="foreign-writer", daemon=True)
+        self.db_path = db_path
+        self.hold = hold_ms / 1000
+        self.period = period_ms / 1000
+        self.stop = threading.Event()
+        self.transactions = 0
+
+    def run(self) -> None:
+        conn = sqlite3.connect(self.db_path, isolation_level=None, timeout=30)
+        try:
+            while not self.stop.is_set():
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("UPDATE admin_bindings SET chat_id=chat_id WHERE user_id=0")
+                time.sleep(self.hold)
+                conn.execute("COMMIT")
+                self.transactions += 1
+                time.sleep(max(0.0, self.period - self.hold))
+        finally:
+            conn.close()
+
+
+async def bench_import(storage: Storage, args) -> dict:
+    started = time.perf_counter()
+    _, added = await storage.add_codes(-1, code_chunks("IMP", args.import_codes, args.chunk_size))
+    elapsed = time.perf_counter() - started
+    return {"codes": added, "seconds": round(elapsed, 3), "codes_per_sec": round(added / elapsed)}
+
+
+async def seed_drops(storage: Storage, args) -> List[int]:
+    drops = []
+    for n in range(args.drops):
+        chat_id = -1000 - n
+        await storage.add_codes(chat_id, code_chunks(f"D{n}-", args.codes, args.chunk_size))
+        batch_id = await storage.get_pending_batch(chat_id)
+        drop_id = await storage.create_drop(chat_id, n + 1, chat_id)
+        await storage.attach_batch(drop_id, batch_id, chat_id)
+        drops.append(drop_id)
+    return drops
+
+
+async def bench_claims(storage: Storage, drops: List[int], args) -> dict:
+    rnd = random.Random(args.seed)
+    # Заранее строим поток нажатий: доля repeat_ratio — повторы тех, кто уже нажимал
+    requests, seen = [], []
+    next_user = 1
+    for _ in range(args.claims):
+        if seen and rnd.random() < args.repeat_ratio:
+            requests.append(rnd.choice(seen))
+        else:
+            request = (next_user, rnd.choice(drops))
+            next_user += 1
+            seen.append(request)
+            requests.append(request)
+
+    latencies: List[float] = []
+    outcome = {"assigned": 0, "repeat": 0, "no_codes": 0, "limited": 0}
+    it = iter(requests)
+
+    async def worker():
+        for user_id, drop_id in it:
+            started = time.perf_counter()
+            result = await storage.claim(user_id, drop_id)
+            latencies.append(time.perf_counter() - started)
+            if result.limited:
+                outcome["limited"] += 1
+            elif result.assigned_now:
+                outcome["assigned"] += 1
+            elif result.code:
+                outcome["repeat"] += 1
+            else:
+                outcome["no_codes"] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    return {
+        "claims": len(requests),
+        "seconds": round(elapsed, 3),
+        "claims_per_sec": round(len(requests) / elapsed),
+        **outcome,
+        "latency": percentiles(latencies),
+    }
+
+
+async def bench_left(storage: Storage, drops: List[int], args) -> dict:
+    samples = []
+    for _ in range(args.query_repeats):
+        for n, drop_id in enumerate(drops):
+            started = time.perf_counter()
+            await storage.latest_drop(-1000 - n)
+            await storage.drop_counts(drop_id)
+            samples.append(time.perf_counter() - started)
+    return {"queries": len(samples), "latency": percentiles(samples)}
+
+
+async def bench_report(storage: Storage, drops: List[int], tmp: str, args) -> dict:
+    samples, rows = [], 0
+    path = os.path.join(tmp, "report.csv")
+    for drop_id in drops[: args.report_drops]:
+        started = time.perf_counter()
+        used, free = await storage.export_report(drop_id, path, args.report_gzip)
+        samples.append(time.perf_counter() - started)
+        rows += used + free
+    total = sum(samples)
+    return {
+        "reports": len(samples),
+        "rows": rows,
+        "rows_per_sec": round(rows / total) if total else 0,
+        "bytes_last": os.path.getsize(path) if samples else 0,
+        "latency": percentiles(samples),
+    }
+
+
+async def run(args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="promo_bench_") as tmp:
+        db_path = os.path.join(tmp, "bench.sqlite3")
+        storage = make_storage(args, db_path)
+        await storage.open()
+        foreign = None
+        try:
+            result = {"import": await bench_import(storage, args)}
+            drops = await seed_drops(storage, args)
+            if args.foreign_writer_ms and args.backend == "sqlite":
+                foreign = ForeignWriter(db_path, args.foreign_writer_ms, args.foreign_writer_period_ms)
+                foreign.start()
+            result["claim"] = await bench_claims(storage, drops, args)
+            if foreign is not None:
+                foreign.stop.set()
+                foreign.join()
+                result["claim"]["foreign_transactions"] = foreign.transactions
+            result["left"] = await bench_left(storage, drops, args)
+            result["report"] = await bench_report(storage, drops, tmp, args)
+        finally:
+            if foreign is not None:
+                foreign.stop.set()
+            await storage.close()
+        result["storage_stats"] = storage.stats()
+        result["db_bytes"] = os.path.getsize(db_path) if os.path.exists(db_path) else 0
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Бенчмарк хранилища промокодов")
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--drops", type=int, default=5, help="сколько дропов создать")
+    parser.add_argument("--codes", type=int, default=10000, help="кодов в каждом дропе")
+    parser.add_argument("--claims", type=int, default=20000, help="сколько нажатий сделать")
+    parser.add_argument("--repeat-ratio", type=float, default=0.3, help="доля повторных нажатий")
+    parser.add_argument("--concurrency", type=int, default=100, help="одновременных задач выдачи")
+    parser.add_argument("--import-codes", type=int, default=200000, help="кодов в замере импорта")
+    parser.add_argument("--chunk-size", type=int, default=50000)
+    parser.add_argument("--query-repeats", type=int, default=200, help="повторов /left на дроп")
+    parser.add_argument("--report-drops", type=int, default=3, help="сколько дропов выгрузить /report")
+    parser.add_argument("--report-gzip", action="store_true")
+    parser.add_argument("--readers", type=int, default=2)
+    parser.add_argument("--group-commit-ms", type=float, default=0)
+    parser.add_argument("--group-commit-max", type=int, default=64)
+    parser.add_argument("--claim-cache-size", type=int, default=100000)
+    parser.add_argument("--global-one-per-user", action="store_true")
+    parser.add_argument("--foreign-writer-ms", type=float, default=0, help="держать блокировку записи N мс")
+    parser.add_argument("--foreign-writer-period-ms", type=float, default=20)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда записать JSON (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    result = {
+        "revision": git_revision(),
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        **asyncio.run(run(args)),
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
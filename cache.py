@@ -0,0 +1,108 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable
+
+
+class LRUCache:
+    """Простой ограниченный LRU-словарь. Не потокобезопасен — только для event loop."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, Any]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            self._data.move_to_end(key)
+        except KeyError:
+            return default
+        return self._data[key]
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        return self._data.pop(key, default)
+
+
+class AsyncTTLCache:
+    """LRU-кэш с TTL для результатов корутин.
+
+    Одновременные промахи по одному ключу объединяются (single-flight):
+    загрузка выполняется один раз, остальные ждут её результат.
+    Ошибки загрузки не кэшируются. Если первую загрузку отменили,
+    ожидающие не отменяются вместе с ней, а повторяют загрузку сами.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            return default
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return default
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        missing = object()
+        value = self.get(key, missing)
+        if value is not missing:
+            self.hits += 1
+            return value
+        self.misses += 1
+        fut = self._inflight.get(key)
+        if fut is not None:
+            # asyncio.wait не отменяет fut и не бросает CancelledError чужой отмены
+            await asyncio.wait((fut,))
+            if fut.cancelled():
+                # Загрузившего отменили — его отмена не наша: грузим сами
+                return await self.get_or_load(key, loader)
+            return fut.result()
+        fut = self._inflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            value = await loader()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except BaseException as exc:
+            fut.set_exception(exc)
+            # исключение уже получит тот, кто вызвал загрузку; ожидающим — через fut.result()
+            fut.exception()
+            raise
+        else:
+            self.set(key, value)
+            fut.set_result(value)
+            return value
+        finally:
+            self._inflight.pop(key, None)
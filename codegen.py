@@ -0,0 +1,96 @@
+"""Генерация промокодов на стороне бота для /codes gen.
+
+Случайность — secrets.token_bytes крупными порциями. Байты переводятся в символы
+алфавита одним bytes.translate: байты из «хвоста» 256 % len(alphabet) выбрасываются
+(rejection sampling), поэтому все символы равновероятны. Уникальность внутри партии
+проверяется по множеству уже выданных генератором кодов — в базу они попадают
+через тот же add_codes, что и импорт, а индекс (batch_id, code) остаётся подстраховкой.
+"""
+import math
+import secrets
+from typing import IO, Iterator, List, Optional, Tuple
+
+ALPHABETS = {
+    # без похожих друг на друга символов (0/O, 1/I/L) — такие коды удобно вводить вручную
+    "safe": "ABCDEFGHJKMNPQRSTUVWXYZ23456789",
+    "upper": "ABCDEFGHIJKLMNOPQRSTUVWXYZ",
+    "lower": "abcdefghijklmnopqrstuvwxyz",
+    "digits": "0123456789",
+    "hex": "0123456789ABCDEF",
+    "alnum": "ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789",
+}
+DEFAULT_ALPHABET = "safe"
+DEFAULT_LENGTH = 10
+MIN_LENGTH, MAX_LENGTH = 4, 64
+# Символы, которые split_codes считает разделителями: с ними файл кодов не импортировать обратно
+FORBIDDEN_CHARS = set(",; \t\r\n")
+# Во сколько раз пространство кодов должно превышать их число: при 1000 повторов почти нет
+MIN_SPACE_RATIO = 1000
+
+
+def resolve_alphabet(spec: str) -> str:
+    """Имя из ALPHABETS или сами символы; повторы убираются с сохранением порядка."""
+    alphabet = "".join(dict.fromkeys(ALPHABETS.get(spec.lower(), spec)))
+    if not alphabet.isascii() or not alphabet.isprintable() or FORBIDDEN_CHARS & set(alphabet):
+        raise ValueError("Алфавит — печатные ASCII-символы без пробелов, запятых и точек с запятой.")
+    if len(alphabet) < 2:
+        raise ValueError("В алфавите нужно хотя бы два разных символа.")
+    return alphabet
+
+
+def validate(count: int, length: int, alphabet: str) -> None:
+    if not MIN_LENGTH <= length <= MAX_LENGTH:
+        raise ValueError(f"Длина кода — от {MIN_LENGTH} до {MAX_LENGTH} символов.")
+    # Сравниваем логарифмы: len(alphabet) ** 64 считать незачем
+    if length * math.log(len(alphabet)) < math.log(count * MIN_SPACE_RATIO):
+        raise ValueError(
+            f"Слишком мало вариантов для {count} кодов: увеличьте длину или возьмите алфавит побольше."
+        )
+
+
+def _translation(alphabet: str) -> Tuple[bytes, bytes]:
+    """Таблица bytes.translate и байты, которые отбрасываются ради равномерности."""
+    n = len(alphabet)
+    limit = 256 - 256 % n
+    table = bytes(ord(alphabet[b % n]) if b < limit else 0 for b in range(256))
+    return table, bytes(range(limit, 256))
+
+
+def generate_codes(
+    count: int,
+    length: int = DEFAULT_LENGTH,
+    alphabet: str = ALPHABETS[DEFAULT_ALPHABET],
+    prefix: str = "",
+    chunk_size: int = 50000,
+    sink: Optional[IO[str]] = None,
+) -> Iterator[List[str]]:
+    """Отдаёт `count` уникальных кодов кусками по `chunk_size` — в формате, который ждёт add_codes.
+
+    Каждый кусок до отдачи дописывается в `sink` (по коду в строке), так что файл
+    для администратора совпадает с тем, что ушло в базу.
+    """
+    table, rejected = _translation(alphabet)
+    keep = 1 - len(rejected) / 256
+    seen: set = set()
+    made = 0
+    while made < count:
+        need = min(chunk_size, count - made) * length
+        chars = b""
+        while len(chars) < need:
+            # С небольшим запасом на отброшенные байты; недобор доберётся следующим кругом
+            raw = secrets.token_bytes(int((need - len(chars)) / keep) + 64)
+            chars += raw.translate(table, rejected)
+        text = chars[:need].decode("ascii")
+        chunk = []
+        for i in range(0, need, length):
+            code = prefix + text[i:i + length]
+            if code not in seen:
+                seen.add(code)
+                chunk.append(code)
+        made += len(chunk)
+        # Отсортированный кусок ложится в индекс (batch_id, code) соседними страницами,
+        # а не вразброс: на миллионе кодов вставка заметно быстрее
+        chunk.sort()
+        if sink is not None:
+            sink.write("\n".join(chunk) + "\n")
+        yield chunk
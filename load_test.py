@@ -0,0 +1,283 @@
+"""Нагрузочный прогон всего бота: Dispatcher, обработчики, очередь исходящих — против
+локальной заглушки Bot API вместо Telegram.
+
+Заглушка (aiohttp) отвечает на getMe, sendMessage, sendPhoto, sendDocument,
+editMessageReplyMarkup, answerCallbackQuery, getChatMember и т.п., умеет
+добавлять задержку и отвечать 429. Бот публикует дроп через /post, затем
+нажатия кнопки подаются в dp.feed_update с заданной частотой:
+
+    python load_test.py --rate 500 --claims 5000 --codes 3000
+    python load_test.py --mode webhook --api-latency-ms 30 --api-429-rate 0.01
+    python load_test.py --backend memory --out run.json
+
+В режиме polling ответ на нажатие уходит отдельным запросом answerCallbackQuery,
+в режиме webhook он возвращается в ответе и запросом не считается.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from contextlib import redirect_stdout
+from pathlib import Path
+from typing import List
+
+from aiohttp import web
+
+from bench_storage import git_revision, percentiles
+
+TOKEN = "123456:LOADTESTLOADTESTLOADTESTLOADTEST0000"
+ADMIN_ID = 1
+CHAT_ID = -100
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: считает вызовы по методам, добавляет задержку и 429."""
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, error_429_rate: float = 0, retry_after: int = 1):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.error_429_rate = error_429_rate
+        self.retry_after = retry_after
+        self.calls: Counter = Counter()
+        self.throttled: Counter = Counter()
+        self._message_id = 0
+        self._rnd = random.Random(7)
+        self._runner = None
+        self.url = ""
+
+    async def start(self, host: str = "127.0.0.1") -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    def _message(self, fields) -> dict:
+        self._message_id += 1
+        chat_id = int(fields.get("chat_id", 0))
+        return {
+            "message_id": self._message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "text": fields.get("text") or fields.get("caption") or "",
+        }
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        fields = await request.post()
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + self._rnd.random() * self.jitter)
+        if self.error_429_rate and self._rnd.random() < self.error_429_rate:
+            self.throttled[method] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        self.calls[method] += 1
+        name = method.lower()
+        if name == "getme":
+            result = {"id": 123456, "is_bot": True, "first_name": "Load", "username": "load_test_bot"}
+        elif name == "getchatmember":
+            result = {"status": "member", "user": {"id": int(fields.get("user_id", 0)), "is_bot": False, "first_name": "U"}}
+        elif name in ("sendmessage", "sendphoto", "senddocument", "editmessagereplymarkup", "editmessagetext"):
+            result = self._message(fields)
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+
+def configure_env(args, api_url: str, db_path: str) -> None:
+    """main.py читает настройки при импорте — выставляем их до него."""
+    os.environ.update({
+        "BOT_TOKEN": TOKEN,
+        "ADMIN_IDS": str(ADMIN_ID),
+        "DB_PATH": db_path,
+        "TELEGRAM_API_URL": api_url,
+        "INPUT_CHAT_ID": str(CHAT_ID),
+        "OUTPUT_CHAT_ID": str(CHAT_ID),
+        "STORAGE_BACKEND": args.backend,
+        "SNAPSHOT_INTERVAL": "0",
+        "OUTBOUND_GLOBAL_RATE": str(args.outbound_rate),
+        "OUTBOUND_PRIVATE_RATE": str(args.outbound_rate),
+        "OUTBOUND_GROUP_PER_MIN": str(args.outbound_rate * 60),
+        "REPORT_MODE": args.report_mode,
+        "SEND_PM_ON_REPEAT": "TRUE" if args.pm else "FALSE",
+        "CLAIM_GROUP_COMMIT_MS": str(args.group_commit_ms),
+        "RECORD_UPDATES": "",
+    })
+
+
+def message_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id, "date": int(time.time()), "text": text,
+            "chat": {"id": CHAT_ID, "type": "supergroup"},
+            "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "Admin"},
+            "entities": [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}],
+        },
+    }
+
+
+def callback_update(update_id: int, user_id: int, drop_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "chat_instance": "load",
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"},
+            "data": f"get:{drop_id}",
+            "message": {"message_id": 1, "date": 0, "chat": {"id": CHAT_ID, "type": "supergroup"}},
+        },
+    }
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.api_latency_ms, args.api_jitter_ms, args.api_429_rate, args.api_retry_after)
+    await api.start()
+    tmp = tempfile.TemporaryDirectory(prefix="promo_load_")
+    configure_env(args, api.url, os.path.join(tmp.name, "load.sqlite3"))
+
+    import main as bot_main
+    from aiogram.methods import TelegramMethod
+    from aiogram.types import Update
+
+    dp, bot = bot_main.dp, bot_main.bot
+    result = {}
+    try:
+        bot_main.BOT_USERNAME = (await bot.get_me()).username
+        await dp.emit_startup(bot=bot, dispatcher=dp)
+
+        # Подготовка через обычные обработчики: коды прямо в хранилище, публикация — командой /post
+        codes = ([f"LOAD{i:08d}" for i in range(start, min(args.codes, start + 50000))]
+                 for start in range(0, args.codes, 50000))
+        await bot_main.storage.add_codes(CHAT_ID, codes)
+        await dp.feed_update(bot, Update.model_validate(message_update(1, "/post Нагрузочный дроп")))
+        drop_id = await bot_main.storage.latest_drop(CHAT_ID)
+        if not drop_id:
+            raise SystemExit("Не удалось опубликовать дроп — см. лог выше.")
+        api.calls.clear()
+
+        rnd = random.Random(args.seed)
+        users: List[int] = []
+        latencies: List[float] = []
+        lateness: List[float] = []
+        answers: Counter = Counter()
+        tasks = []
+
+        async def press(update: Update, scheduled: float):
+            started = time.perf_counter()
+            lateness.append(started - scheduled)
+            if args.mode == "webhook":
+                response = await dp.feed_webhook_update(bot, update)
+            else:
+                response = await dp.feed_update(bot, update)
+                # Так делает polling: возвращённый метод отправляется отдельным запросом
+                if isinstance(response, TelegramMethod):
+                    await dp.silent_call_request(bot, response)
+            latencies.append(time.perf_counter() - started)
+            answers[type(response).__name__ if response is not None else "None"] += 1
+
+        t0 = time.perf_counter()
+        for i in range(args.claims):
+            if users and rnd.random() < args.repeat_ratio:
+                user_id = rnd.choice(users)
+            else:
+                user_id = 10_000 + i
+                users.append(user_id)
+            update = Update.model_validate(callback_update(100 + i, user_id, drop_id))
+            scheduled = t0 + i / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(press(update, scheduled)))
+        await asyncio.gather(*tasks)
+        feed_seconds = time.perf_counter() - t0
+        claim_calls = dict(api.calls)
+
+        # Досылка личных сообщений и отчётов после всплеска
+        drain_started = time.perf_counter()
+        backlog = bot_main.outbound.pending()
+        while bot_main.outbound.pending() and time.perf_counter() - drain_started < args.drain_timeout:
+            await asyncio.sleep(0.05)
+        drain_seconds = time.perf_counter() - drain_started
+
+        claims = len(latencies)
+        left, total, _ = await bot_main.storage.drop_counts(drop_id)
+        result = {
+            "claims": claims,
+            "assigned": total - left,
+            "target_rate": args.rate,
+            "achieved_rate": round(claims / feed_seconds),
+            "latency": percentiles(latencies),
+            "schedule_lag": percentiles(lateness),
+            "responses": dict(answers),
+            "api_calls_during_claims": claim_calls,
+            "api_calls_per_claim": round(sum(claim_calls.values()) / claims, 3) if claims else 0,
+            "outbound_backlog_after_claims": backlog,
+            "outbound_drain_seconds": round(drain_seconds, 3),
+            "api_calls_total": dict(api.calls),
+            "api_throttled": dict(api.throttled),
+        }
+    finally:
+        await dp.emit_shutdown(bot=bot, dispatcher=dp)
+        result["storage_stats"] = bot_main.storage.stats()
+        result["outbound_stats"] = dict(bot_main.outbound.stats)
+        result["metrics"] = bot_main.REGISTRY.summary()
+        await bot.session.close()
+        await api.stop()
+        tmp.cleanup()
+    return result
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон бота против заглушки Bot API")
+    parser.add_argument("--mode", choices=("polling", "webhook"), default="polling")
+    parser.add_argument("--backend", choices=("sqlite", "memory"), default="sqlite")
+    parser.add_argument("--rate", type=float, default=300, help="нажатий в секунду")
+    parser.add_argument("--claims", type=int, default=3000, help="всего нажатий")
+    parser.add_argument("--codes", type=int, default=2000, help="кодов в дропе")
+    parser.add_argument("--repeat-ratio", type=float, default=0.2, help="доля повторных нажатий")
+    parser.add_argument("--pm", action="store_true", help="дублировать коды в ЛС (SEND_PM_ON_REPEAT)")
+    parser.add_argument("--report-mode", choices=("each", "digest"), default="digest")
+    parser.add_argument("--outbound-rate", type=float, default=30, help="лимит исходящей очереди в секунду")
+    parser.add_argument("--group-commit-ms", type=float, default=0)
+    parser.add_argument("--api-latency-ms", type=float, default=0)
+    parser.add_argument("--api-jitter-ms", type=float, default=0)
+    parser.add_argument("--api-429-rate", type=float, default=0, help="доля ответов 429")
+    parser.add_argument("--api-retry-after", type=int, default=1)
+    parser.add_argument("--drain-timeout", type=float, default=30, help="сколько ждать досылки очереди")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--out", help="куда записать JSON (по умолчанию stdout)")
+    args = parser.parse_args(argv)
+
+    # Сообщения самого бота (print при остановке) не должны смешиваться с JSON
+    with redirect_stdout(sys.stderr):
+        measured = asyncio.run(run(args))
+    result = {
+        "revision": git_revision(),
+        "params": {k: v for k, v in vars(args).items() if k != "out"},
+        **measured,
+    }
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        Path(args.out).write_text(text + "\n", encoding="utf-8")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
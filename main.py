@@ -1,28 +1,51 @@
 import asyncio
+import csv
+import gzip
+import io
+import logging
 import os
-import sqlite3
-from contextlib import closing, suppress
-from datetime import datetime, timezone
-from typing import Tuple, Optional
+import signal
+import tempfile
+import time
+from contextlib import suppress
+from typing import Callable, Dict, Iterator, List, Tuple, Optional, Union
 from html import escape
 import re
 
 from aiogram import Bot, Dispatcher, F
-from aiogram.enums import ParseMode, ChatType
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.enums import ParseMode, ChatType, ChatMemberStatus
 from aiogram.client.default import DefaultBotProperties
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError
 from aiogram.filters import Command
+from aiogram.methods import SendMessage, SendPhoto
 from aiogram.utils.token import TokenValidationError, validate_token
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     Message,
     CallbackQuery,
+    ChatMemberUpdated,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
-    User,
+    BufferedInputFile,
+    FSInputFile,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiohttp import web
 from dotenv import load_dotenv
 from pathlib import Path
 
+import codegen
+from cache import AsyncTTLCache
+from metrics import REGISTRY, serve as serve_metrics
+from middlewares import ClaimGuard, HandlerTimingMiddleware, UpdateTracker
+from outbound import PRIORITY_USER, OutboundQueue
+from profiler import StackSampler
+from reports import ClaimReporter
+from memory_storage import MemoryStorage
+from storage import ClaimResult, SqliteStorage, Storage
+
 # Загружаем .env из того же каталога, что и main.py
 load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
 # Стрипуем кавычки/пробелы, если вдруг в .env добавили их
@@ -31,6 +54,82 @@ ADMIN_IDS = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split("
 GLOBAL_ONE_PER_USER = os.getenv("GLOBAL_ONE_PER_USER", "FALSE").upper() in ("1", "TRUE", "YES")
 DB_PATH = os.getenv("DB_PATH", "promo_bot.sqlite3")
 SEND_PM_ON_REPEAT = os.getenv("SEND_PM_ON_REPEAT", "TRUE").upper() in ("1", "TRUE", "YES")
+# Движок хранилища: sqlite — запись каждой выдачи, memory — всё в памяти со снимками в DB_PATH
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite").strip().lower()
+# Раз в сколько секунд memory-движок сохраняет снимок (0 — только при остановке)
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60") or 60)
+# Число read-only соединений к БД (запись всегда идёт через один поток)
+DB_READERS = int(os.getenv("DB_READERS", "2") or 2)
+# Group commit выдач: окно в мс (0 — выключено) и максимум выдач в одной транзакции
+CLAIM_GROUP_COMMIT_MS = float(os.getenv("CLAIM_GROUP_COMMIT_MS", "0") or 0)
+CLAIM_GROUP_COMMIT_MAX = int(os.getenv("CLAIM_GROUP_COMMIT_MAX", "64") or 64)
+# Сколько последних выдач (user_id, drop_id) помнить в памяти для повторных нажатий
+CLAIM_CACHE_SIZE = int(os.getenv("CLAIM_CACHE_SIZE", "100000") or 100000)
+# Фоновое обслуживание БД раз в MAINTENANCE_INTERVAL сек. (0 — только командой /maintenance),
+# если последние MAINTENANCE_QUIET_SECONDS сек. не было выдач
+MAINTENANCE_INTERVAL = float(os.getenv("MAINTENANCE_INTERVAL", "600") or 0)
+MAINTENANCE_QUIET_SECONDS = float(os.getenv("MAINTENANCE_QUIET_SECONDS", "30") or 0)
+# Архив дропов: отдельный файл; переносятся разобранные целиком без выдач дольше ARCHIVE_FINISHED_HOURS
+# часов и, если задано, все дропы старше ARCHIVE_AFTER_DAYS дней — даже со свободными кодами, кнопка
+# у них перестаёт выдавать коды (0 — критерий выключен). Последний дроп чата не трогается
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "").strip() or str(Path(DB_PATH).with_suffix(".archive.sqlite3"))
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "0") or 0)
+ARCHIVE_FINISHED_HOURS = float(os.getenv("ARCHIVE_FINISHED_HOURS", "24") or 0)
+# Сколько свободных страниц возвращать ОС за проход (auto_vacuum=INCREMENTAL)
+VACUUM_PAGES = int(os.getenv("VACUUM_PAGES", "2000") or 0)
+# Порог автоматического чекпоинта WAL в страницах (0 — по умолчанию SQLite, 1000). Чем больше,
+# тем реже чекпоинт случается прямо в транзакции выдачи, а не в фоновом обслуживании
+WAL_AUTOCHECKPOINT = int(os.getenv("WAL_AUTOCHECKPOINT", "0") or 0)
+# Импорт кодов из файла: размер куска для executemany и частота обновления статуса
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "50000") or 50000)
+IMPORT_PROGRESS_INTERVAL = float(os.getenv("IMPORT_PROGRESS_INTERVAL", "3") or 3)
+# Максимум кодов за одну команду /codes gen
+CODES_GEN_MAX = int(os.getenv("CODES_GEN_MAX", "1000000") or 1000000)
+# Лимиты исходящей очереди: глобально в секунду, в группу в минуту, в личку в секунду
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30") or 30)
+OUTBOUND_GROUP_PER_MIN = float(os.getenv("OUTBOUND_GROUP_PER_MIN", "20") or 20)
+OUTBOUND_PRIVATE_RATE = float(os.getenv("OUTBOUND_PRIVATE_RATE", "1") or 1)
+# Кэш проверок «админ ли в группе»: время жизни в секундах и максимум записей
+ADMIN_CACHE_TTL = float(os.getenv("ADMIN_CACHE_TTL", "300") or 300)
+# Лимит нажатий «получить код» на пользователя по всем дропам: CLAIM_USER_RATE в секунду,
+# всплеск до CLAIM_USER_BURST; 0 — без лимита. Сверх лимита — ответ CLAIM_THROTTLED_TEXT
+# (пусто — нажатие молча отбрасывается)
+CLAIM_USER_RATE = float(os.getenv("CLAIM_USER_RATE", "1") or 0)
+CLAIM_USER_BURST = max(1.0, float(os.getenv("CLAIM_USER_BURST", "3") or 1))
+CLAIM_THROTTLED_TEXT = os.getenv("CLAIM_THROTTLED_TEXT", "Слишком часто, попробуйте через пару секунд.").strip()
+ADMIN_CACHE_SIZE = int(os.getenv("ADMIN_CACHE_SIZE", "10000") or 10000)
+# Отчёты о выдаче: each — сообщение на каждый код, digest — сводка раз в N секунд или M выдач
+REPORT_MODE = os.getenv("REPORT_MODE", "each").strip().lower()
+REPORT_DIGEST_INTERVAL = float(os.getenv("REPORT_DIGEST_INTERVAL", "10") or 10)
+REPORT_DIGEST_MAX = int(os.getenv("REPORT_DIGEST_MAX", "50") or 50)
+# /report сразу сжимает CSV в .gz
+REPORT_GZIP = os.getenv("REPORT_GZIP", "FALSE").upper() in ("1", "TRUE", "YES")
+
+# Режим запуска: polling (по умолчанию) или webhook со встроенным aiohttp-сервером
+RUN_MODE = os.getenv("RUN_MODE", "polling").strip().lower()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0").strip()
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080") or 8080)
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook").strip() or "/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+# Публичный https-адрес без пути. Пусто — setWebhook не вызываем (локальный прогон, вебхук за балансировщиком)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+# Сколько секунд при остановке ждать уже принятые апдейты, а затем досылку исходящей очереди
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30") or 30)
+# Свой сервер Bot API (local bot api или заглушка для тестов); пусто — api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").strip().rstrip("/")
+# Имя бота без @: если задано, при старте не ходим в getMe
+ENV_BOT_USERNAME = os.getenv("BOT_USERNAME", "").strip().lstrip("@")
+# Файл, куда дописывать входящие апдейты (JSONL) для replay_updates.py; пусто — не пишем
+RECORD_UPDATES = os.getenv("RECORD_UPDATES", "").strip()
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics; 0 — не поднимать сервер
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1").strip()
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0") or 0)
+# Сэмплирующий профайлер: период в мс (0 — выключен); стеки пишутся в PROFILE_DUMP_PATH по SIGUSR1
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "0") or 0)
+PROFILE_DUMP_PATH = os.getenv("PROFILE_DUMP_PATH", "profile.collapsed").strip()
+
+# Наборы чатов для /post to=<набор>: «partners=-1001,-1002;vip=-1003,@channel»
+POST_PRESETS_RAW = os.getenv("POST_PRESETS", "").strip()
 
 # Разнести «чат загрузки» и «чат выдачи» через .env (по желанию)
 ENV_INPUT_CHAT_ID = int(os.getenv("INPUT_CHAT_ID", "0") or 0)
@@ -48,107 +147,142 @@ except TokenValidationError as exc:
         "Некорректный BOT_TOKEN. Проверьте значение в .env (формат 123456:ABCDEF)."
     ) from exc
 
-bot = Bot(BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+if STORAGE_BACKEND not in ("sqlite", "memory"):
+    raise SystemExit("STORAGE_BACKEND должен быть sqlite или memory.")
+
+if RUN_MODE not in ("polling", "webhook"):
+    raise SystemExit("RUN_MODE должен быть polling или webhook.")
+
+if WEBHOOK_SECRET and not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+    raise SystemExit("WEBHOOK_SECRET: только латиница, цифры, _ и -, не длиннее 256 символов.")
+
+ChatRef = Union[int, str]
+
+
+def parse_chat_refs(text: str) -> List[ChatRef]:
+    """«-1001,@channel» -> [-1001, "@channel"]; ValueError на всё остальное."""
+    refs: List[ChatRef] = []
+    for item in filter(None, (p.strip() for p in text.split(","))):
+        if re.fullmatch(r"-?\d+", item):
+            refs.append(int(item))
+        elif re.fullmatch(r"@\w{4,}", item):
+            refs.append(item)
+        else:
+            raise ValueError(item)
+    return refs
+
+
+POST_PRESETS: Dict[str, List[ChatRef]] = {}
+for preset in filter(None, (p.strip() for p in POST_PRESETS_RAW.split(";"))):
+    name, _, chats = preset.partition("=")
+    try:
+        POST_PRESETS[name.strip().lower()] = parse_chat_refs(chats)
+    except ValueError as exc:
+        raise SystemExit(f"POST_PRESETS: не понимаю чат «{exc}» в наборе «{name.strip()}».") from exc
+    if not POST_PRESETS[name.strip().lower()]:
+        raise SystemExit(f"POST_PRESETS: в наборе «{name.strip()}» нет чатов.")
+
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
-BOT_USERNAME: Optional[str] = None
-
-SCHEMA = """
-PRAGMA journal_mode=WAL;
-CREATE TABLE IF NOT EXISTS chats (
-  chat_id INTEGER PRIMARY KEY,
-  pending_pool_id INTEGER
-);
-CREATE TABLE IF NOT EXISTS code_batches (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  chat_id INTEGER NOT NULL,
-  created_at TEXT NOT NULL
-);
-CREATE TABLE IF NOT EXISTS codes (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  batch_id INTEGER NOT NULL,
-  code TEXT NOT NULL,
-  used_by INTEGER,
-  used_at TEXT
-);
-CREATE TABLE IF NOT EXISTS drops (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  chat_id INTEGER NOT NULL,
-  message_id INTEGER NOT NULL,
-  created_at TEXT NOT NULL
-);
-CREATE TABLE IF NOT EXISTS drop_sources (
-  drop_id INTEGER PRIMARY KEY,
-  source_chat_id INTEGER NOT NULL
-);
-CREATE TABLE IF NOT EXISTS drop_codes (
-  drop_id INTEGER NOT NULL,
-  code_id INTEGER NOT NULL,
-  assigned_user_id INTEGER,
-  assigned_at TEXT,
-  PRIMARY KEY (drop_id, code_id)
-);
-CREATE TABLE IF NOT EXISTS claims (
-  id INTEGER PRIMARY KEY AUTOINCREMENT,
-  user_id INTEGER NOT NULL,
-  drop_id INTEGER NOT NULL,
-  code_id INTEGER NOT NULL,
-  claimed_at TEXT NOT NULL
-);
-CREATE TABLE IF NOT EXISTS admin_bindings (
-  user_id INTEGER PRIMARY KEY,
-  chat_id INTEGER NOT NULL
-);
-CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_code ON codes(code);
-CREATE INDEX IF NOT EXISTS idx_codes_used ON codes(used_by);
-CREATE INDEX IF NOT EXISTS idx_drop_codes_drop ON drop_codes(drop_id);
-CREATE INDEX IF NOT EXISTS idx_claims_user_drop ON claims(user_id, drop_id);
-"""
-
-
-def db():
-    # check_same_thread=False позволяет использовать соединение из разных потоков
-    conn = sqlite3.connect(DB_PATH, isolation_level=None, timeout=10, check_same_thread=False)
-    conn.execute("PRAGMA foreign_keys=ON")
-    return conn
-
-
-def init_db():
-    with closing(db()) as conn:
-        conn.executescript(SCHEMA)
-
-def migrate_unique_per_batch():
-    """Делаем уникальность кодов не глобально, а внутри одной партии (batch)."""
-    with closing(db()) as conn:
-        try:
-            conn.execute("DROP INDEX IF EXISTS idx_codes_code")
-        except Exception:
-            pass
-        conn.execute(
-            "CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_code_batch "
-            "ON codes(batch_id, code)"
-        )
+BOT_USERNAME: Optional[str] = ENV_BOT_USERNAME or None
+
+storage: Storage
+if STORAGE_BACKEND == "memory":
+    storage = MemoryStorage(DB_PATH, snapshot_interval=SNAPSHOT_INTERVAL, global_one_per_user=GLOBAL_ONE_PER_USER)
+else:
+    storage = SqliteStorage(
+        DB_PATH,
+        readers=DB_READERS,
+        group_commit_ms=CLAIM_GROUP_COMMIT_MS,
+        group_commit_max=CLAIM_GROUP_COMMIT_MAX,
+        claim_cache_size=CLAIM_CACHE_SIZE,
+        global_one_per_user=GLOBAL_ONE_PER_USER,
+        archive_path=ARCHIVE_DB_PATH,
+        archive_after_days=ARCHIVE_AFTER_DAYS,
+        archive_finished_hours=ARCHIVE_FINISHED_HOURS,
+        maintenance_interval=MAINTENANCE_INTERVAL,
+        quiet_seconds=MAINTENANCE_QUIET_SECONDS,
+        vacuum_pages=VACUUM_PAGES,
+        wal_autocheckpoint=WAL_AUTOCHECKPOINT,
+    )
+# ЛС пользователям и отчёты админам уходят через фоновую очередь с лимитами Telegram
+outbound = OutboundQueue(
+    bot,
+    global_rate=OUTBOUND_GLOBAL_RATE,
+    group_per_minute=OUTBOUND_GROUP_PER_MIN,
+    private_rate=OUTBOUND_PRIVATE_RATE,
+)
+reporter = ClaimReporter(
+    storage,
+    outbound,
+    mode=REPORT_MODE,
+    interval=REPORT_DIGEST_INTERVAL,
+    max_events=REPORT_DIGEST_MAX,
+)
+# (chat_id, user_id) -> админ ли; обновляется и по апдейтам chat_member
+admin_cache = AsyncTTLCache(ADMIN_CACHE_TTL, ADMIN_CACHE_SIZE)
+ADMIN_STATUSES = (ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.CREATOR)
+# Пользователи, которым не удалось написать в ЛС (не запускали бота или заблокировали его)
+pm_unreachable: set = set()
+# Пользователи, которым ЛС уже доходило: им подсказка про «📩 В личку» не нужна
+pm_delivered: set = set()
+# Апдейты в обработке: при остановке дожидаемся их до закрытия очереди и БД
+update_tracker = UpdateTracker(RECORD_UPDATES)
+dp.update.outer_middleware(update_tracker)
+for observer in (dp.message, dp.callback_query, dp.chat_member):
+    observer.middleware(HandlerTimingMiddleware())
+# Повторные и слишком частые нажатия «get:» отсекаются до хранилища и Bot API
+dp.callback_query.outer_middleware(ClaimGuard(CLAIM_USER_RATE, CLAIM_USER_BURST, CLAIM_THROTTLED_TEXT))
+
+CLAIM_SECONDS = REGISTRY.histogram("claim_seconds", "Время выдачи кода в хранилище")
+CLAIMS = REGISTRY.counter("claims_total", "Нажатия «получить код» по результату")
+TELEGRAM_ERRORS = REGISTRY.counter("telegram_errors_total", "Ошибки вызовов Bot API, не прервавшие обработку")
+
+profiler = StackSampler(PROFILE_INTERVAL_MS / 1000) if PROFILE_INTERVAL_MS > 0 else None
+metrics_runner: Optional[web.AppRunner] = None
+
+
+def is_bot_admin(message: Message) -> bool:
+    """Только ADMIN_IDS — для команд, которые нагружают базу или трогают весь процесс.
+
+    is_admin пускает любого в ЛС, а этим командам нужен именно владелец бота.
+    """
+    return bool(message.from_user and message.from_user.id in ADMIN_IDS)
+
 
 async def is_admin(message: Message) -> bool:
     if message.from_user and message.from_user.id in ADMIN_IDS:
         return True
     if message.chat.type not in (ChatType.SUPERGROUP, ChatType.GROUP):
         return True
+    chat_id, user_id = message.chat.id, message.from_user.id
+
+    async def load() -> bool:
+        member = await bot.get_chat_member(chat_id, user_id)
+        return member.status in ADMIN_STATUSES
+
     try:
-        member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-        return member.is_chat_admin()
-    except Exception:
+        return await admin_cache.get_or_load((chat_id, user_id), load)
+    except Exception as exc:
+        TELEGRAM_ERRORS.inc(op="get_chat_member", error=type(exc).__name__)
         return False
 
 
-def get_target_chats(conn: sqlite3.Connection, message: Message) -> Tuple[int, int]:
+@dp.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    # Права поменялись — сразу обновляем кэш, не дожидаясь TTL
+    admin_cache.set((event.chat.id, event.new_chat_member.user.id), event.new_chat_member.status in ADMIN_STATUSES)
+
+
+async def get_target_chats(message: Message) -> Tuple[int, int]:
     """Возвращает (input_chat_id, output_chat_id)."""
     if ENV_INPUT_CHAT_ID and ENV_OUTPUT_CHAT_ID:
         return ENV_INPUT_CHAT_ID, ENV_OUTPUT_CHAT_ID
     # Fallback: старая логика bind → всё в текущем чате/привязанном
     if message.chat.type in (ChatType.SUPERGROUP, ChatType.GROUP):
         return message.chat.id, message.chat.id
-    row = conn.execute("SELECT chat_id FROM admin_bindings WHERE user_id=?", (message.from_user.id,)).fetchone()
-    chat_id = row[0] if row else 0
+    chat_id = await storage.get_binding(message.from_user.id)
     return chat_id, chat_id
 
 
@@ -160,70 +294,252 @@ async def cmd_bind(message: Message):
         return await message.reply("Эту команду нужно вызвать в группе, которую хотите привязать.")
     if not await is_admin(message):
         return await message.reply("Только администраторы могут выполнять /bind.")
-    with closing(db()) as conn:
-        conn.execute(
-            "INSERT INTO admin_bindings(user_id, chat_id) VALUES(?, ?) "
-            "ON CONFLICT(user_id) DO UPDATE SET chat_id=excluded.chat_id",
-            (message.from_user.id, message.chat.id),
-        )
+    await storage.bind_chat(message.from_user.id, message.chat.id)
     await message.reply("Готово! Теперь можно загружать коды в ЛС: <code>/codes AAA,BBB</code> и публиковать /post.")
 
 
+CODE_SPLIT_RE = re.compile(r"[,;\s]+")
+# Заголовки CSV, которые не считаем кодами
+CSV_HEADERS = {"code", "codes", "promo", "promocode", "код", "промокод"}
+# Bot API отдаёт через getFile файлы не больше 20 МБ, а принимает документы до 50 МБ
+MAX_IMPORT_FILE_SIZE = 20 * 1024 * 1024
+MAX_UPLOAD_FILE_SIZE = 50 * 1024 * 1024
+# Импорт читает файл блоками по столько символов; длиннее MAX_CODE_LENGTH кодов не бывает
+IMPORT_READ_BLOCK = 64 * 1024
+MAX_CODE_LENGTH = 256
+IMPORT_EXTENSIONS = (".txt", ".csv")
+
+
+def split_codes(text: str) -> List[str]:
+    # Парсим «жадно»: запятые / точки с запятой / пробелы / переносы
+    return [p for p in CODE_SPLIT_RE.split(text) if p]
+
+
+def iter_code_chunks(path: str, file_name: str, chunk_size: int) -> Iterator[List[str]]:
+    """Потоково читает коды из .txt/.csv (можно .gz) и отдаёт их кусками.
+
+    Файл читается блоками по IMPORT_READ_BLOCK символов, а не строками: файл
+    в одну строку `AAA,BBB,…` (или распакованный .gz) не поднимается в память целиком.
+    CSV берём по первой колонке, остальные форматы — как текст с любыми разделителями.
+    Код длиннее MAX_CODE_LENGTH — ValueError: такой файл не похож на список кодов.
+    """
+    name = file_name.lower()
+    with open(path, "rb") as raw:
+        gzipped = raw.read(2) == b"\x1f\x8b"
+    opener = gzip.open if gzipped else open
+    with opener(path, "rb") as binary:
+        stream = io.TextIOWrapper(binary, encoding="utf-8-sig", errors="replace", newline="")
+        chunk: List[str] = []
+        if name.removesuffix(".gz").endswith(".csv"):
+            for i, row in enumerate(csv.reader(_csv_lines(stream))):
+                if not row:
+                    continue
+                code = row[0].strip()
+                if not code or (i == 0 and code.lower() in CSV_HEADERS):
+                    continue
+                _check_code_length(len(code))
+                chunk.append(code)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        else:
+            tail = ""
+            while True:
+                block = stream.read(IMPORT_READ_BLOCK)
+                if not block:
+                    break
+                parts = CODE_SPLIT_RE.split(tail + block)
+                _check_code_length(max(map(len, parts)))
+                # Последний кусок может продолжиться в следующем блоке
+                tail = parts.pop()
+                chunk.extend(p for p in parts if p)
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+            if tail:
+                chunk.append(tail)
+        if chunk:
+            yield chunk
+
+
+def _csv_lines(stream: io.TextIOBase) -> Iterator[str]:
+    """Строки CSV не длиннее IMPORT_READ_BLOCK: от слишком длинной остаётся первая колонка."""
+    while True:
+        line = stream.readline(IMPORT_READ_BLOCK)
+        if not line:
+            return
+        if len(line) == IMPORT_READ_BLOCK and not line.endswith(("\n", "\r")):
+            line = line.split(",", 1)[0] + "\n"
+            # Остаток строки пропускаем тем же лимитом
+            while True:
+                rest = stream.readline(IMPORT_READ_BLOCK)
+                if not rest or rest.endswith(("\n", "\r")):
+                    break
+        yield line
+
+
+def _check_code_length(length: int) -> None:
+    if length > MAX_CODE_LENGTH:
+        raise ValueError(f"В файле есть код длиннее {MAX_CODE_LENGTH} символов — это не похоже на список кодов.")
+
+
+async def _import_document(message: Message, output_chat_id: int) -> Optional[int]:
+    """Скачивает вложение во временный файл и импортирует его с прогрессом в одном сообщении."""
+    document = message.document
+    if not (document.file_name or "").lower().removesuffix(".gz").endswith(IMPORT_EXTENSIONS):
+        await message.reply("Принимаю коды только в .txt или .csv (можно сжатые в .gz).")
+        return None
+    if document.file_size and document.file_size > MAX_IMPORT_FILE_SIZE:
+        await message.reply("Файл больше 20 МБ — сожмите его в .gz или разбейте на части.")
+        return None
+
+    status = await message.answer("Скачиваю файл с кодами…")
+    on_progress = _progress(status, "Импорт: прочитано <b>{seen}</b>, добавлено <b>{added}</b>…")
+
+    fd, path = tempfile.mkstemp(prefix="codes_", suffix=".upload")
+    os.close(fd)
+    try:
+        await bot.download(document, destination=path)
+        await _edit_status(status, "Файл получен, импортирую…")
+        chunks = iter_code_chunks(path, document.file_name or "", IMPORT_CHUNK_SIZE)
+        try:
+            _, added = await storage.add_codes(output_chat_id, chunks, on_progress)
+        except ValueError as exc:
+            # add_codes уже удалил недозагруженную партию
+            await _edit_status(status, f"Импорт отменён: {escape(str(exc))}")
+            return None
+    finally:
+        os.remove(path)
+    # Последнее обновление могло отстать — фиксируем итог
+    await _edit_status(status, f"Импорт завершён. Добавлено кодов: <b>{added}</b>.")
+    return added
+
+
+GEN_USAGE = (
+    "Формат: <code>/codes gen &lt;кол-во&gt; [длина] [алфавит] [префикс]</code>, например "
+    "<code>/codes gen 1000 10 safe SPRING-</code>.\n"
+    f"Алфавиты: {', '.join(codegen.ALPHABETS)} или свои символы. По умолчанию — "
+    f"{codegen.DEFAULT_LENGTH} символов из {codegen.DEFAULT_ALPHABET}."
+)
+
+
+async def _generate_codes(message: Message, output_chat_id: int, args: List[str]) -> Optional[int]:
+    """/codes gen: генерирует коды, загружает их одной партией и присылает файлом в ЛС админу."""
+    try:
+        if not args or not args[0].isdigit() or (len(args) > 1 and not args[1].isdigit()):
+            raise ValueError(GEN_USAGE)
+        count = int(args[0])
+        length = int(args[1]) if len(args) > 1 else codegen.DEFAULT_LENGTH
+        alphabet = codegen.resolve_alphabet(args[2] if len(args) > 2 else codegen.DEFAULT_ALPHABET)
+        prefix = args[3] if len(args) > 3 else ""
+        if not 1 <= count <= CODES_GEN_MAX:
+            raise ValueError(f"За раз можно сгенерировать от 1 до {CODES_GEN_MAX} кодов.")
+        if codegen.FORBIDDEN_CHARS & set(prefix):
+            raise ValueError("Префикс — без пробелов, запятых и точек с запятой.")
+        codegen.validate(count, length, alphabet)
+    except ValueError as exc:
+        await message.reply(str(exc))
+        return None
+
+    status = await message.answer(f"Генерирую {count} кодов…")
+    on_progress = _progress(status, "Генерация: создано <b>{seen}</b> из " + str(count) + "…")
+    # Файл пишется тем же проходом, что и вставка; большой — сразу в .gz
+    compress = count * (len(prefix) + length + 1) > MAX_UPLOAD_FILE_SIZE * 0.9
+    fd, path = tempfile.mkstemp(prefix="codes_", suffix=".gen")
+    os.close(fd)
+    try:
+        with (gzip.open if compress else open)(path, "wt", encoding="utf-8", newline="\n") as sink:
+            chunks = codegen.generate_codes(count, length, alphabet, prefix, IMPORT_CHUNK_SIZE, sink)
+            batch_id, added = await storage.add_codes(output_chat_id, chunks, on_progress)
+        await _edit_status(status, f"Сгенерировано и добавлено кодов: <b>{added}</b>.")
+        filename = f"codes_batch{batch_id}.txt" + (".gz" if compress else "")
+        try:
+            await bot.send_document(
+                message.from_user.id,
+                FSInputFile(path, filename=filename),
+                caption=f"Партия #{batch_id}: {added} кодов, длина {length}, префикс «{escape(prefix)}».",
+            )
+        except (TelegramForbiddenError, TelegramBadRequest) as exc:
+            TELEGRAM_ERRORS.inc(op="send_generated_codes", error=type(exc).__name__)
+            await message.reply("Не смог прислать файл с кодами в ЛС — напишите боту /start. Коды уже загружены.")
+    finally:
+        os.remove(path)
+    return added
+
+
+def _progress(status: Message, template: str) -> Callable[[int, int], None]:
+    """Колбэк прогресса add_codes: правит статус не чаще IMPORT_PROGRESS_INTERVAL секунд."""
+    last_edit = [0.0]
+
+    def on_progress(seen: int, added: int):
+        now = time.monotonic()
+        if now - last_edit[0] < IMPORT_PROGRESS_INTERVAL:
+            return
+        last_edit[0] = now
+        asyncio.create_task(_edit_status(status, template.format(seen=seen, added=added)))
+
+    return on_progress
+
+
+async def _edit_status(status: Message, text: str):
+    try:
+        await status.edit_text(text)
+    except Exception as exc:
+        TELEGRAM_ERRORS.inc(op="edit_status", error=type(exc).__name__)
+
+
 @dp.message(Command("codes"))
 async def cmd_codes(message: Message):
     if not await is_admin(message):
         return await message.reply("Команда доступна только администраторам.")
 
-    raw = message.text.split(maxsplit=1)
-    if len(raw) < 2:
-        return await message.reply("Укажи коды через запятую: <code>/codes AAA,BBB,CCC</code>")
-    codes_line = raw[1]
-
-    # Парсим «жадно»: запятые / точки с запятой / пробелы / переносы
-    parts = re.split(r"[,;\s]+", codes_line)
-    incoming = [p.strip() for p in parts if p and p.strip()]
-    if not incoming:
-        return await message.reply("Не вижу кодов в запросе.")
-
-    with closing(db()) as conn:
-        input_chat_id, output_chat_id = get_target_chats(conn, message)
-        if not input_chat_id or not output_chat_id:
+    raw = (message.text or message.caption or "").split(maxsplit=1)
+    words = raw[1].split() if len(raw) > 1 else []
+    gen_args = words[1:] if words and words[0].lower() == "gen" and not message.document else None
+    if message.document and not is_bot_admin(message):
+        return await message.reply("Загрузка кодов файлом доступна только администраторам бота (ADMIN_IDS).")
+    if gen_args is not None and not is_bot_admin(message):
+        # До миллиона строк за команду и замена ожидающей партии — не для любого в ЛС
+        return await message.reply("Генерация кодов доступна только администраторам бота (ADMIN_IDS).")
+    incoming: List[str] = []
+    if not message.document and gen_args is None:
+        if len(raw) < 2:
             return await message.reply(
-                "Не настроены чаты. Укажите INPUT_CHAT_ID/OUTPUT_CHAT_ID в .env или выполните /bind в группе."
+                "Укажи коды через запятую: <code>/codes AAA,BBB,CCC</code>, "
+                "пришли .txt/.csv/.gz файл с подписью <code>/codes</code> "
+                "или сгенерируй их: <code>/codes gen 1000</code>"
             )
-
-        # Разрешим загрузку только из INPUT_CHAT_ID (или из ЛС)
-        if message.chat.type in (ChatType.SUPERGROUP, ChatType.GROUP) and message.chat.id != input_chat_id:
-            return await message.reply("Коды нужно загружать в указанном чате загрузки (INPUT_CHAT_ID).")
-
-        now = datetime.now(timezone.utc).isoformat()
-        cur = conn.execute(
-            "INSERT INTO code_batches(chat_id, created_at) VALUES (?, ?)",
-            (output_chat_id, now),
+        incoming = split_codes(raw[1])
+        if not incoming:
+            return await message.reply("Не вижу кодов в запросе.")
+
+    input_chat_id, output_chat_id = await get_target_chats(message)
+    if not input_chat_id or not output_chat_id:
+        return await message.reply(
+            "Не настроены чаты. Укажите INPUT_CHAT_ID/OUTPUT_CHAT_ID в .env или выполните /bind в группе."
         )
-        batch_id = cur.lastrowid
 
-        added = 0
-        for code in incoming:
-            try:
-                conn.execute("INSERT INTO codes(batch_id, code) VALUES (?, ?)", (batch_id, code))
-                added += 1
-            except sqlite3.IntegrityError:
-                # дубликаты в рамках той же партии игнорируем
-                pass
-
-        conn.execute(
-            "INSERT INTO chats(chat_id, pending_pool_id) VALUES(?, ?) "
-            "ON CONFLICT(chat_id) DO UPDATE SET pending_pool_id=excluded.pending_pool_id",
-            (output_chat_id, batch_id),
-        )
+    # Разрешим загрузку только из INPUT_CHAT_ID (или из ЛС)
+    if message.chat.type in (ChatType.SUPERGROUP, ChatType.GROUP) and message.chat.id != input_chat_id:
+        return await message.reply("Коды нужно загружать в указанном чате загрузки (INPUT_CHAT_ID).")
+
+    if message.document:
+        added = await _import_document(message, output_chat_id)
+        if added is None:
+            return
+    elif gen_args is not None:
+        added = await _generate_codes(message, output_chat_id, gen_args)
+        if added is None:
+            return
+    else:
+        _, added = await storage.add_codes(output_chat_id, [incoming])
 
     # Удалим исходное сообщение с кодами, если это группа
     if message.chat.type in (ChatType.SUPERGROUP, ChatType.GROUP):
         try:
             await message.delete()
-        except Exception:
-            pass
+        except Exception as exc:
+            TELEGRAM_ERRORS.inc(op="delete_codes_message", error=type(exc).__name__)
 
     await message.answer(
         f"Добавлено кодов: <b>{added}</b>. Теперь отправь <code>/post</code> — опубликую пост с кнопкой."
@@ -231,8 +547,7 @@ async def cmd_codes(message: Message):
 
 @dp.message(Command("code"))
 async def cmd_code_alias(message: Message):
-    # Алиас на случай опечатки: /code -> /codes
-    message.text = message.text.replace("/code", "/codes", 1)
+    # Алиас на случай опечатки: /code -> /codes (cmd_codes смотрит только на аргументы)
     return await cmd_codes(message)
 
 
@@ -246,153 +561,145 @@ def make_drop_keyboard(drop_id: int) -> InlineKeyboardMarkup:
     return kb.as_markup()
 
 
+def resolve_post_targets(spec: str) -> List[ChatRef]:
+    """Цели /post to=<…>: имена наборов из POST_PRESETS и/или id чатов через запятую, без повторов."""
+    targets: List[ChatRef] = []
+    for item in filter(None, (p.strip() for p in spec.split(","))):
+        if item.lower() in POST_PRESETS:
+            targets.extend(POST_PRESETS[item.lower()])
+        else:
+            try:
+                targets.extend(parse_chat_refs(item))
+            except ValueError:
+                raise ValueError(f"Не знаю набор или чат «{escape(item)}».") from None
+    return list(dict.fromkeys(targets))
+
+
+async def publish_drop(
+    drop_id: int, targets: List[ChatRef], body: str, photo_id: Optional[str]
+) -> List[Union[Message, Exception]]:
+    """Публикует пост дропа во все чаты сразу; результат — по чату, в порядке targets.
+
+    Запросы идут через общую исходящую очередь: она держит глобальный лимит
+    и лимиты на чат, ограничивает число запросов в полёте и повторяет отправку
+    после 429. Кнопка с drop_id готова заранее, поэтому правок после отправки нет.
+    """
+    keyboard = make_drop_keyboard(drop_id)
+    futures = []
+    for chat_id in targets:
+        if photo_id:
+            method = SendPhoto(chat_id=chat_id, photo=photo_id, caption=body, reply_markup=keyboard)
+        else:
+            method = SendMessage(chat_id=chat_id, text=body, reply_markup=keyboard)
+        futures.append(outbound.submit(method, PRIORITY_USER))
+    return await asyncio.gather(*futures, return_exceptions=True)
+
+
 @dp.message(Command("post"))
 async def cmd_post(message: Message):
+    """Публикует дроп: /post <текст> — в чат выдачи, /post to=<набор|id,…> <текст> — в несколько чатов
+    с общим пулом кодов."""
     if not await is_admin(message):
         return await message.reply("Команда доступна только администраторам.")
 
     raw_text = (message.text or message.caption or "").split(maxsplit=1)
-    body = (
-        raw_text[1]
-        if len(raw_text) > 1
-        else "🎉 Промо-акция! Нажми кнопку ниже, чтобы получить личный промокод."
-    )
+    args = raw_text[1] if len(raw_text) > 1 else ""
+    target_spec = None
+    if args.startswith("to="):
+        target_spec, _, args = args.partition(" ")
+        target_spec = target_spec[3:]
+        args = args.strip()
+        # Произвольные чаты — только владельцам бота: is_admin пускает любого в ЛС
+        if not is_bot_admin(message):
+            return await message.reply("Публикация в другие чаты доступна только администраторам бота (ADMIN_IDS).")
+    body = args or "🎉 Промо-акция! Нажми кнопку ниже, чтобы получить личный промокод."
     photo_id = message.photo[-1].file_id if message.photo else None
 
-    with closing(db()) as conn:
-        input_chat_id, output_chat_id = get_target_chats(conn, message)
-        if not input_chat_id or not output_chat_id:
-            return await message.reply("Не настроены чаты. Укажите INPUT_CHAT_ID/OUTPUT_CHAT_ID в .env или выполните /bind в группе.")
-
-        # Разрешим /post только из INPUT_CHAT_ID (или из ЛС)
-        if message.chat.type in (ChatType.SUPERGROUP, ChatType.GROUP) and message.chat.id != input_chat_id:
-            return await message.reply("Пост публикуется из чата загрузки (INPUT_CHAT_ID) или из ЛС.")
-
-        row = conn.execute("SELECT pending_pool_id FROM chats WHERE chat_id=?", (output_chat_id,)).fetchone()
-        if not row or row[0] is None:
-            return await message.reply("Сначала загрузите коды: <code>/codes AAA,BBB</code>")
-        pending_batch_id = int(row[0])
-
-        if photo_id:
-            sent = await bot.send_photo(
-                output_chat_id,
-                photo=photo_id,
-                caption=body,
-                reply_markup=make_drop_keyboard(0),
-            )
-        else:
-            sent = await bot.send_message(output_chat_id, body, reply_markup=make_drop_keyboard(0))
-
-        now = datetime.now(timezone.utc).isoformat()
-        cur = conn.execute(
-            "INSERT INTO drops(chat_id, message_id, created_at) VALUES (?, ?, ?)",
-            (output_chat_id, sent.message_id, now),
-        )
-        drop_id = cur.lastrowid
-
-        await bot.edit_message_reply_markup(
-            chat_id=sent.chat.id,
-            message_id=sent.message_id,
-            reply_markup=make_drop_keyboard(drop_id),
-        )
-
-        conn.execute(
-            "INSERT OR REPLACE INTO drop_sources(drop_id, source_chat_id) VALUES(?, ?)",
-            (drop_id, message.chat.id),
-        )
-
-        code_rows = conn.execute(
-            "SELECT id FROM codes WHERE batch_id=? AND used_by IS NULL",
-            (pending_batch_id,),
-        ).fetchall()
-        if not code_rows:
-            await message.reply("В загруженной партии нет доступных кодов. Добавьте новые /codes …")
-            return
-
-        conn.executemany("INSERT OR IGNORE INTO drop_codes(drop_id, code_id) VALUES(?, ?)", [(drop_id, r[0]) for r in code_rows])
-        conn.execute("UPDATE chats SET pending_pool_id=NULL WHERE chat_id=?", (output_chat_id,))
+    input_chat_id, output_chat_id = await get_target_chats(message)
+    if not input_chat_id or not output_chat_id:
+        return await message.reply("Не настроены чаты. Укажите INPUT_CHAT_ID/OUTPUT_CHAT_ID в .env или выполните /bind в группе.")
 
-    await message.reply(f"Пост опубликован в чате {output_chat_id}. Привязано кодов: <b>{len(code_rows)}</b>.")
+    # Разрешим /post только из INPUT_CHAT_ID (или из ЛС)
+    if message.chat.type in (ChatType.SUPERGROUP, ChatType.GROUP) and message.chat.id != input_chat_id:
+        return await message.reply("Пост публикуется из чата загрузки (INPUT_CHAT_ID) или из ЛС.")
 
-
-def _get_or_assign_code(user_id: int, drop_id: int):
-    with closing(db()) as conn:
-        # Уже получал в этом дропе?
-        got = conn.execute(
-            "SELECT c.id, c.code FROM claims cl JOIN codes c ON c.id=cl.code_id WHERE cl.user_id=? AND cl.drop_id=?",
-            (user_id, drop_id),
-        ).fetchone()
-        if got:
-            return got[0], got[1], False
-            return got[0], got[1]
-
-        # Иначе пробуем выдать новый
-        conn.execute("BEGIN IMMEDIATE")
+    targets: List[ChatRef] = [output_chat_id]
+    if target_spec is not None:
         try:
-            row = conn.execute(
-                "SELECT c.id, c.code FROM drop_codes dc JOIN codes c ON c.id=dc.code_id "
-                "WHERE dc.drop_id=? AND c.used_by IS NULL AND dc.assigned_user_id IS NULL LIMIT 1",
-                (drop_id,),
-            ).fetchone()
-            if not row:
-                conn.execute("COMMIT")
-                return 0, None, False
-                return 0, None
-            code_id, code_val = int(row[0]), row[1]
-            now = datetime.now(timezone.utc).isoformat()
-            upd1 = conn.execute(
-                "UPDATE codes SET used_by=?, used_at=? WHERE id=? AND used_by IS NULL",
-                (user_id, now, code_id),
-            )
-            if upd1.rowcount != 1:
-                conn.execute("ROLLBACK")
-                return 0, None, False
-                return 0, None
-            upd2 = conn.execute(
-                "UPDATE drop_codes SET assigned_user_id=?, assigned_at=? WHERE drop_id=? AND code_id=? AND assigned_user_id IS NULL",
-                (user_id, now, drop_id, code_id),
-            )
-            if upd2.rowcount != 1:
-                conn.execute("ROLLBACK")
-                return 0, None, False
-                return 0, None
-            conn.execute(
-                "INSERT INTO claims(user_id, drop_id, code_id, claimed_at) VALUES(?, ?, ?, ?)",
-                (user_id, drop_id, code_id, now),
-            )
-            conn.execute("COMMIT")
-            return code_id, code_val, True
-        except Exception:
-            conn.execute("ROLLBACK")
-            return 0, None, False
-
-
-def resolve_report_chat(drop_id: int) -> int:
-    with closing(db()) as conn:
-        row = conn.execute(
-            "SELECT source_chat_id FROM drop_sources WHERE drop_id=?",
-            (drop_id,),
-        ).fetchone()
-        if row and row[0]:
-            return int(row[0])
-    return 0
-
-
-async def send_claim_report(drop_id: int, user: User, code_val: str):
-    report_chat_id = resolve_report_chat(drop_id)
-    if not report_chat_id or not code_val:
+            targets = resolve_post_targets(target_spec)
+        except ValueError as exc:
+            return await message.reply(str(exc))
+        if not targets:
+            presets = ", ".join(POST_PRESETS) or "не заданы (POST_PRESETS в .env)"
+            return await message.reply(f"Укажите чаты: <code>/post to=-1001,-1002 текст</code>. Наборы: {presets}.")
+
+    pending_batch_id = await storage.get_pending_batch(output_chat_id)
+    if pending_batch_id is None:
+        return await message.reply("Сначала загрузите коды: <code>/codes AAA,BBB</code>")
+
+    # Дроп и коды — до отправки: кнопка сразу с верным drop_id, а первые нажатия уже находят коды.
+    # Дроп один на все чаты, поэтому пул кодов у них общий и выдача атомарна как обычно.
+    drop_id = await storage.create_drop(output_chat_id, 0, message.chat.id)
+    attached = await storage.attach_batch(drop_id, pending_batch_id, output_chat_id)
+    if not attached:
+        await message.reply("В загруженной партии нет доступных кодов. Добавьте новые /codes …")
         return
-    full_name = user.full_name or "Пользователь"
-    mention = f'<a href="tg://user?id={user.id}">{escape(full_name)}</a>'
-    username = f" (@{user.username})" if user.username else ""
-    text = (
-        f"Код <code>{escape(str(code_val))}</code> выдан {mention}{username}. "
-        f"ID: <code>{user.id}</code>. Дроп #{drop_id}."
-    )
-    try:
-        await bot.send_message(report_chat_id, text)
-    except Exception:
-        pass
+
+    results = await publish_drop(drop_id, targets, body, photo_id)
+    posts = [(sent.chat.id, sent.message_id) for sent in results if isinstance(sent, Message)]
+    # Основной пост дропа — в чате выдачи, если он среди целей
+    posts.sort(key=lambda post: post[0] != output_chat_id)
+    if posts:
+        await storage.record_posts(drop_id, posts)
+
+    failed = [(chat_id, exc) for chat_id, exc in zip(targets, results) if isinstance(exc, Exception)]
+    if len(targets) == 1 and not failed:
+        return await message.reply(f"Пост опубликован в чате {posts[0][0]}. Привязано кодов: <b>{attached}</b>.")
+    lines = [
+        f"Дроп #{drop_id}: опубликовано в <b>{len(posts)}</b> из {len(targets)} чатов. "
+        f"Привязано кодов: <b>{attached}</b>."
+    ]
+    lines.extend(f"• {escape(str(chat_id))}: {escape(str(exc))[:200]}" for chat_id, exc in failed[:30])
+    if len(failed) > 30:
+        lines.append(f"…и ещё {len(failed) - 30}")
+    if not posts:
+        # Кнопки нигде нет — дроп отменяется, партия снова ждёт /post, загружать коды заново не нужно
+        await storage.discard_drop(drop_id, pending_batch_id, output_chat_id)
+        lines[0] = f"Пост не вышел ни в одном из {len(targets)} чатов, дроп #{drop_id} отменён."
+        lines.append("Партия снова ждёт публикации — повторите /post.")
+    await message.reply("\n".join(lines))
+
+
+async def claim_code(user_id: int, drop_id: int, source: str) -> ClaimResult:
+    """storage.claim с метриками: время выдачи и исход по источнику (button/deeplink)."""
+    started = time.perf_counter()
+    result = await storage.claim(user_id, drop_id)
+    CLAIM_SECONDS.observe(time.perf_counter() - started, source=source)
+    if result.limited:
+        outcome = "limited"
+    elif result.assigned_now:
+        outcome = "assigned"
+    elif result.code:
+        outcome = "repeat"
+    else:
+        outcome = "no_codes"
+    CLAIMS.inc(source=source, result=outcome)
+    return result
+
+
+def send_code_pm(user_id: int, code_val: str) -> None:
+    def on_error(exc: Exception):
+        if isinstance(exc, (TelegramForbiddenError, TelegramBadRequest)):
+            pm_unreachable.add(user_id)
+            pm_delivered.discard(user_id)
+
+    def on_done(fut: asyncio.Future):
+        if not fut.cancelled() and fut.exception() is None:
+            pm_delivered.add(user_id)
+
+    text = f"Ваш промокод: <code>{escape(str(code_val))}</code>"
+    fut = outbound.submit(SendMessage(chat_id=user_id, text=text), PRIORITY_USER, on_error=on_error)
+    fut.add_done_callback(on_done)
 
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
@@ -400,27 +707,30 @@ async def cmd_start(message: Message):
     parts = text.split(maxsplit=1)
     # обычный /start без параметров
     if len(parts) == 1 or not parts[1]:
+        pm_unreachable.discard(message.from_user.id)
         return await message.answer(
             "Привет! Я бот для раздачи промокодов.\n\n"
             "Админ: загрузите коды <code>/codes AAA,BBB,CCC</code> и отправьте <code>/post</code>.\n"
             "Можно работать через .env (INPUT/OUTPUT_CHAT_ID) или привязать чат командой <code>/bind</code>."
         )
 
+    # Пользователь открыл чат с ботом — ЛС снова доступны
+    pm_unreachable.discard(message.from_user.id)
+
     param = parts[1].strip()
     if param.startswith("claim_"):
         try:
             drop_id = int(param.split("_", 1)[1])
         except ValueError:
             return await message.answer("Некорректная ссылка.")
-        user_id = message.from_user.id
-        loop = asyncio.get_running_loop()
-        code_id, code_val, assigned_now = await loop.run_in_executor(
-            None, _get_or_assign_code, user_id, drop_id
-        )
+        result = await claim_code(message.from_user.id, drop_id, "deeplink")
+        if result.limited:
+            return await message.answer("У вас уже есть промокод (ограничение 1 на пользователя).")
+        code_val = result.code
         if not code_val:
             return await message.answer("Промокоды закончились или недоступны.")
-        if assigned_now:
-            await send_claim_report(drop_id, message.from_user, code_val)
+        if result.assigned_now:
+            await reporter.record(drop_id, message.from_user, code_val)
         safe_code = escape(str(code_val))
         return await message.answer(f"Ваш промокод: <code>{safe_code}</code>")
 
@@ -429,103 +739,261 @@ async def on_get_code(cb: CallbackQuery):
     drop_id = int(cb.data.split(":", 1)[1])
     user_id = cb.from_user.id
 
-    # Проверку глобального ограничения делаем в основном потоке своим соединением
-    with closing(db()) as conn:
-        if GLOBAL_ONE_PER_USER:
-            got_global = conn.execute("SELECT 1 FROM claims WHERE user_id=? LIMIT 1", (user_id,)).fetchone()
-            if got_global:
-                return await cb.answer("У вас уже есть промокод (ограничение 1 на пользователя).", show_alert=True)
-
-    # Выдачу кода выполняем в threadpool, но уже с отдельным соединением внутри функции
-    loop = asyncio.get_running_loop()
-    code_id, code_val, assigned_now = await loop.run_in_executor(
-        None, _get_or_assign_code, user_id, drop_id
-    )
-    if code_id == 0 and code_val is None:
-        return await cb.answer("Промокоды закончились. Попробуйте позже.", show_alert=True)
+    # Выдача идёт через поток-писатель хранилища, event loop не блокируется.
+    # Лимит GLOBAL_ONE_PER_USER проверяется там же, атомарно с выдачей.
+    # Ответ на нажатие возвращаем методом, а не вызываем: в режиме webhook он уходит
+    # прямо в ответе на запрос Telegram, при polling его отправит диспетчер.
+    result = await claim_code(user_id, drop_id, "button")
+    if result.limited:
+        return cb.answer("У вас уже есть промокод (ограничение 1 на пользователя).", show_alert=True)
+    code_val, assigned_now = result.code, result.assigned_now
+    if not code_val:
+        return cb.answer("Промокоды закончились. Попробуйте позже.", show_alert=True)
 
     extra_alert_note = ""
 
+    # ЛС и отчёт ставим в очередь: ответ на нажатие не ждёт отправки
     if SEND_PM_ON_REPEAT and code_val:
-        try:
-            await bot.send_message(user_id, f"Ваш промокод: <code>{escape(str(code_val))}</code>")
-        except Exception:
+        if user_id in pm_unreachable:
             extra_alert_note = (
                 "\n\nНажмите кнопку «📩 В личку» под постом — откроется чат с ботом и код придёт там."
             )
+        else:
+            send_code_pm(user_id, code_val)
+            if user_id not in pm_delivered:
+                # Ответ на нажатие не ждёт отправки, поэтому о первой неудаче ЛС предупреждаем заранее
+                extra_alert_note = (
+                    "\n\nЕсли код не придёт в личку, нажмите кнопку «📩 В личку» под постом — "
+                    "откроется чат с ботом."
+                )
 
     if assigned_now and code_val:
-        await send_claim_report(drop_id, cb.from_user, code_val)
+        await reporter.record(drop_id, cb.from_user, code_val)
 
-    await cb.answer(f"Ваш промокод: {code_val}{extra_alert_note}", show_alert=True)
+    return cb.answer(f"Ваш промокод: {code_val}{extra_alert_note}", show_alert=True)
 
 
 @dp.message(Command("left"))
 async def cmd_left(message: Message):
     if not await is_admin(message):
         return await message.reply("Команда доступна только администраторам.")
-    with closing(db()) as conn:
-        input_chat_id, output_chat_id = get_target_chats(conn, message)
-        if not output_chat_id:
-            return await message.reply("Сначала настройте чаты или сделайте /bind.")
-        row = conn.execute("SELECT id FROM drops WHERE chat_id=? ORDER BY id DESC LIMIT 1", (output_chat_id,)).fetchone()
-        if not row:
-            return await message.reply("Нет дропов в этом чате.")
-        drop_id = row[0]
-        total = conn.execute("SELECT COUNT(*) FROM drop_codes WHERE drop_id=?", (drop_id,)).fetchone()[0]
-        left = conn.execute(
-            "SELECT COUNT(*) FROM drop_codes dc JOIN codes c ON c.id=dc.code_id WHERE dc.drop_id=? AND c.used_by IS NULL",
-            (drop_id,),
-        ).fetchone()[0]
-    await message.reply(f"В последнем дропе осталось: <b>{left}/{total}</b> кодов.")
+    input_chat_id, output_chat_id = await get_target_chats(message)
+    if not output_chat_id:
+        return await message.reply("Сначала настройте чаты или сделайте /bind.")
+    drop_id = await storage.latest_drop(output_chat_id)
+    if not drop_id:
+        return await message.reply("Нет дропов в этом чате.")
+    left, total, last_claim_at = await storage.drop_counts(drop_id)
+    text = f"В последнем дропе осталось: <b>{left}/{total}</b> кодов."
+    if last_claim_at:
+        text += f"\nПоследняя выдача: {last_claim_at}"
+    await message.reply(text)
+
+
+@dp.message(Command("recount"))
+async def cmd_recount(message: Message):
+    """Сверка и пересчёт счётчиков drop_stats: /recount — все дропы, /recount <drop_id> — один."""
+    if not is_bot_admin(message):
+        return await message.reply("Команда доступна только администраторам бота (ADMIN_IDS).")
+    args = (message.text or "").split()[1:]
+    if args and not args[0].isdigit():
+        return await message.reply("Формат: <code>/recount</code> или <code>/recount &lt;drop_id&gt;</code>.")
+    drop_id = int(args[0]) if args else None
+    checked, fixed = await storage.check_drop_stats(drop_id)
+    parts = [f"Проверено дропов: <b>{checked}</b>, исправлено: <b>{len(fixed)}</b>."]
+    for d_id, was, now in fixed[:20]:
+        was_text = f"{was[1]}/{was[0]}" if was else "нет записи"
+        parts.append(f"• #{d_id}: {was_text} → {now[1]}/{now[0]}")
+    if len(fixed) > 20:
+        parts.append(f"…и ещё {len(fixed) - 20}")
+    await message.reply("\n".join(parts))
+
+
+@dp.message(Command("maintenance"))
+async def cmd_maintenance(message: Message):
+    """Обслуживание БД сейчас: архив, чекпоинт WAL, возврат свободных страниц.
+
+    /maintenance vacuum — ещё и разовый VACUUM для перевода старой базы в auto_vacuum=INCREMENTAL.
+    """
+    if not is_bot_admin(message):
+        return await message.reply("Команда доступна только администраторам бота (ADMIN_IDS).")
+    args = (message.text or "").split()[1:]
+    full_vacuum = bool(args) and args[0] == "vacuum"
+    if full_vacuum:
+        await message.reply("Если база ещё без auto_vacuum, будет VACUUM — выдачи на это время встанут.")
+    report = await storage.maintenance(force=True, full_vacuum=full_vacuum)
+    if report.skipped:
+        return await message.reply(f"Обслуживание не выполнено: {report.skipped}.")
+    parts = [
+        f"Обслуживание за {report.seconds:.2f} с.",
+        f"В архив: дропов <b>{report.archived_drops}</b>, строк <b>{report.archived_rows}</b>.",
+    ]
+    if report.checkpoint:
+        busy, log_pages, done = report.checkpoint
+        wal = "обрезан" if report.wal_truncated else ("занят читателями" if busy else "не обрезан")
+        parts.append(f"WAL: перенесено страниц {done}/{log_pages}, файл {wal}.")
+    parts.append(
+        f"auto_vacuum: {report.auto_vacuum}, возвращено страниц: {report.vacuumed_pages}, "
+        f"свободно: {report.freelist_pages}."
+    )
+    if report.auto_vacuum == "none":
+        parts.append("Свободные страницы не возвращаются — выполните <code>/maintenance vacuum</code>.")
+    await message.reply("\n".join(parts))
 
 
 @dp.message(Command("report"))
 async def cmd_report(message: Message):
-    """Отчёт по последнему дропу привязанного/настроенного чата (видно только админам)."""
-    if not await is_admin(message):
+    """Отчёт по дропу CSV-файлом: /report — последний дроп, /report <drop_id> [gz] — конкретный."""
+    if message.chat.type not in (ChatType.SUPERGROUP, ChatType.GROUP):
+        # В отчёте все свободные коды дропа, а is_admin в ЛС пускает любого
+        if not is_bot_admin(message):
+            return await message.reply("Отчёт в ЛС доступен только администраторам бота (ADMIN_IDS).")
+    elif not await is_admin(message):
         return await message.reply("Команда доступна только администраторам.")
-    with closing(db()) as conn:
-        input_chat_id, output_chat_id = get_target_chats(conn, message)
-        if not output_chat_id:
-            return await message.reply("Сначала настройте чаты или сделайте /bind.")
-        row = conn.execute("SELECT id FROM drops WHERE chat_id=? ORDER BY id DESC LIMIT 1", (output_chat_id,)).fetchone()
-        if not row:
+    input_chat_id, output_chat_id = await get_target_chats(message)
+    if not output_chat_id:
+        return await message.reply("Сначала настройте чаты или сделайте /bind.")
+
+    args = (message.text or "").split()[1:]
+    compress = REPORT_GZIP or "gz" in args
+    drop_arg = next((a for a in args if a.isdigit()), None)
+    if drop_arg:
+        drop_id = int(drop_arg)
+        if await storage.drop_chat(drop_id) != output_chat_id:
+            return await message.reply("Дроп не найден в этом чате.")
+    else:
+        drop_id = await storage.latest_drop(output_chat_id)
+        if not drop_id:
             return await message.reply("Нет дропов в этом чате.")
-        drop_id = row[0]
-        used = conn.execute(
-            "SELECT c.code, cl.user_id, cl.claimed_at FROM claims cl JOIN codes c ON c.id=cl.code_id WHERE cl.drop_id=? ORDER BY cl.claimed_at",
-            (drop_id,),
-        ).fetchall()
-        free = conn.execute(
-            "SELECT c.code FROM drop_codes dc JOIN codes c ON c.id=dc.code_id WHERE dc.drop_id=? AND c.used_by IS NULL",
-            (drop_id,),
-        ).fetchall()
-
-    parts = ["<b>Отчёт по последнему дропу</b>", f"Выдано: {len(used)} | Свободно: {len(free)}"]
-    if used:
-        parts.append("<b>Выданные:</b>")
-        parts.extend([f"• <code>{c}</code> — user <code>{u}</code> — {t}" for c, u, t in used[:200]])
-        if len(used) > 200:
-            parts.append(f"…и ещё {len(used)-200}")
-    if free:
-        parts.append("<b>Свободные:</b>")
-        parts.extend([f"• <code>{r[0]}</code>" for r in free[:200]])
-        if len(free) > 200:
-            parts.append(f"…и ещё {len(free)-200}")
-
-    await message.answer("".join(parts))
+
+    suffix = ".csv.gz" if compress else ".csv"
+    fd, path = tempfile.mkstemp(prefix=f"report_{drop_id}_", suffix=suffix)
+    os.close(fd)
+    try:
+        used, free = await storage.export_report(drop_id, path, compress)
+        caption = f"<b>Отчёт по дропу #{drop_id}</b>\nВыдано: {used} | Свободно: {free}"
+        if os.path.getsize(path) > MAX_UPLOAD_FILE_SIZE:
+            return await message.answer(f"{caption}\n\nФайл больше 50 МБ — запросите <code>/report {drop_id} gz</code>.")
+        await message.answer_document(FSInputFile(path, filename=f"drop_{drop_id}{suffix}"), caption=caption)
+    finally:
+        os.remove(path)
+
+
+@dp.message(Command("stats"))
+async def cmd_stats(message: Message):
+    """Метрики процесса: /stats — сводка, /stats profile — горячие стеки (нужен PROFILE_INTERVAL_MS)."""
+    if not is_bot_admin(message):
+        return await message.reply("Команда доступна только администраторам бота (ADMIN_IDS).")
+    args = (message.text or "").split()[1:]
+    if args and args[0] == "profile":
+        if profiler is None:
+            return await message.reply("Профайлер выключен — задайте PROFILE_INTERVAL_MS в .env.")
+        top = profiler.top(10)
+        lines = [f"<b>Сэмплов: {profiler.samples}</b>"]
+        lines.extend(f"{count} — <code>{escape(';'.join(stack.split(';')[-3:]))}</code>" for stack, count in top)
+        fd, path = tempfile.mkstemp(prefix="profile_", suffix=".collapsed")
+        os.close(fd)
+        try:
+            profiler.dump(path)
+            await message.answer_document(FSInputFile(path, filename="profile.collapsed"))
+        finally:
+            os.remove(path)
+        return await message.answer("\n".join(lines)[:4000])
+
+    lines = REGISTRY.summary()
+    lines.append("storage: " + ", ".join(f"{k}={v}" for k, v in storage.stats().items()))
+    lines.append("outbound: " + ", ".join(f"{k}={v}" for k, v in outbound.stats.items()))
+    text = "\n".join(lines)
+    if len(text) > 3500:
+        document = BufferedInputFile(text.encode("utf-8"), filename="stats.txt")
+        return await message.answer_document(document, caption="Метрики процесса")
+    await message.answer(f"<pre>{escape(text)}</pre>")
+
+
+def dump_profile() -> None:
+    rows = profiler.dump(PROFILE_DUMP_PATH)
+    logging.info("Profile: %s stacks from %s samples written to %s", rows, profiler.samples, PROFILE_DUMP_PATH)
+
+
+@dp.startup()
+async def on_startup():
+    global metrics_runner
+    await storage.open()
+    outbound.start()
+    reporter.start()
+    if METRICS_PORT:
+        metrics_runner = await serve_metrics(METRICS_HOST, METRICS_PORT)
+    if profiler is not None:
+        profiler.start()
+        # kill -USR1 <pid> — выгрузить накопленные стеки, не останавливая бота
+        with suppress(NotImplementedError, AttributeError):
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, dump_profile)
+
+
+@dp.shutdown()
+async def on_shutdown():
+    # Новые апдейты уже не принимаются — даём дообработаться начатым выдачам
+    deadline = time.monotonic() + SHUTDOWN_DRAIN_TIMEOUT
+    while update_tracker.active and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if update_tracker.active:
+        logging.warning("Shutdown: %s updates still in progress", update_tracker.active)
+    # Сначала сбрасываем сводки и досылаем очередь, потом закрываем БД
+    await reporter.close()
+    await outbound.close(SHUTDOWN_DRAIN_TIMEOUT)
+    await storage.close()
+    if profiler is not None:
+        profiler.stop()
+        dump_profile()
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    logging.info("Claim stats: %s, outbound: %s", storage.stats(), outbound.stats)
+
+
+async def run_webhook():
+    app = web.Application()
+    # setup_application раньше обработчика: shutdown диспетчера (досылка очереди, закрытие БД)
+    # должен отработать до того, как обработчик закроет сессию бота
+    setup_application(app, dp, bot=bot)
+    SimpleRequestHandler(
+        dp, bot, handle_in_background=False, secret_token=WEBHOOK_SECRET or None
+    ).register(app, path=WEBHOOK_PATH)
+
+    runner = web.AppRunner(app, shutdown_timeout=SHUTDOWN_DRAIN_TIMEOUT)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+        )
+    print(f"Bot is running (webhook on {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH})…")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        with suppress(NotImplementedError):
+            loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Сервер перестаёт принимать запросы, затем on_shutdown дожидается начатых апдейтов
+        await runner.cleanup()
 
 
 async def main():
     global BOT_USERNAME
-    init_db()
-    migrate_unique_per_batch()
-    me = await bot.get_me()
-    BOT_USERNAME = me.username
+    if not BOT_USERNAME:
+        me = await bot.get_me()
+        BOT_USERNAME = me.username
+    if RUN_MODE == "webhook":
+        await run_webhook()
+        return
     print("Bot is running…")
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     asyncio.run(main())
@@ -0,0 +1,519 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from collections import deque
+from contextlib import suppress
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import migrations
+from metrics import REGISTRY
+from storage import LIMITED, NO_CODES, ClaimResult, MaintenanceReport, write_report
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_SECONDS = REGISTRY.histogram("storage_snapshot_seconds", "Время записи снимка MemoryStorage")
+SNAPSHOT_FAILURES = REGISTRY.counter("storage_snapshot_failures_total", "Неудачные снимки MemoryStorage")
+# Сколько строк снимка собирать между передачами управления event loop
+SNAPSHOT_CHUNK = 10000
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class _Code:
+    __slots__ = ("batch_id", "code", "used_by", "used_at")
+
+    def __init__(self, batch_id: int, code: str, used_by: Optional[int] = None, used_at: Optional[str] = None):
+        self.batch_id = batch_id
+        self.code = code
+        self.used_by = used_by
+        self.used_at = used_at
+
+
+class _Drop:
+    __slots__ = (
+        "chat_id", "message_id", "created_at", "source_chat_id", "codes", "pool", "claims", "last_claim_at", "posts",
+    )
+
+    def __init__(self, chat_id: int, message_id: int, created_at: str, source_chat_id: int):
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.created_at = created_at
+        self.source_chat_id = source_chat_id
+        # code_id -> (user_id, assigned_at) или None, пока код свободен
+        self.codes: Dict[int, Optional[Tuple[int, str]]] = {}
+        self.pool: deque = deque()
+        # (claim_id, user_id, code_id, claimed_at) в порядке выдачи
+        self.claims: List[Tuple[int, int, int, str]] = []
+        self.last_claim_at: Optional[str] = None
+        # chat_id -> (message_id, posted_at)
+        self.posts: Dict[int, Tuple[int, str]] = {}
+
+
+class MemoryStorage:
+    """Хранилище целиком в памяти процесса — для профилирования движка выдачи
+    и для быстрого режима без записи на каждую выдачу.
+
+    Все изменения делаются синхронно в event loop без await посередине, поэтому
+    выдача атомарна так же, как транзакция в SqliteStorage. Раз в
+    `snapshot_interval` секунд (и при остановке) состояние целиком пишется
+    в SQLite-файл той же схемы: из него MemoryStorage восстанавливается при старте,
+    и его же может открыть SqliteStorage. Всё, что случилось после последнего
+    снимка, при падении процесса теряется. Файл снимка должен принадлежать
+    одному процессу и не должен быть боевой базой SqliteStorage: снимок
+    переписывает файл целиком и не знает об архиве дропов (ARCHIVE_DB_PATH).
+    """
+
+    def __init__(
+        self,
+        snapshot_path: Optional[str] = None,
+        snapshot_interval: float = 60,
+        global_one_per_user: bool = False,
+    ):
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.global_one_per_user = global_one_per_user
+        self._bindings: Dict[int, int] = {}
+        self._pending: Dict[int, int] = {}
+        self._batches: Dict[int, Tuple[int, str]] = {}
+        # batch_id -> {code: code_id}: уникальность кода внутри партии и порядок вставки
+        self._batch_codes: Dict[int, Dict[str, int]] = {}
+        self._codes: Dict[int, _Code] = {}
+        self._drops: Dict[int, _Drop] = {}
+        self._latest: Dict[int, int] = {}
+        self._claims: Dict[Tuple[int, int], int] = {}
+        self._claimed_users: set = set()
+        # Строки claims_duplicates из исходной базы: в памяти не нужны, но снимок их сохраняет
+        self._claims_duplicates: List[tuple] = []
+        self._last_ids = {"batch": 0, "code": 0, "drop": 0, "claim": 0}
+        # Номер изменения: снимок пишется, только если с прошлого что-то поменялось
+        self._version = 0
+        self._saved_version = 0
+        self._snapshotter: Optional[asyncio.Task] = None
+        self._snapshot_lock = asyncio.Lock()
+        # Пока собирается снимок: что поменялось в больших таблицах (codes, drop_codes, claims)
+        self._touched: Optional[Dict[str, object]] = None
+        self._started_at = time.monotonic()
+        self._stats = {"claims": 0, "assigned": 0, "repeat_hits": 0, "snapshots": 0, "snapshot_seconds": 0.0}
+
+    def _next_id(self, kind: str) -> int:
+        self._last_ids[kind] += 1
+        return self._last_ids[kind]
+
+    # --- жизненный цикл -------------------------------------------------
+
+    async def open(self) -> None:
+        self._started_at = time.monotonic()
+        if self.snapshot_path and Path(self.snapshot_path).exists():
+            # До open обработчики не работают — состояние можно собирать в потоке
+            await asyncio.get_running_loop().run_in_executor(None, self._load_snapshot, self.snapshot_path)
+        if self.snapshot_path and self.snapshot_interval > 0:
+            self._snapshotter = asyncio.create_task(self._snapshot_loop(), name="memory-snapshot")
+
+    async def close(self) -> None:
+        if self._snapshotter is not None:
+            self._snapshotter.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._snapshotter
+            self._snapshotter = None
+        if self.snapshot_path:
+            await self.snapshot()
+
+    async def _snapshot_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            try:
+                await self.snapshot()
+            except Exception:
+                SNAPSHOT_FAILURES.inc()
+                log.exception("Memory storage snapshot failed")
+
+    # --- привязки и партии ----------------------------------------------
+
+    async def get_binding(self, user_id: int) -> int:
+        return self._bindings.get(user_id, 0)
+
+    async def bind_chat(self, user_id: int, chat_id: int) -> None:
+        self._bindings[user_id] = chat_id
+        self._version += 1
+
+    async def add_codes(
+        self,
+        output_chat_id: int,
+        chunks: Iterable[List[str]],
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Tuple[int, int]:
+        """Создаёт партию и делает её ожидающей для чата. Возвращает (batch_id, added).
+
+        Куски (например, чтение файла) берутся в потоке, а партия появляется
+        в хранилище целиком только после последнего куска.
+        """
+        loop = asyncio.get_running_loop()
+        chunks = iter(chunks)
+        incoming: Dict[str, None] = {}
+        seen = 0
+        while True:
+            chunk = await loop.run_in_executor(None, next, chunks, None)
+            if chunk is None:
+                break
+            seen += len(chunk)
+            incoming.update(dict.fromkeys(chunk))
+            if progress is not None:
+                progress(seen, len(incoming))
+        batch_id = self._next_id("batch")
+        self._batches[batch_id] = (output_chat_id, _now())
+        index = self._batch_codes[batch_id] = {}
+        for code in incoming:
+            code_id = index[code] = self._next_id("code")
+            self._codes[code_id] = _Code(batch_id, code)
+        if self._touched is not None:
+            self._touched["codes"].update(index.values())
+        self._pending[output_chat_id] = batch_id
+        self._version += 1
+        return batch_id, len(index)
+
+    async def get_pending_batch(self, output_chat_id: int) -> Optional[int]:
+        return self._pending.get(output_chat_id)
+
+    # --- дропы ----------------------------------------------------------
+
+    async def create_drop(self, chat_id: int, message_id: int, source_chat_id: int) -> int:
+        drop_id = self._next_id("drop")
+        self._drops[drop_id] = _Drop(chat_id, message_id, _now(), source_chat_id)
+        self._latest[chat_id] = drop_id
+        self._version += 1
+        return drop_id
+
+    async def attach_batch(self, drop_id: int, batch_id: int, output_chat_id: int) -> int:
+        """Привязывает свободные коды партии к дропу. Возвращает число кодов."""
+        drop = self._drops[drop_id]
+        code_ids = [cid for cid in self._batch_codes.get(batch_id, {}).values() if self._codes[cid].used_by is None]
+        for cid in code_ids:
+            if cid not in drop.codes:
+                drop.codes[cid] = None
+                drop.pool.append(cid)
+                if self._touched is not None:
+                    self._touched["drop_codes"].add((drop_id, cid))
+        if code_ids:
+            self._pending.pop(output_chat_id, None)
+        self._version += 1
+        return len(code_ids)
+
+    async def discard_drop(self, drop_id: int, batch_id: int, output_chat_id: int) -> None:
+        """Отвязывает свободные коды неопубликованного дропа, удаляет его, если выдач не было, и возвращает партию."""
+        drop = self._drops[drop_id]
+        for cid in [cid for cid, assigned in drop.codes.items() if assigned is None]:
+            del drop.codes[cid]
+            if self._touched is not None:
+                self._touched["drop_codes"].discard((drop_id, cid))
+                self._touched["removed_drop_codes"].add((drop_id, cid))
+        drop.pool.clear()
+        if not drop.claims:
+            del self._drops[drop_id]
+            if self._latest.get(drop.chat_id) == drop_id:
+                previous = [did for did, d in self._drops.items() if d.chat_id == drop.chat_id]
+                if previous:
+                    self._latest[drop.chat_id] = max(previous)
+                else:
+                    del self._latest[drop.chat_id]
+        self._pending[output_chat_id] = batch_id
+        self._version += 1
+
+    async def record_posts(self, drop_id: int, posts: List[Tuple[int, int]]) -> None:
+        drop = self._drops[drop_id]
+        now = _now()
+        for chat_id, message_id in posts:
+            drop.posts[chat_id] = (message_id, now)
+        if posts and not drop.message_id:
+            drop.message_id = posts[0][1]
+        self._version += 1
+
+    async def latest_drop(self, chat_id: int) -> Optional[int]:
+        return self._latest.get(chat_id)
+
+    async def drop_chat(self, drop_id: int) -> int:
+        drop = self._drops.get(drop_id)
+        return drop.chat_id if drop else 0
+
+    async def report_chat(self, drop_id: int) -> int:
+        drop = self._drops.get(drop_id)
+        return drop.source_chat_id if drop else 0
+
+    # --- выдача ---------------------------------------------------------
+
+    async def claim(self, user_id: int, drop_id: int) -> ClaimResult:
+        """Выдаёт код пользователю; NO_CODES — кодов нет, LIMITED — сработал лимит 1 на пользователя."""
+        self._stats["claims"] += 1
+        key = (user_id, drop_id)
+        code_id = self._claims.get(key)
+        if code_id is not None:
+            self._stats["repeat_hits"] += 1
+            return ClaimResult(code_id, self._codes[code_id].code, False)
+        if self.global_one_per_user and user_id in self._claimed_users:
+            return LIMITED
+        drop = self._drops.get(drop_id)
+        if drop is None:
+            return NO_CODES
+        while drop.pool:
+            code_id = drop.pool.popleft()
+            code = self._codes[code_id]
+            # код мог уйти через другой дроп той же партии
+            if code.used_by is not None or drop.codes[code_id] is not None:
+                continue
+            now = _now()
+            claim_id = self._next_id("claim")
+            code.used_by, code.used_at = user_id, now
+            drop.codes[code_id] = (user_id, now)
+            drop.claims.append((claim_id, user_id, code_id, now))
+            if self._touched is not None:
+                self._touched["codes"].add(code_id)
+                self._touched["drop_codes"].add((drop_id, code_id))
+                self._touched["claims"].append((claim_id, user_id, drop_id, code_id, now))
+            drop.last_claim_at = now
+            self._claims[key] = code_id
+            self._claimed_users.add(user_id)
+            self._stats["assigned"] += 1
+            self._version += 1
+            return ClaimResult(code_id, code.code, True)
+        return NO_CODES
+
+    def stats(self) -> dict:
+        st = dict(self._stats)
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        st["claims_per_sec"] = round(st["claims"] / elapsed, 2)
+        st["codes"] = len(self._codes)
+        st["drops"] = len(self._drops)
+        st["claimed_users"] = len(self._claimed_users)
+        st["unsaved_changes"] = self._version - self._saved_version
+        return st
+
+    # --- статистика и отчёты --------------------------------------------
+
+    async def drop_counts(self, drop_id: int) -> Tuple[int, int, Optional[str]]:
+        drop = self._drops.get(drop_id)
+        if drop is None:
+            return 0, 0, None
+        total = len(drop.codes)
+        return total - len(drop.claims), total, drop.last_claim_at
+
+    async def check_drop_stats(self, drop_id: Optional[int] = None) -> Tuple[int, List[tuple]]:
+        # Счётчики считаются по самим данным, расходиться нечему
+        if drop_id:
+            return int(drop_id in self._drops), []
+        return len(self._drops), []
+
+    async def export_report(self, drop_id: int, path: str, compress: bool = False) -> Tuple[int, int]:
+        drop = self._drops.get(drop_id)
+        if drop is None:
+            used, free = [], []
+        else:
+            codes = self._codes
+            used = [(codes[cid].code, user_id, at) for _id, user_id, cid, at in drop.claims]
+            free = [
+                (codes[cid].code,) for cid, assigned in drop.codes.items()
+                if assigned is None and codes[cid].used_by is None
+            ]
+        return await asyncio.get_running_loop().run_in_executor(None, write_report, path, compress, used, free)
+
+    async def maintenance(self, force: bool = False, full_vacuum: bool = False) -> MaintenanceReport:
+        # Снимок каждый раз пишется в новый файл целиком: WAL и свободных страниц у него нет
+        return MaintenanceReport(skipped="в режиме memory обслуживать нечего")
+
+    # --- снимки ---------------------------------------------------------
+
+    async def snapshot(self) -> bool:
+        """Пишет состояние в snapshot_path, если оно менялось. Возвращает, был ли записан снимок.
+
+        Строки собираются в event loop кусками (см. _dump), запись в SQLite идёт в потоке.
+        """
+        async with self._snapshot_lock:
+            if self._version == self._saved_version:
+                return False
+            started = time.perf_counter()
+            rows = await self._dump()
+            # Срез — на момент окончания сборки: между ней и этой строкой await нет
+            version = self._version
+            await asyncio.get_running_loop().run_in_executor(None, _write_snapshot, self.snapshot_path, rows)
+            self._saved_version = version
+            self._stats["snapshots"] += 1
+            elapsed = time.perf_counter() - started
+            SNAPSHOT_SECONDS.observe(elapsed)
+            self._stats["snapshot_seconds"] = round(elapsed, 3)
+            return True
+
+    async def _dump(self) -> Dict[str, list]:
+        """Строки снимка для всех таблиц.
+
+        Большие таблицы собираются кусками по SNAPSHOT_CHUNK строк, и между кусками
+        выдачи продолжаются. Всё, что они успели поменять, копится в `_touched`
+        и в конце пересобирается одним синхронным проходом вместе с маленькими
+        таблицами; при записи поздние строки заменяют ранние (INSERT OR REPLACE),
+        так что снимок согласован на момент окончания сборки.
+        """
+        rows: Dict[str, list] = {"codes": [], "drop_codes": [], "claims": []}
+        touched = self._touched = {"codes": set(), "drop_codes": set(), "claims": [], "removed_drop_codes": set()}
+        try:
+            for _ in self._dump_large(rows):
+                await asyncio.sleep(0)
+        finally:
+            self._touched = None
+        removed = touched["removed_drop_codes"]
+        if removed:
+            # Отвязанные во время сборки коды (discard_drop) в снимок не попадают
+            rows["drop_codes"] = [r for r in rows["drop_codes"] if (r[0], r[1]) not in removed]
+        rows["codes"].extend(self._code_row(cid) for cid in touched["codes"])
+        rows["drop_codes"].extend(self._drop_code_row(did, cid) for did, cid in touched["drop_codes"])
+        rows["claims"].extend(touched["claims"])
+        drops = self._drops.items()
+        return {
+            **rows,
+            "admin_bindings": list(self._bindings.items()),
+            "chats": list(self._pending.items()),
+            "code_batches": [(bid, chat_id, at) for bid, (chat_id, at) in self._batches.items()],
+            "drops": [(did, d.chat_id, d.message_id, d.created_at) for did, d in drops],
+            "drop_sources": [(did, d.source_chat_id) for did, d in drops],
+            "drop_stats": [(did, len(d.codes), len(d.claims), d.last_claim_at) for did, d in drops],
+            "drop_posts": [
+                (did, chat_id, message_id, at) for did, d in drops for chat_id, (message_id, at) in d.posts.items()
+            ],
+            "claims_duplicates": list(self._claims_duplicates),
+        }
+
+    def _dump_large(self, rows: Dict[str, list]) -> Iterator[None]:
+        """Дописывает строки codes, drop_codes и claims в `rows`; yield — пауза между кусками.
+
+        Ключи копируются заранее: словари между кусками могут расти.
+        """
+        code_ids = list(self._codes)
+        for i in range(0, len(code_ids), SNAPSHOT_CHUNK):
+            rows["codes"].extend(self._code_row(cid) for cid in code_ids[i:i + SNAPSHOT_CHUNK])
+            yield
+        pending = 0
+        for did, drop in list(self._drops.items()):
+            keys = list(drop.codes)
+            # Выдачи только дописываются: всё, что появится после этой длины, попадёт в _touched
+            n_claims = len(drop.claims)
+            for i in range(0, len(keys), SNAPSHOT_CHUNK):
+                part = keys[i:i + SNAPSHOT_CHUNK]
+                # Через drop, а не self._drops: дроп мог быть удалён между кусками
+                rows["drop_codes"].extend((did, cid, *(drop.codes.get(cid) or (None, None))) for cid in part)
+                pending += len(part)
+                if pending >= SNAPSHOT_CHUNK:
+                    pending = 0
+                    yield
+            for i in range(0, n_claims, SNAPSHOT_CHUNK):
+                part = drop.claims[i:min(i + SNAPSHOT_CHUNK, n_claims)]
+                rows["claims"].extend((claim_id, user_id, did, cid, at) for claim_id, user_id, cid, at in part)
+                pending += len(part)
+                if pending >= SNAPSHOT_CHUNK:
+                    pending = 0
+                    yield
+
+    def _code_row(self, code_id: int) -> tuple:
+        c = self._codes[code_id]
+        return code_id, c.batch_id, c.code, c.used_by, c.used_at
+
+    def _drop_code_row(self, drop_id: int, code_id: int) -> tuple:
+        return (drop_id, code_id, *(self._drops[drop_id].codes[code_id] or (None, None)))
+
+    def _load_snapshot(self, path: str) -> None:
+        conn = sqlite3.connect(path, isolation_level=None)
+        try:
+            migrations.migrate(conn)
+            # Снимок заменяется целиком, поэтому WAL от SqliteStorage вливаем в файл заранее
+            conn.execute("PRAGMA journal_mode=DELETE")
+            self._bindings = dict(conn.execute("SELECT user_id, chat_id FROM admin_bindings"))
+            self._pending = dict(
+                conn.execute("SELECT chat_id, pending_pool_id FROM chats WHERE pending_pool_id IS NOT NULL")
+            )
+            for bid, chat_id, at in conn.execute("SELECT id, chat_id, created_at FROM code_batches"):
+                self._batches[bid] = (chat_id, at)
+                self._batch_codes[bid] = {}
+            for cid, bid, code, used_by, used_at in conn.execute(
+                "SELECT id, batch_id, code, used_by, used_at FROM codes ORDER BY id"
+            ):
+                self._codes[cid] = _Code(bid, code, used_by, used_at)
+                self._batch_codes.setdefault(bid, {})[code] = cid
+            for did, chat_id, message_id, at, source in conn.execute(
+                "SELECT d.id, d.chat_id, d.message_id, d.created_at, COALESCE(s.source_chat_id, 0) "
+                "FROM drops d LEFT JOIN drop_sources s ON s.drop_id=d.id ORDER BY d.id"
+            ):
+                self._drops[did] = _Drop(chat_id, message_id, at, source)
+                self._latest[chat_id] = did
+            for did, chat_id, message_id, at in conn.execute(
+                "SELECT drop_id, chat_id, message_id, posted_at FROM drop_posts"
+            ):
+                drop = self._drops.get(did)
+                if drop is not None:
+                    drop.posts[chat_id] = (message_id, at)
+            for did, cid, user_id, at in conn.execute(
+                "SELECT drop_id, code_id, assigned_user_id, assigned_at FROM drop_codes ORDER BY drop_id, code_id"
+            ):
+                drop = self._drops.get(did)
+                if drop is not None and cid in self._codes:
+                    drop.codes[cid] = (user_id, at) if user_id is not None else None
+            for claim_id, user_id, did, cid, at in conn.execute(
+                "SELECT id, user_id, drop_id, code_id, claimed_at FROM claims ORDER BY id"
+            ):
+                drop = self._drops.get(did)
+                if drop is None:
+                    continue
+                drop.claims.append((claim_id, user_id, cid, at))
+                drop.last_claim_at = at
+                self._claims[(user_id, did)] = cid
+                self._claimed_users.add(user_id)
+            self._claims_duplicates = conn.execute(
+                "SELECT id, user_id, drop_id, code_id, claimed_at FROM claims_duplicates"
+            ).fetchall()
+            for drop in self._drops.values():
+                drop.pool.extend(
+                    cid for cid, assigned in drop.codes.items()
+                    if assigned is None and self._codes[cid].used_by is None
+                )
+            for kind, table in (("batch", "code_batches"), ("code", "codes"), ("drop", "drops"), ("claim", "claims")):
+                self._last_ids[kind] = conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+        finally:
+            conn.close()
+        log.info("Memory storage loaded from %s: %s codes, %s drops", path, len(self._codes), len(self._drops))
+
+
+SNAPSHOT_INSERTS = {
+    "admin_bindings": "INSERT INTO admin_bindings(user_id, chat_id) VALUES(?, ?)",
+    "chats": "INSERT INTO chats(chat_id, pending_pool_id) VALUES(?, ?)",
+    "code_batches": "INSERT INTO code_batches(id, chat_id, created_at) VALUES(?, ?, ?)",
+    "codes": "INSERT OR REPLACE INTO codes(id, batch_id, code, used_by, used_at) VALUES(?, ?, ?, ?, ?)",
+    "drops": "INSERT INTO drops(id, chat_id, message_id, created_at) VALUES(?, ?, ?, ?)",
+    "drop_sources": "INSERT INTO drop_sources(drop_id, source_chat_id) VALUES(?, ?)",
+    "drop_codes": "INSERT OR REPLACE INTO drop_codes(drop_id, code_id, assigned_user_id, assigned_at) VALUES(?, ?, ?, ?)",
+    "claims": "INSERT OR REPLACE INTO claims(id, user_id, drop_id, code_id, claimed_at) VALUES(?, ?, ?, ?, ?)",
+    "drop_stats": "INSERT INTO drop_stats(drop_id, total, assigned, last_claim_at) VALUES(?, ?, ?, ?)",
+    "drop_posts": "INSERT INTO drop_posts(drop_id, chat_id, message_id, posted_at) VALUES(?, ?, ?, ?)",
+    "claims_duplicates": (
+        "INSERT INTO claims_duplicates(id, user_id, drop_id, code_id, claimed_at) VALUES(?, ?, ?, ?, ?)"
+    ),
+}
+
+
+def _write_snapshot(path: str, rows: Dict[str, list]) -> None:
+    """Пишет снимок во временный файл и атомарно подменяет им `path`."""
+    tmp = f"{path}.snapshot"
+    with suppress(FileNotFoundError):
+        os.remove(tmp)
+    conn = sqlite3.connect(tmp, isolation_level=None)
+    try:
+        migrations.migrate(conn)
+        conn.execute("BEGIN")
+        for table, sql in SNAPSHOT_INSERTS.items():
+            conn.executemany(sql, rows[table])
+        conn.execute("COMMIT")
+    finally:
+        conn.close()
+    for suffix in ("-wal", "-shm"):
+        with suppress(FileNotFoundError):
+            os.remove(path + suffix)
+    os.replace(tmp, path)
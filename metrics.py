@@ -0,0 +1,234 @@
+"""Метрики процесса: счётчики, гистограммы и gauge в одном реестре.
+
+Запись дешёвая и потокобезопасная (поток-писатель хранилища тоже пишет сюда).
+Реестр отдаётся в текстовом формате Prometheus через `serve()` и сводкой
+для команды /stats через `summary()`.
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from aiohttp import web
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _key(labels: Dict[str, object]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(key) + ([extra] if extra else [])
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, lock: threading.Lock):
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._values: Dict[LabelKey, float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        return self._values.get(_key(labels), 0)
+
+    def total(self) -> float:
+        return sum(self._values.values())
+
+    def render(self) -> List[str]:
+        return [f"{self.name}{_format_labels(k)} {v:g}" for k, v in sorted(self._values.items())]
+
+
+class Gauge:
+    """Значение, которое читается в момент выгрузки (`fn`) или выставляется через set()."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, lock: threading.Lock, fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self._lock = lock
+        self._fn = fn
+        self._values: Dict[LabelKey, float] = {}
+
+    def set(self, value: float, **labels) -> None:
+        with self._lock:
+            self._values[_key(labels)] = value
+
+    def value(self, **labels) -> float:
+        if self._fn is not None and not labels:
+            return self._fn()
+        return self._values.get(_key(labels), 0)
+
+    def render(self) -> List[str]:
+        if self._fn is not None:
+            return [f"{self.name} {self._fn():g}"]
+        return [f"{self.name}{_format_labels(k)} {v:g}" for k, v in sorted(self._values.items())]
+
+
+class _Series:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, buckets: int):
+        self.counts = [0] * (buckets + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, lock: threading.Lock, buckets=DEFAULT_BUCKETS, seconds: bool = True):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.seconds = seconds
+        self._lock = lock
+        self._series: Dict[LabelKey, _Series] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = _key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series(len(self.buckets))
+            series.counts[i] += 1
+            series.sum += value
+            series.count += 1
+
+    @contextmanager
+    def time(self, **labels) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def quantile(self, q: float, **labels) -> float:
+        """Оценка квантиля по корзинам (линейно внутри корзины)."""
+        series = self._series.get(_key(labels))
+        if series is None or not series.count:
+            return 0.0
+        rank = q * series.count
+        seen = 0
+        for i, n in enumerate(series.counts):
+            if seen + n >= rank and n:
+                low = self.buckets[i - 1] if i else 0.0
+                high = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return low + (high - low) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+    def series(self) -> Dict[LabelKey, Tuple[int, float]]:
+        return {k: (s.count, s.sum) for k, s in self._series.items()}
+
+    def render(self) -> List[str]:
+        lines = []
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, series.counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', f'{bound:g}'))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {series.count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series.sum:g}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str) -> Counter:
+        return self._add(Counter(name, help, self._lock))
+
+    def gauge(self, name: str, help: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        gauge = self._add(Gauge(name, help, self._lock, fn))
+        if fn is not None:
+            # повторная регистрация (новый экземпляр очереди/хранилища) перепривязывает функцию
+            gauge._fn = fn
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS, seconds: bool = True) -> Histogram:
+        return self._add(Histogram(name, help, self._lock, buckets, seconds))
+
+    def render(self) -> str:
+        """Текстовый формат Prometheus (text/plain; version=0.0.4)."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            try:
+                # под общей блокировкой: поток-писатель может добавлять серии прямо сейчас
+                with self._lock:
+                    lines.extend(metric.render())
+            except Exception as exc:
+                lines.append(f"# {metric.name}: {exc}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Короткие строки для /stats: счётчики — суммой по меткам, гистограммы — count/p50/p95."""
+        with self._lock:
+            return self._summary()
+
+    def _summary(self) -> List[str]:
+        lines = []
+        for metric in self._metrics.values():
+            if isinstance(metric, Counter):
+                if metric.total():
+                    lines.append(f"{metric.name}: {metric.total():g}")
+            elif isinstance(metric, Gauge):
+                lines.extend(line.replace(" ", ": ", 1) for line in metric.render())
+            elif isinstance(metric, Histogram):
+                for key, (count, _sum) in sorted(metric.series().items()):
+                    labels = dict(key)
+                    p50 = metric.quantile(0.5, **labels)
+                    p95 = metric.quantile(0.95, **labels)
+                    name = metric.name + (_format_labels(key) if key else "")
+                    if metric.seconds:
+                        lines.append(f"{name}: n={count} p50={p50 * 1000:.1f}мс p95={p95 * 1000:.1f}мс")
+                    else:
+                        lines.append(f"{name}: n={count} p50={p50:.1f} p95={p95:.1f}")
+        return lines
+
+
+REGISTRY = Registry()
+
+
+async def serve(host: str, port: int, registry: Registry = REGISTRY) -> web.AppRunner:
+    """Поднимает HTTP-сервер с /metrics; остановка — `await runner.cleanup()`."""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,130 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+from aiogram import BaseMiddleware
+from aiogram.methods import AnswerCallbackQuery
+from aiogram.types import CallbackQuery, TelegramObject, Update
+
+from metrics import REGISTRY
+from outbound import TokenBucket
+
+Handler = Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]]
+
+UPDATES = REGISTRY.counter("updates_total", "Полученные апдейты по типу")
+HANDLER_SECONDS = REGISTRY.histogram("handler_seconds", "Время работы обработчика")
+HANDLER_ERRORS = REGISTRY.counter("handler_errors_total", "Исключения в обработчиках")
+CLAIMS_COALESCED = REGISTRY.counter("claims_coalesced_total", "Повторные нажатия, присоединённые к выдаче в полёте")
+CLAIMS_THROTTLED = REGISTRY.counter("claims_throttled_total", "Нажатия, отсечённые лимитом на пользователя")
+
+
+class UpdateTracker(BaseMiddleware):
+    """Внешний middleware апдейтов: считает апдейты в обработке (для мягкой остановки)
+    и по желанию дописывает каждый апдейт в JSONL для replay_updates.py."""
+
+    def __init__(self, record_path: str = ""):
+        self.record_path = record_path
+        self.active = 0
+        REGISTRY.gauge("updates_in_progress", "Апдейтов в обработке", lambda: self.active)
+
+    async def __call__(self, handler: Handler, event: Update, data: Dict[str, Any]) -> Any:
+        UPDATES.inc(type=event.event_type)
+        if self.record_path:
+            with open(self.record_path, "a", encoding="utf-8") as f:
+                f.write(event.model_dump_json(exclude_none=True) + "\n")
+        self.active += 1
+        try:
+            return await handler(event, data)
+        finally:
+            self.active -= 1
+
+
+class HandlerTimingMiddleware(BaseMiddleware):
+    """Внутренний middleware: время и ошибки по имени функции-обработчика."""
+
+    async def __call__(self, handler: Handler, event: TelegramObject, data: Dict[str, Any]) -> Any:
+        handler_object = data.get("handler")
+        name = getattr(getattr(handler_object, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+
+class ClaimGuard(BaseMiddleware):
+    """Внешний middleware нажатий «get:<drop_id>», срабатывает до фильтров и обработчика.
+
+    Одинаковые нажатия (user_id, drop_id), пришедшие, пока первое ещё выдаётся,
+    не идут в хранилище: они ждут результат первого и получают тот же ответ
+    (без повторных ЛС и отчётов). Остальные нажатия пользователя проходят через
+    его token bucket — общий для всех дропов; сверх лимита отвечаем `throttled_text`
+    без обращения к БД, а при пустом тексте апдейт просто отбрасывается.
+    """
+
+    def __init__(self, rate: float, burst: float, throttled_text: str = ""):
+        self.rate = rate
+        self.burst = burst
+        self.throttled_text = throttled_text
+        self._flights: Dict[Tuple[int, int], asyncio.Future] = {}
+        self._buckets: Dict[int, TokenBucket] = {}
+        self._last_prune = time.monotonic()
+        REGISTRY.gauge("claims_in_flight", "Выдач в полёте (уникальных пар пользователь—дроп)", lambda: len(self._flights))
+
+    async def __call__(self, handler: Handler, event: CallbackQuery, data: Dict[str, Any]) -> Any:
+        prefix, _, drop = (event.data or "").partition(":")
+        if prefix != "get" or not drop.isdigit():
+            return await handler(event, data)
+        key = (event.from_user.id, int(drop))
+
+        flight = self._flights.get(key)
+        if flight is not None:
+            CLAIMS_COALESCED.inc()
+            await asyncio.wait((flight,))
+            if flight.cancelled():
+                # Первое нажатие упало — ошибку уже залогировал его обработчик
+                return None
+            return self._rebind(flight.result(), event)
+
+        if self.rate > 0 and not self._take(event.from_user.id):
+            CLAIMS_THROTTLED.inc(action="answer" if self.throttled_text else "drop")
+            if self.throttled_text:
+                return event.answer(self.throttled_text)
+            return None
+
+        flight = self._flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await handler(event, data)
+            flight.set_result(result)
+            return result
+        finally:
+            del self._flights[key]
+            if not flight.done():
+                flight.cancel()
+
+    def _take(self, user_id: int) -> bool:
+        now = time.monotonic()
+        self._prune(now)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket.take(now)
+
+    def _prune(self, now: float) -> None:
+        # Ведро на каждого нажавшего: полные (давно не нажимавшие) можно забыть
+        if len(self._buckets) < 10000 or now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for user_id, bucket in list(self._buckets.items()):
+            if bucket.is_full(now):
+                del self._buckets[user_id]
+
+    @staticmethod
+    def _rebind(result: Any, event: CallbackQuery) -> Any:
+        """Ответ первого нажатия, адресованный этому нажатию (у каждого свой callback_query_id)."""
+        if isinstance(result, AnswerCallbackQuery):
+            return result.model_copy(update={"callback_query_id": event.id})
+        return None
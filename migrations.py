@@ -0,0 +1,249 @@
+"""Версионные миграции схемы по PRAGMA user_version.
+
+Каждый шаг идемпотентен и выполняется в своей транзакции вместе с записью
+новой версии, поэтому прерванная миграция просто повторится при следующем старте.
+
+    python migrations.py                 # применить недостающие шаги
+    python migrations.py --dry-run       # выполнить и откатить, показать время шагов
+    python migrations.py --explain       # проверить планы горячих запросов
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import time
+from pathlib import Path
+from typing import Callable, List, NamedTuple, Optional
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[sqlite3.Connection], None]
+
+
+class MigrationReport(NamedTuple):
+    version: int
+    name: str
+    seconds: float
+    applied: bool
+
+
+def _base_schema(conn: sqlite3.Connection) -> None:
+    conn.execute("""CREATE TABLE IF NOT EXISTS chats (
+      chat_id INTEGER PRIMARY KEY,
+      pending_pool_id INTEGER
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS code_batches (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      chat_id INTEGER NOT NULL,
+      created_at TEXT NOT NULL
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS codes (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      batch_id INTEGER NOT NULL,
+      code TEXT NOT NULL,
+      used_by INTEGER,
+      used_at TEXT
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS drops (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      chat_id INTEGER NOT NULL,
+      message_id INTEGER NOT NULL,
+      created_at TEXT NOT NULL
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS drop_sources (
+      drop_id INTEGER PRIMARY KEY,
+      source_chat_id INTEGER NOT NULL
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS drop_codes (
+      drop_id INTEGER NOT NULL,
+      code_id INTEGER NOT NULL,
+      assigned_user_id INTEGER,
+      assigned_at TEXT,
+      PRIMARY KEY (drop_id, code_id)
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS claims (
+      id INTEGER PRIMARY KEY AUTOINCREMENT,
+      user_id INTEGER NOT NULL,
+      drop_id INTEGER NOT NULL,
+      code_id INTEGER NOT NULL,
+      claimed_at TEXT NOT NULL
+    )""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS admin_bindings (
+      user_id INTEGER PRIMARY KEY,
+      chat_id INTEGER NOT NULL
+    )""")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_codes_used ON codes(used_by)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_drop_codes_drop ON drop_codes(drop_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_claims_user_drop ON claims(user_id, drop_id)")
+
+
+def _unique_per_batch(conn: sqlite3.Connection) -> None:
+    # Уникальность кодов не глобально, а внутри одной партии (batch)
+    conn.execute("DROP INDEX IF EXISTS idx_codes_code")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_code_batch ON codes(batch_id, code)")
+
+
+def _drop_stats(conn: sqlite3.Connection) -> None:
+    conn.execute("""CREATE TABLE IF NOT EXISTS drop_stats (
+      drop_id INTEGER PRIMARY KEY,
+      total INTEGER NOT NULL DEFAULT 0,
+      assigned INTEGER NOT NULL DEFAULT 0,
+      last_claim_at TEXT
+    )""")
+    # Заполняем счётчики для дропов, созданных до появления таблицы
+    conn.execute(
+        "INSERT OR IGNORE INTO drop_stats(drop_id, total, assigned, last_claim_at) "
+        "SELECT dc.drop_id, COUNT(*), COUNT(dc.assigned_user_id), "
+        "(SELECT MAX(claimed_at) FROM claims cl WHERE cl.drop_id=dc.drop_id) "
+        "FROM drop_codes dc GROUP BY dc.drop_id"
+    )
+
+
+def _hot_path_indexes(conn: sqlite3.Connection) -> None:
+    # Свободные коды дропа: загрузка пула и отчёты идут только по ещё не выданным
+    conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_drop_codes_free ON drop_codes(drop_id, code_id) "
+        "WHERE assigned_user_id IS NULL"
+    )
+    # Свободные коды партии для /post
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_codes_batch_free ON codes(batch_id) WHERE used_by IS NULL")
+    # Последний дроп чата для /left и /report
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_drops_chat ON drops(chat_id, id)")
+    # Выдачи по дропу для отчётов и списка получивших
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_claims_drop ON claims(drop_id)")
+    # Одна выдача на пользователя в дропе. Дубликаты от старых гонок не удаляем бесследно,
+    # а переносим в claims_duplicates.
+    conn.execute("CREATE TABLE IF NOT EXISTS claims_duplicates AS SELECT * FROM claims WHERE 0")
+    duplicates = (
+        "SELECT id FROM claims WHERE id NOT IN (SELECT MIN(id) FROM claims GROUP BY user_id, drop_id)"
+    )
+    conn.execute(f"INSERT INTO claims_duplicates SELECT * FROM claims WHERE id IN ({duplicates})")
+    conn.execute(f"DELETE FROM claims WHERE id IN ({duplicates})")
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_claims_user_drop_unique ON claims(user_id, drop_id)")
+    # Эти индексы перекрыты новыми (или первичным ключом) и только замедляют запись выдач
+    conn.execute("DROP INDEX IF EXISTS idx_claims_user_drop")
+    conn.execute("DROP INDEX IF EXISTS idx_drop_codes_drop")
+    conn.execute("DROP INDEX IF EXISTS idx_codes_used")
+
+
+def _drop_posts(conn: sqlite3.Connection) -> None:
+    # Один дроп — несколько постов (общий пул кодов на все чаты рассылки)
+    conn.execute("""CREATE TABLE IF NOT EXISTS drop_posts (
+      drop_id INTEGER NOT NULL,
+      chat_id INTEGER NOT NULL,
+      message_id INTEGER NOT NULL,
+      posted_at TEXT NOT NULL,
+      PRIMARY KEY (drop_id, chat_id)
+    )""")
+    # Старые дропы — по одному посту в своём чате
+    conn.execute(
+        "INSERT OR IGNORE INTO drop_posts(drop_id, chat_id, message_id, posted_at) "
+        "SELECT id, chat_id, message_id, created_at FROM drops WHERE message_id != 0"
+    )
+
+
+def _drop_codes_by_code(conn: sqlite3.Connection) -> None:
+    # Код может быть привязан к нескольким дропам: архивация удаляет его из codes,
+    # только если другой дроп на него больше не ссылается
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_drop_codes_code ON drop_codes(code_id)")
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "базовая схема", _base_schema),
+    Migration(2, "уникальность кодов внутри партии", _unique_per_batch),
+    Migration(3, "счётчики drop_stats", _drop_stats),
+    Migration(4, "индексы горячих запросов", _hot_path_indexes),
+    Migration(5, "посты дропа в нескольких чатах", _drop_posts),
+    Migration(6, "поиск дропов по коду", _drop_codes_by_code),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(conn: sqlite3.Connection) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(
+    conn: sqlite3.Connection,
+    dry_run: bool = False,
+    before_rollback: Optional[Callable[[sqlite3.Connection], None]] = None,
+) -> List[MigrationReport]:
+    """Применяет недостающие шаги по порядку. Соединение — в режиме autocommit.
+
+    В режиме dry_run все шаги выполняются в одной транзакции и откатываются:
+    видно реальное время на боевых данных, а база не меняется. `before_rollback`
+    вызывается перед откатом и видит уже новую схему (например, для EXPLAIN).
+    """
+    version = current_version(conn)
+    pending = [step for step in MIGRATIONS if step.version > version]
+    reports = []
+    if dry_run and pending:
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for step in pending:
+                started = time.perf_counter()
+                step.apply(conn)
+                reports.append(MigrationReport(step.version, step.name, time.perf_counter() - started, False))
+            if before_rollback is not None:
+                before_rollback(conn)
+        finally:
+            conn.execute("ROLLBACK")
+        return reports
+    for step in pending:
+        started = time.perf_counter()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            step.apply(conn)
+            conn.execute(f"PRAGMA user_version={step.version}")
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        reports.append(MigrationReport(step.version, step.name, time.perf_counter() - started, True))
+    return reports
+
+
+def main(argv=None) -> int:
+    from dotenv import load_dotenv
+
+    load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
+    parser = argparse.ArgumentParser(description="Миграции схемы базы промокодов")
+    parser.add_argument("--db", default=os.getenv("DB_PATH", "promo_bot.sqlite3"))
+    parser.add_argument("--dry-run", action="store_true", help="выполнить шаги и откатить")
+    parser.add_argument("--explain", action="store_true", help="проверить EXPLAIN QUERY PLAN горячих запросов")
+    args = parser.parse_args(argv)
+    if args.explain:
+        from storage import explain_hot_queries
+
+    conn = sqlite3.connect(args.db, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    print(f"{args.db}: версия схемы {current_version(conn)}, последняя {LATEST_VERSION}")
+    plans = []
+    # В dry-run новые таблицы и индексы есть только до отката — планы снимаем внутри транзакции
+    explain = (lambda c: plans.extend(explain_hot_queries(c))) if args.explain else None
+    reports = migrate(conn, dry_run=args.dry_run, before_rollback=explain)
+    for r in reports:
+        state = "применена" if r.applied else "проверена (откат)"
+        print(f"  #{r.version} {r.name}: {state} за {r.seconds:.3f} с")
+    if not reports:
+        print("  нечего применять")
+
+    if args.explain:
+        failed = 0
+        for name, plan, ok in plans or explain_hot_queries(conn):
+            failed += not ok
+            print(f"{'OK  ' if ok else 'SCAN'} {name}")
+            for line in plan:
+                print(f"       {line}")
+        if failed:
+            print(f"Запросов без индекса: {failed}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
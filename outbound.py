@@ -0,0 +1,324 @@
+import asyncio
+import logging
+import time
+from collections import deque
+from contextlib import suppress
+from typing import Callable, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+OUTBOUND_SENT = REGISTRY.counter("outbound_sent_total", "Отправленные запросы к Bot API")
+OUTBOUND_FAILED = REGISTRY.counter("outbound_failed_total", "Запросы к Bot API, завершившиеся ошибкой")
+OUTBOUND_RETRY_AFTER = REGISTRY.counter("outbound_retry_after_total", "Ответы 429 (retry_after)")
+OUTBOUND_SEND_SECONDS = REGISTRY.histogram("outbound_send_seconds", "Время запроса к Bot API")
+OUTBOUND_DROPPED = REGISTRY.counter("outbound_dropped_total", "Запросы, не отправленные до остановки очереди")
+OUTBOUND_QUEUE_SECONDS = REGISTRY.histogram("outbound_queue_seconds", "Ожидание в исходящей очереди до отправки")
+
+# Полосы приоритета: чем меньше число, тем раньше уходит сообщение
+PRIORITY_USER = 0
+PRIORITY_ADMIN = 1
+
+
+class TokenBucket:
+    """Классический token bucket: `rate` токенов в секунду, не больше `capacity`."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        # Ведро, созданное позже, чем взят `now` планировщика, не должно терять токены
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Сколько ждать до появления токена (0 — можно прямо сейчас)."""
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> bool:
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Job:
+    __slots__ = ("method", "chat_id", "priority", "future", "on_error", "attempts", "queued")
+
+    def __init__(self, method: TelegramMethod, priority: int, future: asyncio.Future, on_error):
+        self.method = method
+        self.chat_id = getattr(method, "chat_id", None)
+        self.priority = priority
+        self.future = future
+        self.on_error = on_error
+        self.attempts = 0
+        self.queued = time.perf_counter()
+
+
+class _Lane:
+    """Очередь одного приоритета: задания сгруппированы по чатам и обходятся по кругу,
+    чтобы один «медленный» чат (группа с лимитом 20/мин) не задерживал остальных."""
+
+    def __init__(self):
+        self.by_chat: Dict[object, deque] = {}
+        self.order: deque = deque()
+        self.size = 0
+
+    def push(self, job: _Job, front: bool = False) -> None:
+        jobs = self.by_chat.get(job.chat_id)
+        if jobs is None:
+            jobs = self.by_chat[job.chat_id] = deque()
+            self.order.append(job.chat_id)
+        if front:
+            jobs.appendleft(job)
+        else:
+            jobs.append(job)
+        self.size += 1
+
+    def pop_ready(self, ready: Callable[[object], bool]) -> Optional[_Job]:
+        for _ in range(len(self.order)):
+            chat_id = self.order[0]
+            self.order.rotate(-1)
+            if not ready(chat_id):
+                continue
+            jobs = self.by_chat[chat_id]
+            job = jobs.popleft()
+            if not jobs:
+                # после rotate чат стоит последним
+                del self.by_chat[chat_id]
+                self.order.pop()
+            self.size -= 1
+            return job
+        return None
+
+
+class OutboundQueue:
+    """Фоновая очередь исходящих запросов к Bot API.
+
+    Ограничивает скорость глобально (≈30 сообщений/с) и по каждому чату
+    (группы ≈20/мин, личка ≈1/с), соблюдает `retry_after` из ответов 429
+    и отправляет сообщения пользователям раньше служебных отчётов.
+    """
+
+    def __init__(
+        self,
+        bot: Bot,
+        global_rate: float = 30,
+        group_per_minute: float = 20,
+        private_rate: float = 1,
+        max_in_flight: int = 16,
+        max_retries: int = 3,
+    ):
+        self.bot = bot
+        self.group_rate = group_per_minute / 60
+        self.private_rate = private_rate
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_buckets: Dict[object, TokenBucket] = {}
+        self._blocked_until: Dict[object, float] = {}
+        self._lanes = {PRIORITY_USER: _Lane(), PRIORITY_ADMIN: _Lane()}
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight: set = set()
+        self._runner: Optional[asyncio.Task] = None
+        self._last_prune = 0.0
+        self.stats = {"sent": 0, "failed": 0, "retry_after": 0, "dropped": 0}
+
+    # --- публичный интерфейс --------------------------------------------
+
+    def start(self) -> None:
+        if self._runner is None:
+            REGISTRY.gauge("outbound_pending", "Запросов в исходящей очереди", self.pending)
+            REGISTRY.gauge("outbound_in_flight", "Запросов к Bot API в работе", lambda: len(self._in_flight))
+            self._runner = asyncio.create_task(self._run(), name="outbound-queue")
+
+    async def close(self, timeout: float = 30) -> None:
+        """Дожидается отправки накопленного (не дольше `timeout`) и останавливает очередь.
+
+        Что не успело уйти, считается в stats["dropped"] и outbound_dropped_total
+        и попадает в лог одной строкой с разбивкой по методам.
+        """
+        deadline = time.monotonic() + timeout
+        while (self.pending() or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._runner is not None:
+            self._runner.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._runner
+            self._runner = None
+        # Запросы в работе прерываются без ответа: дошли ли они, неизвестно
+        dropped: Dict[str, int] = {"in_flight": len(self._in_flight)} if self._in_flight else {}
+        for task in list(self._in_flight):
+            task.cancel()
+        for lane in self._lanes.values():
+            for jobs in lane.by_chat.values():
+                for job in jobs:
+                    name = type(job.method).__name__
+                    dropped[name] = dropped.get(name, 0) + 1
+                    job.future.cancel()
+            lane.by_chat.clear()
+            lane.order.clear()
+            lane.size = 0
+        if dropped:
+            for name, count in dropped.items():
+                OUTBOUND_DROPPED.inc(count, method=name)
+            self.stats["dropped"] += sum(dropped.values())
+            log.warning("Outbound queue closed after %.0fs with unsent requests: %s", timeout, dropped)
+
+    def pending(self) -> int:
+        return sum(lane.size for lane in self._lanes.values())
+
+    def submit(
+        self,
+        method: TelegramMethod,
+        priority: int = PRIORITY_USER,
+        on_error: Optional[Callable[[Exception], None]] = None,
+    ) -> asyncio.Future:
+        """Ставит запрос в очередь и сразу возвращает future с его результатом.
+
+        Ждать future не обязательно: ошибки отправки уходят в `on_error` и в лог.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(_consume_exception)
+        self._lanes[priority].push(_Job(method, priority, fut, on_error))
+        self._wakeup.set()
+        return fut
+
+    # --- планировщик ----------------------------------------------------
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if isinstance(chat_id, int) and chat_id > 0:
+                bucket = TokenBucket(self.private_rate, 1)
+            else:
+                # группы/каналы: небольшой запас на всплеск, дальше 20 в минуту
+                bucket = TokenBucket(self.group_rate, 3)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _chat_wait(self, chat_id, now: float) -> float:
+        if chat_id is None:
+            # запросы без чата (answerCallbackQuery и т.п.) ограничены только глобально
+            return 0.0
+        blocked = self._blocked_until.get(chat_id, 0) - now
+        if blocked > 0:
+            return blocked
+        self._blocked_until.pop(chat_id, None)
+        return self._bucket(chat_id).wait_time(now)
+
+    def _next_job(self, now: float) -> Optional[_Job]:
+        ready = lambda chat_id: self._chat_wait(chat_id, now) <= 0  # noqa: E731
+        for priority in sorted(self._lanes):
+            job = self._lanes[priority].pop_ready(ready)
+            if job is not None:
+                return job
+        return None
+
+    def _next_wait(self, now: float) -> Optional[float]:
+        waits = [
+            self._chat_wait(chat_id, now)
+            for lane in self._lanes.values()
+            for chat_id in lane.order
+        ]
+        return min(waits) if waits else None
+
+    def _prune_buckets(self, now: float) -> None:
+        # Ведра личных чатов копятся по одному на пользователя — полные можно забыть
+        if len(self._chat_buckets) < 10000 or now - self._last_prune < 60:
+            return
+        self._last_prune = now
+        for chat_id, bucket in list(self._chat_buckets.items()):
+            if bucket.is_full(now) and chat_id not in self._blocked_until:
+                del self._chat_buckets[chat_id]
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            job = self._next_job(now)
+            if job is None:
+                self._wakeup.clear()
+                wait = self._next_wait(now)
+                with suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                continue
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                await asyncio.sleep(global_wait)
+                now = time.monotonic()
+            self._global.take(now)
+            if job.chat_id is not None:
+                self._bucket(job.chat_id).take(now)
+            self._prune_buckets(now)
+            await self._slots.acquire()
+            task = asyncio.create_task(self._send(job))
+            self._in_flight.add(task)
+            task.add_done_callback(self._in_flight.discard)
+
+    async def _send(self, job: _Job) -> None:
+        name = type(job.method).__name__
+        started = time.perf_counter()
+        if not job.attempts:
+            OUTBOUND_QUEUE_SECONDS.observe(started - job.queued)
+        try:
+            job.attempts += 1
+            result = await self.bot(job.method)
+        except TelegramRetryAfter as exc:
+            self.stats["retry_after"] += 1
+            OUTBOUND_RETRY_AFTER.inc(method=name)
+            if job.attempts <= self.max_retries:
+                # Повторяем тот же запрос первым в своём чате, когда истечёт retry_after
+                if job.chat_id is None:
+                    # без чата лимит общий: «занимаем» глобальное ведро на retry_after секунд
+                    self._global.tokens = 1 - exc.retry_after * self._global.rate
+                else:
+                    self._blocked_until[job.chat_id] = time.monotonic() + exc.retry_after
+                self._lanes[job.priority].push(job, front=True)
+                self._wakeup.set()
+                return
+            self._fail(job, exc)
+        except Exception as exc:
+            self._fail(job, exc)
+        else:
+            self.stats["sent"] += 1
+            OUTBOUND_SENT.inc(method=name)
+            if not job.future.done():
+                job.future.set_result(result)
+        finally:
+            OUTBOUND_SEND_SECONDS.observe(time.perf_counter() - started, method=name)
+            self._slots.release()
+
+    def _fail(self, job: _Job, exc: Exception) -> None:
+        self.stats["failed"] += 1
+        OUTBOUND_FAILED.inc(method=type(job.method).__name__, error=type(exc).__name__)
+        log.warning("Outbound %s to %s failed: %s", type(job.method).__name__, job.chat_id, exc)
+        if job.on_error is not None:
+            try:
+                job.on_error(exc)
+            except Exception:
+                log.exception("Outbound on_error callback failed")
+        if not job.future.done():
+            job.future.set_exception(exc)
+
+
+def _consume_exception(fut: asyncio.Future) -> None:
+    # Future без ожидающих не должен ругаться «exception was never retrieved»
+    if not fut.cancelled():
+        fut.exception()
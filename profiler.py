@@ -0,0 +1,81 @@
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+
+class StackSampler:
+    """Сэмплирующий профайлер: раз в `interval` секунд снимает стеки всех потоков.
+
+    Стеки копятся в «свёрнутом» виде (`main.py:main;storage.py:claim 42`), который
+    понимают flamegraph.pl и speedscope. Накладные расходы — один обход кадров
+    на каждый сэмпл, поэтому включается только через PROFILE_INTERVAL_MS.
+    """
+
+    def __init__(self, interval: float = 0.01, max_depth: int = 40):
+        self.interval = interval
+        self.max_depth = max_depth
+        self.samples = 0
+        self.started_at = time.monotonic()
+        self._stacks: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+            self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                self.samples += 1
+                for ident, frame in frames.items():
+                    if ident == own:
+                        continue
+                    if ident not in names:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                    self._stacks[self._collapse(names.get(ident, str(ident)), frame)] += 1
+
+    def _collapse(self, thread_name: str, frame) -> str:
+        parts = []
+        leaf_line = frame.f_lineno
+        while frame is not None and len(parts) < self.max_depth:
+            code = frame.f_code
+            parts.append(f"{Path(code.co_filename).name}:{code.co_name}")
+            frame = frame.f_back
+        parts.append(thread_name)
+        parts.reverse()
+        return ";".join(parts) + f":{leaf_line}"
+
+    def top(self, n: int = 10) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._stacks.most_common(n)
+
+    def dump(self, path: str) -> int:
+        """Пишет накопленные стеки в свёрнутом формате; возвращает число строк."""
+        with self._lock:
+            stacks = list(self._stacks.items())
+        with open(path, "w", encoding="utf-8") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        return len(stacks)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stacks.clear()
+            self.samples = 0
+            self.started_at = time.monotonic()
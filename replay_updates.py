@@ -0,0 +1,125 @@
+"""Прогон записанных апдейтов через вебхук бота — без связи с Telegram.
+
+Апдейты берутся из JSONL (по одному Update в строке, как пишет RECORD_UPDATES)
+или из JSON-массива. Бот запускается с RUN_MODE=webhook, BOT_USERNAME=<имя>
+и без WEBHOOK_URL, после чего:
+
+    python replay_updates.py updates.jsonl
+    python replay_updates.py updates.jsonl --concurrency 50 --repeat 10
+
+Для каждого апдейта печатается HTTP-статус и метод, который бот вернул
+в ответе вебхука (например answerCallbackQuery), в конце — сводка задержек.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import aiohttp
+from dotenv import load_dotenv
+
+
+def load_updates(path: str) -> List[dict]:
+    text = Path(path).read_text(encoding="utf-8").strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+async def response_method(resp: aiohttp.ClientResponse) -> Optional[str]:
+    """Имя метода из multipart-ответа вебхука (None — бот ничего не вернул)."""
+    if not resp.content_type.startswith("multipart/"):
+        await resp.read()
+        return None
+    reader = aiohttp.MultipartReader.from_response(resp)
+    method = None
+    while True:
+        part = await reader.next()
+        if part is None:
+            return method
+        if part.name == "method":
+            method = await part.text()
+        else:
+            await part.release()
+
+
+async def post_update(
+    http: aiohttp.ClientSession, url: str, headers: dict, update: dict
+) -> Tuple[int, Optional[str], float]:
+    started = time.perf_counter()
+    async with http.post(url, json=update, headers=headers) as resp:
+        method = await response_method(resp)
+        return resp.status, method, time.perf_counter() - started
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+async def replay(args) -> int:
+    updates = load_updates(args.file) * args.repeat
+    if args.renumber:
+        # Telegram не присылает один update_id дважды — при повторах нумеруем заново
+        for i, update in enumerate(updates, 1):
+            updates[i - 1] = {**update, "update_id": i}
+    headers = {"X-Telegram-Bot-Api-Secret-Token": args.secret} if args.secret else {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    statuses: Counter = Counter()
+    methods: Counter = Counter()
+    latencies: List[float] = []
+
+    async def one(http: aiohttp.ClientSession, update: dict):
+        async with semaphore:
+            try:
+                status, method, seconds = await post_update(http, args.url, headers, update)
+            except aiohttp.ClientError as exc:
+                statuses[type(exc).__name__] += 1
+                return
+        statuses[status] += 1
+        methods[method or "-"] += 1
+        latencies.append(seconds)
+        if args.verbose:
+            print(f"update {update.get('update_id')}: {status} {method or '-'} {seconds * 1000:.1f} мс")
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as http:
+        await asyncio.gather(*(one(http, u) for u in updates))
+    elapsed = time.perf_counter() - started
+
+    print(f"Отправлено апдейтов: {len(updates)} за {elapsed:.2f} с ({len(updates) / elapsed:.0f}/с)")
+    print("Статусы: " + ", ".join(f"{k}: {v}" for k, v in statuses.items()))
+    print("Ответы: " + ", ".join(f"{k}: {v}" for k, v in methods.items()))
+    if latencies:
+        print(
+            "Задержка, мс: "
+            f"p50 {percentile(latencies, 0.5) * 1000:.1f}, "
+            f"p95 {percentile(latencies, 0.95) * 1000:.1f}, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f}, "
+            f"max {max(latencies) * 1000:.1f}"
+        )
+    return 0 if set(statuses) == {200} else 1
+
+
+def main(argv=None) -> int:
+    load_dotenv(dotenv_path=Path(__file__).with_name(".env"))
+    port = os.getenv("WEBHOOK_PORT", "8080") or "8080"
+    path = os.getenv("WEBHOOK_PATH", "/webhook").strip() or "/webhook"
+    parser = argparse.ArgumentParser(description="Отправка записанных апдейтов в вебхук бота")
+    parser.add_argument("file", help="JSONL или JSON-массив апдейтов")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{port}{path}")
+    parser.add_argument("--secret", default=os.getenv("WEBHOOK_SECRET", "").strip())
+    parser.add_argument("--concurrency", type=int, default=1, help="запросов одновременно")
+    parser.add_argument("--repeat", type=int, default=1, help="прогнать файл N раз")
+    parser.add_argument("--renumber", action="store_true", help="перенумеровать update_id по порядку")
+    parser.add_argument("-v", "--verbose", action="store_true", help="печатать каждый апдейт")
+    return asyncio.run(replay(parser.parse_args(argv)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+import asyncio
+import csv
+import io
+import logging
+import time
+from contextlib import suppress
+from datetime import datetime, timezone
+from html import escape
+from typing import Dict, List, NamedTuple
+
+from aiogram.methods import SendDocument, SendMessage
+from aiogram.types import BufferedInputFile, User
+
+from outbound import PRIORITY_ADMIN, OutboundQueue
+
+log = logging.getLogger(__name__)
+
+# Telegram режет сообщения на 4096 символах; длиннее — отправляем CSV-файлом
+MAX_DIGEST_TEXT = 3500
+
+
+class ClaimEvent(NamedTuple):
+    drop_id: int
+    code: str
+    user_id: int
+    full_name: str
+    username: str
+    claimed_at: str
+
+
+def _mention(event: ClaimEvent) -> str:
+    full_name = event.full_name or "Пользователь"
+    mention = f'<a href="tg://user?id={event.user_id}">{escape(full_name)}</a>'
+    username = f" (@{event.username})" if event.username else ""
+    return mention + username
+
+
+class ClaimReporter:
+    """Отчёты о выданных кодах в чат-источник дропа.
+
+    Режим "each" — сообщение на каждую выдачу (как раньше), "digest" — события
+    копятся по чату отчёта и уходят одним сообщением раз в `interval` секунд
+    или по достижении `max_events`. Чат отчёта кэшируется по дропу.
+    """
+
+    def __init__(self, storage, outbound: OutboundQueue, mode: str = "each", interval: float = 10, max_events: int = 50):
+        self.storage = storage
+        self.outbound = outbound
+        self.digest = mode == "digest"
+        self.interval = interval
+        self.max_events = max(1, max_events)
+        self._report_chats: Dict[int, int] = {}
+        self._buffers: Dict[int, List[ClaimEvent]] = {}
+        self._flusher = None
+
+    def start(self) -> None:
+        if self.digest and self._flusher is None:
+            self._flusher = asyncio.create_task(self._flush_loop(), name="claim-digest")
+
+    async def close(self) -> None:
+        """Останавливает таймер и отправляет всё, что накопилось."""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._flusher
+            self._flusher = None
+        self.flush_all()
+
+    async def report_chat(self, drop_id: int) -> int:
+        chat_id = self._report_chats.get(drop_id)
+        if chat_id is None:
+            chat_id = self._report_chats[drop_id] = await self.storage.report_chat(drop_id)
+        return chat_id
+
+    async def record(self, drop_id: int, user: User, code_val: str) -> None:
+        report_chat_id = await self.report_chat(drop_id)
+        if not report_chat_id or not code_val:
+            return
+        event = ClaimEvent(
+            drop_id, str(code_val), user.id, user.full_name or "", user.username or "",
+            datetime.now(timezone.utc).isoformat(),
+        )
+        if not self.digest:
+            text = (
+                f"Код <code>{escape(event.code)}</code> выдан {_mention(event)}. "
+                f"ID: <code>{event.user_id}</code>. Дроп #{drop_id}."
+            )
+            self.outbound.submit(SendMessage(chat_id=report_chat_id, text=text), PRIORITY_ADMIN)
+            return
+        buffer = self._buffers.setdefault(report_chat_id, [])
+        buffer.append(event)
+        if len(buffer) >= self.max_events:
+            self.flush(report_chat_id)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush_all()
+
+    def flush_all(self) -> None:
+        for chat_id in list(self._buffers):
+            self.flush(chat_id)
+
+    def flush(self, chat_id: int) -> None:
+        events = self._buffers.pop(chat_id, None)
+        if not events:
+            return
+        drops = ", ".join(f"#{d}" for d in sorted({e.drop_id for e in events}))
+        header = f"<b>Выдано кодов: {len(events)}</b> (дроп {drops})"
+        lines = [header]
+        lines.extend(
+            f"• <code>{escape(e.code)}</code> — {_mention(e)}, ID: <code>{e.user_id}</code>"
+            for e in events
+        )
+        text = "\n".join(lines)
+        if len(text) <= MAX_DIGEST_TEXT:
+            self.outbound.submit(SendMessage(chat_id=chat_id, text=text), PRIORITY_ADMIN)
+            return
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        writer.writerow(["drop_id", "code", "user_id", "full_name", "username", "claimed_at"])
+        writer.writerows(events)
+        name = f"claims_{int(time.time())}.csv"
+        document = BufferedInputFile(buf.getvalue().encode("utf-8"), filename=name)
+        self.outbound.submit(
+            SendDocument(chat_id=chat_id, document=document, caption=header), PRIORITY_ADMIN
+        )
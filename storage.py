@@ -0,0 +1,1259 @@
+import asyncio
+import csv
+import gzip
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, suppress
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Callable, Iterable, List, NamedTuple, Optional, Protocol, Tuple
+
+import migrations
+from cache import LRUCache
+from metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+DB_WRITE_SECONDS = REGISTRY.histogram("db_write_seconds", "Время задания в потоке записи")
+DB_WRITE_QUEUE_SECONDS = REGISTRY.histogram("db_write_queue_seconds", "Ожидание задания в очереди потока записи")
+DB_READ_SECONDS = REGISTRY.histogram("db_read_seconds", "Время чтения в пуле читателей")
+DB_READ_QUEUE_SECONDS = REGISTRY.histogram("db_read_queue_seconds", "Ожидание чтения в очереди пула")
+DB_LOCK_WAIT_SECONDS = REGISTRY.histogram("db_lock_wait_seconds", "Ожидание блокировки записи (BEGIN IMMEDIATE)")
+DB_BUSY_RETRIES = REGISTRY.counter("db_busy_retries_total", "Повторы BEGIN IMMEDIATE из-за SQLITE_BUSY")
+DB_TXN_ERRORS = REGISTRY.counter("db_transaction_errors_total", "Откаченные транзакции")
+CLAIM_BATCH_SIZE = REGISTRY.histogram(
+    "db_claim_batch_size", "Выдач в одной транзакции (group commit)", buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+    seconds=False,
+)
+MAINTENANCE_SECONDS = REGISTRY.histogram("db_maintenance_seconds", "Шаги обслуживания базы")
+ARCHIVED_ROWS = REGISTRY.counter("db_archived_rows_total", "Строки, перенесённые в архивную базу")
+
+# Запросы держим константами: sqlite3 кэширует подготовленные выражения
+# на соединении по тексту SQL, и долгоживущие соединения компилируют их один раз.
+SQL_GET_BINDING = "SELECT chat_id FROM admin_bindings WHERE user_id=?"
+SQL_BIND = (
+    "INSERT INTO admin_bindings(user_id, chat_id) VALUES(?, ?) "
+    "ON CONFLICT(user_id) DO UPDATE SET chat_id=excluded.chat_id"
+)
+SQL_NEW_BATCH = "INSERT INTO code_batches(chat_id, created_at) VALUES (?, ?)"
+SQL_INSERT_CODE_IGNORE = "INSERT OR IGNORE INTO codes(batch_id, code) VALUES (?, ?)"
+SQL_DELETE_BATCH_CODES = "DELETE FROM codes WHERE batch_id=?"
+SQL_DELETE_BATCH = "DELETE FROM code_batches WHERE id=?"
+# Строк кодов в одной транзакции загрузки: столько ждёт выдача, попавшая на загрузку
+CODES_TXN_ROWS = 5000
+SQL_SET_PENDING = (
+    "INSERT INTO chats(chat_id, pending_pool_id) VALUES(?, ?) "
+    "ON CONFLICT(chat_id) DO UPDATE SET pending_pool_id=excluded.pending_pool_id"
+)
+SQL_GET_PENDING = "SELECT pending_pool_id FROM chats WHERE chat_id=?"
+SQL_NEW_DROP = "INSERT INTO drops(chat_id, message_id, created_at) VALUES (?, ?, ?)"
+SQL_SET_SOURCE = "INSERT OR REPLACE INTO drop_sources(drop_id, source_chat_id) VALUES(?, ?)"
+SQL_FREE_IN_BATCH = "SELECT id FROM codes WHERE batch_id=? AND used_by IS NULL ORDER BY id"
+SQL_ATTACH = "INSERT OR IGNORE INTO drop_codes(drop_id, code_id) VALUES(?, ?)"
+SQL_CLEAR_PENDING = "UPDATE chats SET pending_pool_id=NULL WHERE chat_id=?"
+# Дроп, пост которого никуда не вышел: свободные коды отвязываются, а дроп без выдач удаляется целиком
+SQL_DISCARD_DROP = (
+    "DELETE FROM drop_codes WHERE drop_id=?1 AND assigned_user_id IS NULL",
+    "UPDATE drop_stats SET total=assigned WHERE drop_id=?1",
+    "DELETE FROM drop_posts WHERE drop_id=?1 AND NOT EXISTS (SELECT 1 FROM claims WHERE drop_id=?1)",
+    "DELETE FROM drop_stats WHERE drop_id=?1 AND NOT EXISTS (SELECT 1 FROM claims WHERE drop_id=?1)",
+    "DELETE FROM drop_sources WHERE drop_id=?1 AND NOT EXISTS (SELECT 1 FROM claims WHERE drop_id=?1)",
+    "DELETE FROM drops WHERE id=?1 AND NOT EXISTS (SELECT 1 FROM claims WHERE drop_id=?1)",
+)
+SQL_POOL_LOAD = (
+    "SELECT dc.code_id FROM drop_codes dc JOIN codes c ON c.id=dc.code_id "
+    "WHERE dc.drop_id=? AND dc.assigned_user_id IS NULL AND c.used_by IS NULL "
+    "ORDER BY dc.code_id"
+)
+SQL_USER_CLAIM = (
+    "SELECT c.id, c.code FROM claims cl JOIN codes c ON c.id=cl.code_id "
+    "WHERE cl.user_id=? AND cl.drop_id=?"
+)
+SQL_USE_CODE = "UPDATE codes SET used_by=?, used_at=? WHERE id=? AND used_by IS NULL"
+SQL_UNUSE_CODE = "UPDATE codes SET used_by=NULL, used_at=NULL WHERE id=?"
+SQL_ASSIGN = (
+    "UPDATE drop_codes SET assigned_user_id=?, assigned_at=? "
+    "WHERE drop_id=? AND code_id=? AND assigned_user_id IS NULL"
+)
+SQL_CODE_VALUE = "SELECT code FROM codes WHERE id=?"
+SQL_INSERT_CLAIM = "INSERT INTO claims(user_id, drop_id, code_id, claimed_at) VALUES(?, ?, ?, ?)"
+SQL_ALL_CLAIMANTS = "SELECT DISTINCT user_id FROM claims"
+SQL_USER_HAS_CLAIM = "SELECT 1 FROM claims WHERE user_id=? LIMIT 1"
+SQL_REPORT_CHAT = "SELECT source_chat_id FROM drop_sources WHERE drop_id=?"
+SQL_DROP_CHAT = "SELECT chat_id FROM drops WHERE id=?"
+SQL_LATEST_DROP = "SELECT id FROM drops WHERE chat_id=? ORDER BY id DESC LIMIT 1"
+SQL_ADD_POST = (
+    "INSERT OR REPLACE INTO drop_posts(drop_id, chat_id, message_id, posted_at) VALUES(?, ?, ?, ?)"
+)
+# Дроп создаётся до рассылки с message_id=0; основным становится первый записанный пост
+SQL_SET_DROP_MESSAGE = "UPDATE drops SET message_id=? WHERE id=? AND message_id=0"
+# drop_stats ведётся в тех же транзакциях, что и привязка кодов и выдача
+SQL_STATS_ATTACH = (
+    "INSERT INTO drop_stats(drop_id, total, assigned) VALUES(?, ?, 0) "
+    "ON CONFLICT(drop_id) DO UPDATE SET total=total+excluded.total"
+)
+SQL_STATS_CLAIM = "UPDATE drop_stats SET assigned=assigned+1, last_claim_at=? WHERE drop_id=?"
+SQL_STATS_GET = "SELECT total, assigned, last_claim_at FROM drop_stats WHERE drop_id=?"
+SQL_STATS_ALL = "SELECT drop_id, total, assigned, last_claim_at FROM drop_stats"
+SQL_STATS_ACTUAL = (
+    "SELECT dc.drop_id, COUNT(*), COUNT(dc.assigned_user_id), "
+    "(SELECT MAX(claimed_at) FROM claims cl WHERE cl.drop_id=dc.drop_id) "
+    "FROM drop_codes dc {where} GROUP BY dc.drop_id"
+)
+SQL_STATS_PUT = (
+    "INSERT OR REPLACE INTO drop_stats(drop_id, total, assigned, last_claim_at) VALUES(?, ?, ?, ?)"
+)
+# Порядок по id совпадает с порядком выдачи и не требует сортировки во временном B-дереве
+SQL_REPORT_USED = (
+    "SELECT c.code, cl.user_id, cl.claimed_at FROM claims cl JOIN codes c ON c.id=cl.code_id "
+    "WHERE cl.drop_id=? ORDER BY cl.id"
+)
+SQL_REPORT_FREE = (
+    "SELECT c.code FROM drop_codes dc JOIN codes c ON c.id=dc.code_id "
+    "WHERE dc.drop_id=? AND c.used_by IS NULL"
+)
+
+# Архив: закончившиеся и старые дропы переезжают в отдельный файл, подключённый
+# к соединению записи как `archive`. Схема та же, первичные ключи те же — повторный
+# перенос после сбоя просто перезаписывает строки.
+ARCHIVE_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS archive.codes ("
+    "id INTEGER PRIMARY KEY, batch_id INTEGER NOT NULL, code TEXT NOT NULL, used_by INTEGER, used_at TEXT)",
+    "CREATE TABLE IF NOT EXISTS archive.drop_codes ("
+    "drop_id INTEGER NOT NULL, code_id INTEGER NOT NULL, assigned_user_id INTEGER, assigned_at TEXT, "
+    "PRIMARY KEY (drop_id, code_id))",
+    "CREATE TABLE IF NOT EXISTS archive.claims ("
+    "id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, drop_id INTEGER NOT NULL, "
+    "code_id INTEGER NOT NULL, claimed_at TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS archive.drops ("
+    "id INTEGER PRIMARY KEY, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, created_at TEXT NOT NULL, "
+    "source_chat_id INTEGER, total INTEGER, assigned INTEGER, last_claim_at TEXT, archived_at TEXT NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS archive.drop_posts ("
+    "drop_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, message_id INTEGER NOT NULL, posted_at TEXT NOT NULL, "
+    "PRIMARY KEY (drop_id, chat_id))",
+    "CREATE INDEX IF NOT EXISTS archive.idx_claims_drop ON claims(drop_id)",
+    "CREATE INDEX IF NOT EXISTS archive.idx_claims_user ON claims(user_id)",
+)
+SQL_ALL_CLAIMANTS_WITH_ARCHIVE = "SELECT user_id FROM claims UNION SELECT user_id FROM archive.claims"
+SQL_USER_HAS_CLAIM_WITH_ARCHIVE = (
+    "SELECT 1 FROM claims WHERE user_id=? UNION ALL SELECT 1 FROM archive.claims WHERE user_id=? LIMIT 1"
+)
+# Кандидаты в архив: не последний дроп чата, и либо старше порога (критерий включается
+# явно: у такого дропа могут оставаться свободные коды), либо разобран целиком и без выдач
+# дольше второго порога
+SQL_ARCHIVE_CANDIDATES = (
+    "SELECT d.id FROM drops d LEFT JOIN drop_stats s ON s.drop_id=d.id "
+    "WHERE d.id NOT IN (SELECT MAX(id) FROM drops GROUP BY chat_id) "
+    "AND (d.created_at < ? OR (s.total > 0 AND s.assigned >= s.total AND s.last_claim_at < ?)) "
+    "ORDER BY d.id LIMIT ?"
+)
+SQL_ARCHIVE_CODES_RANGE = (
+    "SELECT MIN(code_id), MAX(code_id), COUNT(*) FROM "
+    "(SELECT code_id FROM drop_codes WHERE drop_id=? ORDER BY code_id LIMIT ?)"
+)
+SQL_ARCHIVE_COPY_CODES = (
+    "INSERT OR REPLACE INTO archive.codes(id, batch_id, code, used_by, used_at) "
+    "SELECT id, batch_id, code, used_by, used_at FROM main.codes WHERE id IN "
+    "(SELECT code_id FROM main.drop_codes WHERE drop_id=? AND code_id BETWEEN ? AND ?)"
+)
+SQL_ARCHIVE_COPY_DROP_CODES = (
+    "INSERT OR REPLACE INTO archive.drop_codes(drop_id, code_id, assigned_user_id, assigned_at) "
+    "SELECT drop_id, code_id, assigned_user_id, assigned_at FROM main.drop_codes "
+    "WHERE drop_id=? AND code_id BETWEEN ? AND ?"
+)
+# Код, на который ссылается ещё и живой дроп, остаётся в основной базе
+SQL_ARCHIVE_DELETE_CODES = (
+    "DELETE FROM main.codes WHERE id IN "
+    "(SELECT code_id FROM main.drop_codes WHERE drop_id=?1 AND code_id BETWEEN ?2 AND ?3) "
+    "AND NOT EXISTS (SELECT 1 FROM main.drop_codes o WHERE o.code_id=main.codes.id AND o.drop_id<>?1)"
+)
+SQL_ARCHIVE_DELETE_DROP_CODES = "DELETE FROM main.drop_codes WHERE drop_id=? AND code_id BETWEEN ? AND ?"
+SQL_ARCHIVE_CLAIMS_RANGE = (
+    "SELECT MIN(id), MAX(id), COUNT(*) FROM (SELECT id FROM claims WHERE drop_id=? ORDER BY id LIMIT ?)"
+)
+SQL_ARCHIVE_COPY_CLAIMS = (
+    "INSERT OR REPLACE INTO archive.claims(id, user_id, drop_id, code_id, claimed_at) "
+    "SELECT id, user_id, drop_id, code_id, claimed_at FROM main.claims WHERE drop_id=? AND id BETWEEN ? AND ?"
+)
+SQL_ARCHIVE_DELETE_CLAIMS = "DELETE FROM main.claims WHERE drop_id=? AND id BETWEEN ? AND ?"
+SQL_ARCHIVE_COPY_DROP = (
+    "INSERT OR REPLACE INTO archive.drops(id, chat_id, message_id, created_at, source_chat_id, "
+    "total, assigned, last_claim_at, archived_at) "
+    "SELECT d.id, d.chat_id, d.message_id, d.created_at, src.source_chat_id, s.total, s.assigned, "
+    "s.last_claim_at, ? FROM main.drops d "
+    "LEFT JOIN main.drop_sources src ON src.drop_id=d.id LEFT JOIN main.drop_stats s ON s.drop_id=d.id "
+    "WHERE d.id=?"
+)
+SQL_ARCHIVE_COPY_POSTS = (
+    "INSERT OR REPLACE INTO archive.drop_posts(drop_id, chat_id, message_id, posted_at) "
+    "SELECT drop_id, chat_id, message_id, posted_at FROM main.drop_posts WHERE drop_id=?"
+)
+# Выдачи, успевшие случиться после переноса кусков, уезжают вместе со строкой дропа
+SQL_ARCHIVE_COPY_REST_CLAIMS = (
+    "INSERT OR REPLACE INTO archive.claims(id, user_id, drop_id, code_id, claimed_at) "
+    "SELECT id, user_id, drop_id, code_id, claimed_at FROM main.claims WHERE drop_id=?"
+)
+SQL_ARCHIVE_DELETE_DROP = (
+    "DELETE FROM main.claims WHERE drop_id=?1",
+    "DELETE FROM main.drop_posts WHERE drop_id=?1",
+    "DELETE FROM main.drop_stats WHERE drop_id=?1",
+    "DELETE FROM main.drop_sources WHERE drop_id=?1",
+    "DELETE FROM main.drops WHERE id=?1",
+)
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+# Отчёты и чат дропа, уже переехавшего в архив
+SQL_DROP_CHAT_WITH_ARCHIVE = (
+    "SELECT chat_id FROM drops WHERE id=?1 UNION ALL SELECT chat_id FROM archive.drops WHERE id=?1 LIMIT 1"
+)
+SQL_IS_ARCHIVED = "SELECT 1 FROM archive.drops WHERE id=? AND id NOT IN (SELECT id FROM main.drops)"
+SQL_ARCHIVE_REPORT_USED = (
+    "SELECT c.code, cl.user_id, cl.claimed_at FROM archive.claims cl JOIN archive.codes c ON c.id=cl.code_id "
+    "WHERE cl.drop_id=? ORDER BY cl.id"
+)
+SQL_ARCHIVE_REPORT_FREE = (
+    "SELECT c.code FROM archive.drop_codes dc JOIN archive.codes c ON c.id=dc.code_id "
+    "WHERE dc.drop_id=? AND c.used_by IS NULL"
+)
+
+
+class ClaimResult(NamedTuple):
+    code_id: int
+    code: Optional[str]
+    assigned_now: bool
+    # отказ по GLOBAL_ONE_PER_USER: пользователь уже получал код в другом дропе
+    limited: bool = False
+
+
+NO_CODES = ClaimResult(0, None, False)
+LIMITED = ClaimResult(0, None, False, True)
+
+
+class MaintenanceReport(NamedTuple):
+    # непусто — проход пропущен, здесь причина
+    skipped: str = ""
+    archived_drops: int = 0
+    archived_rows: int = 0
+    # (busy, страниц в WAL, перенесено в базу) из wal_checkpoint(PASSIVE)
+    checkpoint: Optional[Tuple[int, int, int]] = None
+    wal_truncated: bool = False
+    vacuumed_pages: int = 0
+    freelist_pages: int = 0
+    auto_vacuum: str = ""
+    seconds: float = 0.0
+
+
+class Storage(Protocol):
+    """Интерфейс хранилища, которым пользуются обработчики.
+
+    Реализации: SqliteStorage (по умолчанию) и MemoryStorage из memory_storage.py.
+    Выдача (claim) атомарна: один код — одному пользователю, повторный вызов
+    возвращает тот же код с assigned_now=False.
+    """
+
+    async def open(self) -> None: ...
+
+    async def close(self) -> None: ...
+
+    async def get_binding(self, user_id: int) -> int: ...
+
+    async def bind_chat(self, user_id: int, chat_id: int) -> None: ...
+
+    async def add_codes(
+        self,
+        output_chat_id: int,
+        chunks: Iterable[List[str]],
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Tuple[int, int]: ...
+
+    async def get_pending_batch(self, output_chat_id: int) -> Optional[int]: ...
+
+    async def create_drop(self, chat_id: int, message_id: int, source_chat_id: int) -> int: ...
+
+    async def attach_batch(self, drop_id: int, batch_id: int, output_chat_id: int) -> int: ...
+
+    async def discard_drop(self, drop_id: int, batch_id: int, output_chat_id: int) -> None: ...
+
+    async def record_posts(self, drop_id: int, posts: List[Tuple[int, int]]) -> None: ...
+
+    async def latest_drop(self, chat_id: int) -> Optional[int]: ...
+
+    async def drop_chat(self, drop_id: int) -> int: ...
+
+    async def report_chat(self, drop_id: int) -> int: ...
+
+    async def claim(self, user_id: int, drop_id: int) -> ClaimResult: ...
+
+    async def drop_counts(self, drop_id: int) -> Tuple[int, int, Optional[str]]: ...
+
+    async def check_drop_stats(self, drop_id: Optional[int] = None) -> Tuple[int, List[tuple]]: ...
+
+    async def export_report(self, drop_id: int, path: str, compress: bool = False) -> Tuple[int, int]: ...
+
+    async def maintenance(self, force: bool = False, full_vacuum: bool = False) -> MaintenanceReport: ...
+
+    def stats(self) -> dict: ...
+
+
+# Запросы горячих путей с примерными параметрами: migrations.py --explain проверяет,
+# что ни один из них не сканирует таблицу целиком
+HOT_QUERIES = {
+    "binding": (SQL_GET_BINDING, (1,)),
+    "pending batch": (SQL_GET_PENDING, (1,)),
+    "free codes in batch": (SQL_FREE_IN_BATCH, (1,)),
+    "pool load": (SQL_POOL_LOAD, (1,)),
+    "user claim in drop": (SQL_USER_CLAIM, (1, 1)),
+    "use code": (SQL_USE_CODE, (1, "", 1)),
+    "assign code": (SQL_ASSIGN, (1, "", 1, 1)),
+    "code value": (SQL_CODE_VALUE, (1,)),
+    "drop stats": (SQL_STATS_GET, (1,)),
+    "drop stats on claim": (SQL_STATS_CLAIM, ("", 1)),
+    "report chat": (SQL_REPORT_CHAT, (1,)),
+    "drop chat": (SQL_DROP_CHAT, (1,)),
+    "latest drop": (SQL_LATEST_DROP, (1,)),
+    "report used": (SQL_REPORT_USED, (1,)),
+    "report free": (SQL_REPORT_FREE, (1,)),
+}
+
+
+def explain_hot_queries(conn: sqlite3.Connection) -> List[Tuple[str, List[str], bool]]:
+    """EXPLAIN QUERY PLAN для HOT_QUERIES: (имя, строки плана, нет ли полного скана таблицы)."""
+    results = []
+    for name, (sql, args) in HOT_QUERIES.items():
+        plan = [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", args)]
+        ok = not any(line.startswith("SCAN") and "INDEX" not in line for line in plan)
+        results.append((name, plan, ok))
+    return results
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+class DropPool:
+    """Пулы свободных code_id по дропам, чтобы выдача не сканировала drop_codes.
+
+    Пул заполняется в /post или лениво при первой выдаче после рестарта.
+    Источник истины — SQLite: id берётся из памяти за O(1), а запись в БД
+    выполняется сразу в той же транзакции (write-through).
+    Используется только из потока записи, поэтому без блокировок.
+    """
+
+    def __init__(self):
+        self._pools: dict[int, deque] = {}
+        self.on_put_back: Optional[Callable[[int], None]] = None
+
+    def prime(self, drop_id: int, code_ids) -> None:
+        self._pools[drop_id] = deque(code_ids)
+
+    def take(self, conn: sqlite3.Connection, drop_id: int) -> Optional[int]:
+        """Забирает свободный code_id; вызывать внутри открытой транзакции."""
+        pool = self._pools.get(drop_id)
+        if pool is None:
+            pool = self._pools[drop_id] = deque(r[0] for r in conn.execute(SQL_POOL_LOAD, (drop_id,)))
+        return pool.popleft() if pool else None
+
+    def forget(self, drop_id: int) -> None:
+        self._pools.pop(drop_id, None)
+
+    def put_back(self, drop_id: int, code_id: int) -> None:
+        # Транзакция откатилась — код снова свободен
+        pool = self._pools.get(drop_id)
+        if pool is not None:
+            pool.appendleft(code_id)
+        if self.on_put_back is not None:
+            self.on_put_back(drop_id)
+
+
+def write_report(path: str, compress: bool, used: Iterable[tuple], free: Iterable[tuple]) -> Tuple[int, int]:
+    """CSV отчёта по дропу: выданные (code, user_id, claimed_at), затем свободные (code,)."""
+    n_used = n_free = 0
+    opener = gzip.open if compress else open
+    with opener(path, "wt", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["status", "code", "user_id", "claimed_at"])
+        for code, user_id, claimed_at in used:
+            writer.writerow(("used", code, user_id, claimed_at))
+            n_used += 1
+        for (code,) in free:
+            writer.writerow(("free", code, "", ""))
+            n_free += 1
+    return n_used, n_free
+
+
+# Маркер остановки потока-писателя
+_STOP = object()
+
+
+def _user_claim(conn: sqlite3.Connection, user_id: int, drop_id: int) -> Optional[Tuple[int, str]]:
+    return conn.execute(SQL_USER_CLAIM, (user_id, drop_id)).fetchone()
+
+
+def _op_name(fn: Callable) -> str:
+    # SqliteStorage.get_binding.<locals>.fn -> get_binding
+    parts = fn.__qualname__.split(".")
+    return parts[-3] if len(parts) >= 3 and parts[-2] == "<locals>" else fn.__name__.lstrip("_")
+
+
+def _resolve(fut: asyncio.Future, result=None, exc: Optional[BaseException] = None) -> None:
+    if fut.cancelled():
+        return
+    if exc is not None:
+        fut.set_exception(exc)
+    else:
+        fut.set_result(result)
+
+
+class SqliteStorage:
+    """Хранилище на SQLite с долгоживущими соединениями.
+
+    Все записи идут через один поток-писатель (очередь заданий, одно соединение),
+    чтения — через небольшой пул read-only соединений. Обработчики вызывают
+    async-методы, поэтому ни один вызов SQLite не блокирует event loop.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        readers: int = 2,
+        timeout: float = 10,
+        group_commit_ms: float = 0,
+        group_commit_max: int = 64,
+        claim_cache_size: int = 100000,
+        global_one_per_user: bool = False,
+        archive_path: Optional[str] = None,
+        archive_after_days: float = 0,
+        archive_finished_hours: float = 0,
+        archive_chunk: int = 5000,
+        maintenance_interval: float = 0,
+        quiet_seconds: float = 30,
+        vacuum_pages: int = 1000,
+        wal_autocheckpoint: int = 0,
+    ):
+        self.path = path
+        self.timeout = timeout
+        self._readers = max(1, readers)
+        # Group commit: выдачи, пришедшие в пределах окна, пишутся одной транзакцией.
+        # 0 — выключено, каждая выдача коммитится отдельно.
+        self.group_commit_window = max(0.0, group_commit_ms) / 1000
+        self.group_commit_max = max(1, group_commit_max)
+        self._jobs: queue.Queue = queue.Queue()
+        # Один и тот же объект метода, чтобы поток-писатель узнавал задания выдачи по `is`
+        self._claim_job = self._claim
+        self._started_at = time.monotonic()
+        self._stats = {
+            "claims": 0, "assigned": 0, "claim_commits": 0, "max_batch": 0,
+            "cache_hits": 0, "exhausted_hits": 0, "cache_misses": 0,
+            "busy_retries": 0, "lock_wait_ms": 0.0, "lock_wait_max_ms": 0.0,
+            "maintenance_runs": 0, "archived_drops": 0,
+        }
+        self._writer: Optional[threading.Thread] = None
+        self._wconn: Optional[sqlite3.Connection] = None
+        self._read_executor: Optional[ThreadPoolExecutor] = None
+        self._read_local = threading.local()
+        self._read_conns: List[sqlite3.Connection] = []
+        self._read_conns_lock = threading.Lock()
+        self._reads_pending = 0
+        self.pools = DropPool()
+        self.pools.on_put_back = self._unexhaust
+        # Быстрый путь без очереди записи: (user_id, drop_id) -> (code_id, code) для повторных
+        # нажатий и id закончившихся дропов — в них нажатие только ищет прежнюю выдачу читателем
+        self._claimed = LRUCache(claim_cache_size)
+        self._exhausted: set = set()
+        self._exhaust_pending: set = set()
+        # GLOBAL_ONE_PER_USER: кэш тех, кто уже получал код. Только положительный: промах
+        # проверяется запросом к claims внутри транзакции выдачи (BEGIN IMMEDIATE), поэтому
+        # лимит держится и при нескольких процессах на одной базе.
+        self.global_one_per_user = global_one_per_user
+        self._claimed_users: set = set()
+        self._claimed_users_pending: List[int] = []
+        # Обслуживание: архив в отдельном файле, чекпоинты WAL и incremental_vacuum
+        # идут фоном, мелкими заданиями потока записи и только в тишине между выдачами
+        self.archive_path = archive_path
+        self.archive_after_days = archive_after_days
+        self.archive_finished_hours = archive_finished_hours
+        self.archive_chunk = max(100, archive_chunk)
+        self.maintenance_interval = maintenance_interval
+        self.quiet_seconds = quiet_seconds
+        self.vacuum_pages = vacuum_pages
+        self.wal_autocheckpoint = wal_autocheckpoint
+        self._archive_attached = False
+        self._last_claim = 0.0
+        self._maintainer: Optional[asyncio.Task] = None
+        self._maintenance_lock = asyncio.Lock()
+
+    # --- жизненный цикл -------------------------------------------------
+
+    async def open(self) -> None:
+        self._started_at = time.monotonic()
+        REGISTRY.gauge("db_write_queue_depth", "Заданий в очереди потока записи", self._jobs.qsize)
+        REGISTRY.gauge("db_reads_pending", "Чтений в пуле: в очереди и в работе", lambda: self._reads_pending)
+        self._writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+        self._writer.start()
+        await self._write(self._init_schema)
+        self._read_executor = ThreadPoolExecutor(
+            max_workers=self._readers, thread_name_prefix="db-read"
+        )
+        if self.maintenance_interval > 0:
+            self._maintainer = asyncio.create_task(self._maintenance_loop(), name="db-maintenance")
+
+    async def close(self) -> None:
+        """Дожидается уже поставленных в очередь записей и закрывает соединения."""
+        if self._maintainer is not None:
+            self._maintainer.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._maintainer
+            self._maintainer = None
+        if self._writer is not None:
+            self._jobs.put(_STOP)
+            await asyncio.get_running_loop().run_in_executor(None, self._writer.join)
+            self._writer = None
+        if self._read_executor is not None:
+            self._read_executor.shutdown(wait=True)
+            self._read_executor = None
+        with self._read_conns_lock:
+            for conn in self._read_conns:
+                conn.close()
+            self._read_conns.clear()
+
+    def _connect(self, read_only: bool = False) -> sqlite3.Connection:
+        if read_only:
+            uri = Path(self.path).resolve().as_uri() + "?mode=ro"
+            conn = sqlite3.connect(
+                uri, uri=True, isolation_level=None, timeout=self.timeout,
+                check_same_thread=False, cached_statements=256,
+            )
+        else:
+            conn = sqlite3.connect(
+                self.path, isolation_level=None, timeout=self.timeout,
+                check_same_thread=False, cached_statements=256,
+            )
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def _init_schema(self, conn: sqlite3.Connection) -> None:
+        if conn.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+            # Новая база: режим auto_vacuum можно выбрать только до первой таблицы.
+            # Для старых баз он включается разовым VACUUM — командой /maintenance vacuum.
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("PRAGMA journal_mode=WAL")
+        if self.wal_autocheckpoint:
+            conn.execute(f"PRAGMA wal_autocheckpoint={int(self.wal_autocheckpoint)}")
+        for report in migrations.migrate(conn):
+            log.info("Migration #%s (%s) applied in %.3fs", report.version, report.name, report.seconds)
+        if self.archive_path and (
+            self.archive_after_days or self.archive_finished_hours or Path(self.archive_path).exists()
+        ):
+            conn.execute("ATTACH DATABASE ? AS archive", (self.archive_path,))
+            for sql in ARCHIVE_SCHEMA:
+                conn.execute(sql)
+            self._archive_attached = True
+        if self.global_one_per_user:
+            # Лимит «один код на пользователя» учитывает и выдачи из архивных дропов
+            sql = SQL_ALL_CLAIMANTS_WITH_ARCHIVE if self._archive_attached else SQL_ALL_CLAIMANTS
+            self._claimed_users = {r[0] for r in conn.execute(sql)}
+        # Дальше блокировку записи ждёт _begin сам, чтобы ожидание было видно в stats()
+        conn.execute("PRAGMA busy_timeout=0")
+
+    # --- исполнители ----------------------------------------------------
+
+    def _writer_loop(self) -> None:
+        self._wconn = self._connect()
+        pending = None
+        try:
+            while True:
+                if pending is not None:
+                    job, pending = pending, None
+                else:
+                    job = self._jobs.get()
+                if job is _STOP:
+                    break
+                started = time.perf_counter()
+                if self.group_commit_window and job[0] is self._claim_job:
+                    batch, pending = self._collect_claims(job)
+                    for queued_job in batch:
+                        DB_WRITE_QUEUE_SECONDS.observe(started - queued_job[4])
+                    self._run_claim_batch(self._wconn, batch)
+                    DB_WRITE_SECONDS.observe(time.perf_counter() - started, op="claim_batch")
+                    continue
+                fn, args, fut, loop, queued = job
+                DB_WRITE_QUEUE_SECONDS.observe(started - queued)
+                try:
+                    result = fn(self._wconn, *args)
+                except BaseException as exc:
+                    loop.call_soon_threadsafe(_resolve, fut, None, exc)
+                else:
+                    loop.call_soon_threadsafe(_resolve, fut, result)
+                DB_WRITE_SECONDS.observe(time.perf_counter() - started, op=_op_name(fn))
+        finally:
+            self._wconn.close()
+            self._wconn = None
+
+    def _collect_claims(self, first: tuple):
+        """Набирает выдачи в пределах окна group commit.
+
+        Возвращает (пачка, следующее задание не-выдачи или None): порядок заданий
+        в очереди сохраняется, прочие записи выполняются сразу после пачки.
+        """
+        batch = [first]
+        deadline = time.monotonic() + self.group_commit_window
+        while len(batch) < self.group_commit_max:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                job = self._jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if job is _STOP or job[0] is not self._claim_job:
+                return batch, job
+            batch.append(job)
+        return batch, None
+
+    def _begin(self, conn: sqlite3.Connection) -> None:
+        """BEGIN IMMEDIATE с повтором, пока блокировку записи держит другой процесс.
+
+        В WAL ждать можно только здесь: чтения не блокируют, а COMMIT не ждёт читателей.
+        Число повторов SQLITE_BUSY и время ожидания попадают в stats().
+        """
+        started = time.perf_counter()
+        delay = 0.001
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as exc:
+                if "locked" not in str(exc) or time.perf_counter() - started > self.timeout:
+                    raise
+                self._stats["busy_retries"] += 1
+                DB_BUSY_RETRIES.inc()
+                time.sleep(delay)
+                delay = min(delay * 2, 0.05)
+        waited = (time.perf_counter() - started) * 1000
+        DB_LOCK_WAIT_SECONDS.observe(waited / 1000)
+        st = self._stats
+        st["lock_wait_ms"] += waited
+        if waited > st["lock_wait_max_ms"]:
+            st["lock_wait_max_ms"] = waited
+
+    def _execute_txn(self, conn: sqlite3.Connection, sql: str, args: tuple = ()) -> sqlite3.Cursor:
+        """Одиночная запись в своей транзакции: у писателя busy_timeout=0, блокировку ждёт _begin."""
+        self._begin(conn)
+        try:
+            cur = conn.execute(sql, args)
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return cur
+
+    @contextmanager
+    def _busy_wait(self, conn: sqlite3.Connection):
+        """Для команд, которые нельзя обернуть в BEGIN (VACUUM, чекпоинт): ждать блокировку силами SQLite."""
+        conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        try:
+            yield
+        finally:
+            conn.execute("PRAGMA busy_timeout=0")
+
+    def _write(self, fn: Callable, *args) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._jobs.put((fn, args, fut, loop, time.perf_counter()))
+        return fut
+
+    def _read_conn(self) -> sqlite3.Connection:
+        conn = getattr(self._read_local, "conn", None)
+        if conn is None:
+            conn = self._read_local.conn = self._connect(read_only=True)
+            if self._archive_attached:
+                # Отчёты по архивным дропам читаются тем же соединением
+                uri = Path(self.archive_path).resolve().as_uri() + "?mode=ro"
+                conn.execute("ATTACH DATABASE ? AS archive", (uri,))
+            with self._read_conns_lock:
+                self._read_conns.append(conn)
+        return conn
+
+    def _run_read(self, fn: Callable, args: tuple, queued: float):
+        started = time.perf_counter()
+        DB_READ_QUEUE_SECONDS.observe(started - queued)
+        try:
+            return fn(self._read_conn(), *args)
+        finally:
+            DB_READ_SECONDS.observe(time.perf_counter() - started, op=_op_name(fn))
+
+    def _read(self, fn: Callable, *args) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        self._reads_pending += 1
+        fut = loop.run_in_executor(self._read_executor, self._run_read, fn, args, time.perf_counter())
+        fut.add_done_callback(self._read_done)
+        return fut
+
+    def _read_done(self, _fut: asyncio.Future) -> None:
+        self._reads_pending -= 1
+
+    # --- привязки и партии ----------------------------------------------
+
+    async def get_binding(self, user_id: int) -> int:
+        def fn(conn):
+            row = conn.execute(SQL_GET_BINDING, (user_id,)).fetchone()
+            return row[0] if row else 0
+        return await self._read(fn)
+
+    async def bind_chat(self, user_id: int, chat_id: int) -> None:
+        def fn(conn):
+            self._execute_txn(conn, SQL_BIND, (user_id, chat_id))
+        await self._write(fn)
+
+    async def add_codes(
+        self,
+        output_chat_id: int,
+        chunks: Iterable[List[str]],
+        progress: Optional[Callable[[int, int], None]] = None,
+    ) -> Tuple[int, int]:
+        """Создаёт партию из кусков кодов и делает её ожидающей для чата.
+
+        Куски пишутся короткими транзакциями по CODES_TXN_ROWS строк (executemany +
+        INSERT OR IGNORE), выдачи проходят между ними; дубликаты отсекает уникальный индекс
+        (batch_id, code). Следующий кусок (чтение файла, генерация) берётся в потоке
+        пула, а не в потоке записи. Ожидающей партия становится только после
+        последнего куска; при ошибке недозагруженная партия удаляется.
+        `progress(прочитано, добавлено)` вызывается в event loop после каждого куска.
+        Возвращает (batch_id, added).
+        """
+        loop = asyncio.get_running_loop()
+        chunks = iter(chunks)
+        batch_id = await self._write(self._new_batch, output_chat_id)
+        seen = added = 0
+        try:
+            while True:
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                seen += len(chunk)
+                for i in range(0, len(chunk), CODES_TXN_ROWS):
+                    added += await self._write(self._insert_codes, batch_id, chunk[i:i + CODES_TXN_ROWS])
+                if progress is not None:
+                    progress(seen, added)
+            await self._write(self._set_pending, output_chat_id, batch_id)
+        except Exception:
+            await self._write(self._discard_batch, batch_id)
+            raise
+        return batch_id, added
+
+    def _new_batch(self, conn: sqlite3.Connection, output_chat_id: int) -> int:
+        return self._execute_txn(conn, SQL_NEW_BATCH, (output_chat_id, _now())).lastrowid
+
+    def _insert_codes(self, conn: sqlite3.Connection, batch_id: int, chunk: List[str]) -> int:
+        self._begin(conn)
+        try:
+            before = conn.total_changes
+            # dict.fromkeys убирает повторы внутри куска и сохраняет порядок
+            conn.executemany(SQL_INSERT_CODE_IGNORE, ((batch_id, code) for code in dict.fromkeys(chunk)))
+            added = conn.total_changes - before
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return added
+
+    def _set_pending(self, conn: sqlite3.Connection, output_chat_id: int, batch_id: int) -> None:
+        self._execute_txn(conn, SQL_SET_PENDING, (output_chat_id, batch_id))
+
+    def _discard_batch(self, conn: sqlite3.Connection, batch_id: int) -> None:
+        self._begin(conn)
+        try:
+            conn.execute(SQL_DELETE_BATCH_CODES, (batch_id,))
+            conn.execute(SQL_DELETE_BATCH, (batch_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    async def get_pending_batch(self, output_chat_id: int) -> Optional[int]:
+        def fn(conn):
+            row = conn.execute(SQL_GET_PENDING, (output_chat_id,)).fetchone()
+            return int(row[0]) if row and row[0] is not None else None
+        return await self._read(fn)
+
+    # --- дропы ----------------------------------------------------------
+
+    async def create_drop(self, chat_id: int, message_id: int, source_chat_id: int) -> int:
+        def fn(conn):
+            self._begin(conn)
+            try:
+                drop_id = conn.execute(SQL_NEW_DROP, (chat_id, message_id, _now())).lastrowid
+                conn.execute(SQL_SET_SOURCE, (drop_id, source_chat_id))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return drop_id
+        return await self._write(fn)
+
+    async def attach_batch(self, drop_id: int, batch_id: int, output_chat_id: int) -> int:
+        """Привязывает свободные коды партии к дропу и заполняет пул. Возвращает число кодов."""
+        return await self._write(self._attach_batch, drop_id, batch_id, output_chat_id)
+
+    def _attach_batch(self, conn: sqlite3.Connection, drop_id: int, batch_id: int, output_chat_id: int) -> int:
+        self._begin(conn)
+        try:
+            code_ids = [r[0] for r in conn.execute(SQL_FREE_IN_BATCH, (batch_id,))]
+            if code_ids:
+                conn.executemany(SQL_ATTACH, ((drop_id, cid) for cid in code_ids))
+                conn.execute(SQL_STATS_ATTACH, (drop_id, len(code_ids)))
+                conn.execute(SQL_CLEAR_PENDING, (output_chat_id,))
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        self.pools.prime(drop_id, code_ids)
+        return len(code_ids)
+
+    async def discard_drop(self, drop_id: int, batch_id: int, output_chat_id: int) -> None:
+        """Отменяет дроп, пост которого не вышел ни в одном чате: партия снова ждёт /post.
+
+        Свободные коды отвязываются от дропа в той же транзакции, что и возврат партии,
+        поэтому следующий дроп не делит их с неопубликованным.
+        """
+        def fn(conn):
+            self._begin(conn)
+            try:
+                for sql in SQL_DISCARD_DROP:
+                    conn.execute(sql, (drop_id,))
+                conn.execute(SQL_SET_PENDING, (output_chat_id, batch_id))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            self.pools.forget(drop_id)
+            self._exhausted.discard(drop_id)
+        await self._write(fn)
+
+    async def record_posts(self, drop_id: int, posts: List[Tuple[int, int]]) -> None:
+        """Запоминает опубликованные посты дропа: [(chat_id, message_id), ...]."""
+        def fn(conn):
+            now = _now()
+            self._begin(conn)
+            try:
+                conn.executemany(SQL_ADD_POST, ((drop_id, chat_id, message_id, now) for chat_id, message_id in posts))
+                if posts:
+                    conn.execute(SQL_SET_DROP_MESSAGE, (posts[0][1], drop_id))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        await self._write(fn)
+
+    async def latest_drop(self, chat_id: int) -> Optional[int]:
+        def fn(conn):
+            row = conn.execute(SQL_LATEST_DROP, (chat_id,)).fetchone()
+            return row[0] if row else None
+        return await self._read(fn)
+
+    async def drop_chat(self, drop_id: int) -> int:
+        def fn(conn):
+            if self._archive_attached:
+                row = conn.execute(SQL_DROP_CHAT_WITH_ARCHIVE, (drop_id,)).fetchone()
+            else:
+                row = conn.execute(SQL_DROP_CHAT, (drop_id,)).fetchone()
+            return row[0] if row else 0
+        return await self._read(fn)
+
+    async def report_chat(self, drop_id: int) -> int:
+        def fn(conn):
+            row = conn.execute(SQL_REPORT_CHAT, (drop_id,)).fetchone()
+            return int(row[0]) if row and row[0] else 0
+        return await self._read(fn)
+
+    # --- выдача ---------------------------------------------------------
+
+    async def claim(self, user_id: int, drop_id: int) -> ClaimResult:
+        """Выдаёт код пользователю; NO_CODES — кодов нет, LIMITED — сработал лимит 1 на пользователя.
+
+        Повторные нажатия отвечаются из памяти, а нажатия в закончившемся дропе —
+        одним чтением из пула читателей, без очереди записи.
+        """
+        key = (user_id, drop_id)
+        cached = self._claimed.get(key)
+        if cached is not None:
+            self._stats["cache_hits"] += 1
+            return ClaimResult(cached[0], cached[1], False)
+        if drop_id in self._exhausted:
+            self._stats["exhausted_hits"] += 1
+            got = await self._read(_user_claim, user_id, drop_id)
+            if got is None:
+                return NO_CODES
+            self._claimed.set(key, got)
+            return ClaimResult(got[0], got[1], False)
+        self._stats["cache_misses"] += 1
+        self._last_claim = time.monotonic()
+        result = await self._write(self._claim_job, user_id, drop_id)
+        if result.code_id:
+            self._claimed.set(key, (result.code_id, result.code))
+        return result
+
+    def _claim(self, conn: sqlite3.Connection, user_id: int, drop_id: int):
+        # Уже получал в этом дропе? Проверяем до захвата блокировки записи
+        got = conn.execute(SQL_USER_CLAIM, (user_id, drop_id)).fetchone()
+        if got:
+            self._count_claims(1, 0, 0)
+            return ClaimResult(got[0], got[1], False)
+
+        result = NO_CODES
+        self._begin(conn)
+        try:
+            result = self._claim_in_txn(conn, user_id, drop_id, _now(), check_repeat=False)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            DB_TXN_ERRORS.inc(op="claim")
+            log.exception("Claim transaction for user %s in drop %s rolled back", user_id, drop_id)
+            self._exhaust_pending.clear()
+            self._rollback_claimed_users()
+            if result.assigned_now:
+                self.pools.put_back(drop_id, result.code_id)
+            result = NO_CODES
+        self._claimed_users_pending.clear()
+        self._publish_exhausted()
+        self._count_claims(1, int(result.assigned_now), 1)
+        return result
+
+    def _claim_in_txn(self, conn: sqlite3.Connection, user_id: int, drop_id: int, now: str, check_repeat: bool = True):
+        """Одна выдача внутри уже открытой транзакции; при ошибке код возвращается в пул."""
+        if check_repeat:
+            got = conn.execute(SQL_USER_CLAIM, (user_id, drop_id)).fetchone()
+            if got:
+                return ClaimResult(got[0], got[1], False)
+        if self.global_one_per_user and self._has_claimed(conn, user_id):
+            return LIMITED
+        code_id = None
+        try:
+            while True:
+                # id берём из пула, строки обновляем по первичному ключу
+                code_id = self.pools.take(conn, drop_id)
+                if code_id is None:
+                    self._exhaust_pending.add(drop_id)
+                    return NO_CODES
+                if conn.execute(SQL_USE_CODE, (user_id, now, code_id)).rowcount != 1:
+                    # Код уже занят (например, другим процессом) — берём следующий
+                    continue
+                if conn.execute(SQL_ASSIGN, (user_id, now, drop_id, code_id)).rowcount != 1:
+                    conn.execute(SQL_UNUSE_CODE, (code_id,))
+                    continue
+                break
+            code_val = conn.execute(SQL_CODE_VALUE, (code_id,)).fetchone()[0]
+            conn.execute(SQL_INSERT_CLAIM, (user_id, drop_id, code_id, now))
+            conn.execute(SQL_STATS_CLAIM, (now, drop_id))
+        except Exception:
+            if code_id:
+                self.pools.put_back(drop_id, code_id)
+            raise
+        if self.global_one_per_user and user_id not in self._claimed_users:
+            self._claimed_users.add(user_id)
+            self._claimed_users_pending.append(user_id)
+        return ClaimResult(code_id, code_val, True)
+
+    def _has_claimed(self, conn: sqlite3.Connection, user_id: int) -> bool:
+        if user_id in self._claimed_users:
+            return True
+        if self._archive_attached:
+            found = conn.execute(SQL_USER_HAS_CLAIM_WITH_ARCHIVE, (user_id, user_id)).fetchone()
+        else:
+            found = conn.execute(SQL_USER_HAS_CLAIM, (user_id,)).fetchone()
+        if found:
+            # Выдача уже закоммичена (возможно, другим процессом) — в откат её не записываем
+            self._claimed_users.add(user_id)
+        return found is not None
+
+    def _run_claim_batch(self, conn: sqlite3.Connection, batch: List[tuple]) -> None:
+        """Выполняет пачку выдач одной транзакцией; ответы отдаются только после COMMIT.
+
+        Каждая выдача идёт под своим SAVEPOINT: ошибка в одной не откатывает остальные,
+        а проверки used_by/assigned_user_id IS NULL работают как при поштучной записи.
+        """
+        now = _now()
+        results = []
+        try:
+            self._begin(conn)
+            for _fn, (user_id, drop_id), _fut, _loop, _queued in batch:
+                conn.execute("SAVEPOINT claim")
+                try:
+                    results.append(self._claim_in_txn(conn, user_id, drop_id, now))
+                except Exception:
+                    conn.execute("ROLLBACK TO claim")
+                    DB_TXN_ERRORS.inc(op="claim_savepoint")
+                    log.exception("Claim for user %s in drop %s rolled back to savepoint", user_id, drop_id)
+                    results.append(NO_CODES)
+                conn.execute("RELEASE claim")
+            conn.execute("COMMIT")
+        except Exception:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            DB_TXN_ERRORS.inc(op="claim_batch")
+            log.exception("Claim batch of %s rolled back", len(batch))
+            self._exhaust_pending.clear()
+            self._rollback_claimed_users()
+            for (_fn, (_user_id, drop_id), _fut, _loop, _queued), res in reversed(list(zip(batch, results))):
+                if res.assigned_now:
+                    self.pools.put_back(drop_id, res.code_id)
+            results = [NO_CODES] * len(batch)
+        self._claimed_users_pending.clear()
+        self._publish_exhausted()
+        self._count_claims(len(batch), sum(1 for r in results if r.assigned_now), 1)
+        for (_fn, _args, fut, loop, _queued), res in zip(batch, results):
+            loop.call_soon_threadsafe(_resolve, fut, res)
+
+    def _publish_exhausted(self) -> None:
+        """После коммита запоминает закончившиеся дропы: их выдачи уже видны читателям."""
+        self._exhausted.update(self._exhaust_pending)
+        self._exhaust_pending.clear()
+
+    def _rollback_claimed_users(self) -> None:
+        for user_id in self._claimed_users_pending:
+            self._claimed_users.discard(user_id)
+        self._claimed_users_pending.clear()
+
+    def _unexhaust(self, drop_id: int) -> None:
+        # Код вернулся в пул — дроп снова «живой»
+        self._exhausted.discard(drop_id)
+
+    def _count_claims(self, claims: int, assigned: int, commits: int) -> None:
+        st = self._stats
+        st["claims"] += claims
+        st["assigned"] += assigned
+        st["claim_commits"] += commits
+        if commits:
+            CLAIM_BATCH_SIZE.observe(claims)
+        if claims > st["max_batch"]:
+            st["max_batch"] = claims
+
+    def stats(self) -> dict:
+        """Счётчики выдачи: сколько обработано, сколько коммитов и средняя скорость."""
+        st = dict(self._stats)
+        elapsed = max(time.monotonic() - self._started_at, 1e-9)
+        st["claims_per_sec"] = round(st["claims"] / elapsed, 2)
+        st["claims_per_commit"] = round(st["claims"] / st["claim_commits"], 2) if st["claim_commits"] else 0.0
+        st["group_commit_ms"] = self.group_commit_window * 1000
+        st["lock_wait_ms"] = round(st["lock_wait_ms"], 3)
+        st["lock_wait_max_ms"] = round(st["lock_wait_max_ms"], 3)
+        st["claim_cache_size"] = len(self._claimed)
+        st["exhausted_drops"] = len(self._exhausted)
+        st["claimed_users"] = len(self._claimed_users)
+        return st
+
+    # --- обслуживание ---------------------------------------------------
+
+    async def _maintenance_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.maintenance_interval)
+            try:
+                report = await self.maintenance()
+            except Exception:
+                log.exception("Database maintenance failed")
+                continue
+            if not report.skipped and (report.archived_drops or report.vacuumed_pages or report.wal_truncated):
+                log.info("Maintenance: %s", report)
+
+    def _busy(self) -> bool:
+        return time.monotonic() - self._last_claim < self.quiet_seconds
+
+    async def maintenance(self, force: bool = False, full_vacuum: bool = False) -> MaintenanceReport:
+        """Архивирует закончившиеся дропы, делает чекпоинт WAL и возвращает свободные страницы.
+
+        Без `force` проход пропускается, если за последние quiet_seconds были выдачи,
+        а архивирование останавливается, как только выдачи возобновились. Каждый шаг —
+        отдельное короткое задание потока записи, выдачи встают между ними.
+        `full_vacuum` переводит старую базу в auto_vacuum=INCREMENTAL разовым VACUUM
+        (запись на это время стоит) и возвращает все свободные страницы.
+        """
+        if not force and self._busy():
+            return MaintenanceReport(skipped="идут выдачи")
+        if self._maintenance_lock.locked():
+            return MaintenanceReport(skipped="обслуживание уже идёт")
+        async with self._maintenance_lock:
+            started = time.perf_counter()
+            drops = rows = 0
+            if self._archive_attached and (self.archive_after_days or self.archive_finished_hours):
+                with MAINTENANCE_SECONDS.time(step="archive"):
+                    for drop_id in await self._write(self._archive_candidates):
+                        if not force and self._busy():
+                            break
+                        rows += await self._archive_drop(drop_id)
+                        drops += 1
+            with MAINTENANCE_SECONDS.time(step="checkpoint"):
+                checkpoint, truncated = await self._write(self._checkpoint)
+            with MAINTENANCE_SECONDS.time(step="vacuum"):
+                mode, vacuumed, freelist = await self._write(self._vacuum, full_vacuum)
+            self._stats["maintenance_runs"] += 1
+            self._stats["archived_drops"] += drops
+            return MaintenanceReport(
+                "", drops, rows, checkpoint, truncated, vacuumed, freelist, mode, time.perf_counter() - started
+            )
+
+    def _archive_candidates(self, conn: sqlite3.Connection) -> List[int]:
+        now = datetime.now(timezone.utc)
+        # Нулевой порог выключает свой критерий: сравнение с пустой строкой всегда ложно
+        old = (now - timedelta(days=self.archive_after_days)).isoformat() if self.archive_after_days else ""
+        finished = (
+            (now - timedelta(hours=self.archive_finished_hours)).isoformat() if self.archive_finished_hours else ""
+        )
+        return [r[0] for r in conn.execute(SQL_ARCHIVE_CANDIDATES, (old, finished, 1000))]
+
+    async def _archive_drop(self, drop_id: int) -> int:
+        """Переносит дроп в архив кусками по archive_chunk строк; возвращает число строк."""
+        rows = 0
+        for step in (self._archive_codes_chunk, self._archive_claims_chunk):
+            while True:
+                moved = await self._write(step, drop_id)
+                rows += moved
+                if moved < self.archive_chunk:
+                    break
+        rows += await self._write(self._archive_drop_row, drop_id)
+        ARCHIVED_ROWS.inc(rows)
+        return rows
+
+    def _move(self, conn: sqlite3.Connection, copy: List[tuple], delete: List[tuple]) -> None:
+        """Копия в архив и удаление из основной базы — двумя транзакциями.
+
+        В WAL транзакция над двумя файлами атомарна только для каждого по отдельности:
+        при сбое между ними строки останутся в обеих базах, и следующий проход
+        перепишет копию (INSERT OR REPLACE) и доудалит оригинал — но не потеряет их.
+        """
+        for statements in (copy, delete):
+            self._begin(conn)
+            try:
+                for sql, args in statements:
+                    conn.execute(sql, args)
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                DB_TXN_ERRORS.inc(op="archive")
+                raise
+
+    def _archive_codes_chunk(self, conn: sqlite3.Connection, drop_id: int) -> int:
+        low, high, count = conn.execute(SQL_ARCHIVE_CODES_RANGE, (drop_id, self.archive_chunk)).fetchone()
+        if not count:
+            return 0
+        args = (drop_id, low, high)
+        self._move(
+            conn,
+            [(SQL_ARCHIVE_COPY_CODES, args), (SQL_ARCHIVE_COPY_DROP_CODES, args)],
+            [(SQL_ARCHIVE_DELETE_CODES, args), (SQL_ARCHIVE_DELETE_DROP_CODES, args)],
+        )
+        return count
+
+    def _archive_claims_chunk(self, conn: sqlite3.Connection, drop_id: int) -> int:
+        low, high, count = conn.execute(SQL_ARCHIVE_CLAIMS_RANGE, (drop_id, self.archive_chunk)).fetchone()
+        if not count:
+            return 0
+        args = (drop_id, low, high)
+        self._move(conn, [(SQL_ARCHIVE_COPY_CLAIMS, args)], [(SQL_ARCHIVE_DELETE_CLAIMS, args)])
+        return count
+
+    def _archive_drop_row(self, conn: sqlite3.Connection, drop_id: int) -> int:
+        self._move(
+            conn,
+            [
+                (SQL_ARCHIVE_COPY_REST_CLAIMS, (drop_id,)),
+                (SQL_ARCHIVE_COPY_DROP, (_now(), drop_id)),
+                (SQL_ARCHIVE_COPY_POSTS, (drop_id,)),
+            ],
+            [(sql, (drop_id,)) for sql in SQL_ARCHIVE_DELETE_DROP],
+        )
+        self.pools.forget(drop_id)
+        self._exhausted.discard(drop_id)
+        return 1
+
+    def _checkpoint(self, conn: sqlite3.Connection) -> Tuple[Tuple[int, int, int], bool]:
+        """PASSIVE не ждёт читателей и писателей; если он перенёс весь WAL, файл обрезается до нуля."""
+        with self._busy_wait(conn):
+            busy, log_pages, done = conn.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+        truncated = False
+        if not busy and log_pages == done:
+            # busy_timeout=0: при активном читателе TRUNCATE сразу вернёт busy, а не будет ждать
+            truncated = conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0] == 0
+        return (busy, log_pages, done), truncated
+
+    def _vacuum(self, conn: sqlite3.Connection, full: bool) -> Tuple[str, int, int]:
+        with self._busy_wait(conn):
+            return self._vacuum_locked(conn, full)
+
+    def _vacuum_locked(self, conn: sqlite3.Connection, full: bool) -> Tuple[str, int, int]:
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if full and mode != 2:
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            conn.execute("VACUUM")
+            mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        vacuumed = 0
+        freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if mode == 2 and freelist and (full or self.vacuum_pages > 0):
+            # incremental_vacuum(0) возвращает все свободные страницы. Через execute() модуль
+            # sqlite3 делает один шаг (одну страницу), executescript доводит до конца.
+            conn.executescript(f"PRAGMA incremental_vacuum({0 if full else int(self.vacuum_pages)})")
+            after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            vacuumed, freelist = freelist - after, after
+        return AUTO_VACUUM_MODES.get(mode, str(mode)), vacuumed, freelist
+
+    # --- статистика и отчёты --------------------------------------------
+
+    async def drop_counts(self, drop_id: int) -> Tuple[int, int, Optional[str]]:
+        """Возвращает (осталось, всего, время последней выдачи) из drop_stats за один поиск по ключу.
+
+        Для дропов из старых баз без строки в drop_stats она пересчитывается один раз.
+        """
+        row = await self._read(lambda conn: conn.execute(SQL_STATS_GET, (drop_id,)).fetchone())
+        if row is None:
+            await self.check_drop_stats(drop_id)
+            row = await self._read(lambda conn: conn.execute(SQL_STATS_GET, (drop_id,)).fetchone())
+            if row is None:
+                return 0, 0, None
+        total, assigned, last_claim_at = row
+        return total - assigned, total, last_claim_at
+
+    async def check_drop_stats(self, drop_id: Optional[int] = None) -> Tuple[int, List[tuple]]:
+        """Сверяет drop_stats с drop_codes/claims и исправляет расхождения.
+
+        Возвращает (проверено дропов, [(drop_id, было, стало), ...]); было/стало — (total, assigned).
+        Выполняется в потоке записи, поэтому выдачи во время сверки не теряются.
+        """
+        def fn(conn):
+            where, args = ("WHERE dc.drop_id=?", (drop_id,)) if drop_id else ("", ())
+            actual = conn.execute(SQL_STATS_ACTUAL.format(where=where), args).fetchall()
+            stored = {r[0]: r[1:] for r in conn.execute(SQL_STATS_ALL)}
+            fixed = []
+            self._begin(conn)
+            try:
+                for d_id, total, assigned, last_claim_at in actual:
+                    was = stored.get(d_id)
+                    if was is None or (was[0], was[1], was[2]) != (total, assigned, last_claim_at):
+                        conn.execute(SQL_STATS_PUT, (d_id, total, assigned, last_claim_at))
+                        fixed.append((d_id, was[:2] if was else None, (total, assigned)))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            return len(actual), fixed
+        return await self._write(fn)
+
+    async def export_report(self, drop_id: int, path: str, compress: bool = False) -> Tuple[int, int]:
+        """Пишет отчёт по дропу в CSV (или CSV.gz) построчно прямо из курсора.
+
+        В памяти держится только текущая строка, сколько бы кодов ни было в дропе.
+        Дроп, уже перенесённый в архив, выгружается из архива. Возвращает (выдано, свободно).
+        """
+        def fn(conn):
+            if self._archive_attached and conn.execute(SQL_IS_ARCHIVED, (drop_id,)).fetchone():
+                used = conn.execute(SQL_ARCHIVE_REPORT_USED, (drop_id,))
+                free = conn.execute(SQL_ARCHIVE_REPORT_FREE, (drop_id,))
+            else:
+                used = conn.execute(SQL_REPORT_USED, (drop_id,))
+                free = conn.execute(SQL_REPORT_FREE, (drop_id,))
+            return write_report(path, compress, used, free)
+        return await self._read(fn)
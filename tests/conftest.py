@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# Модули бота лежат плоско рядом с main.py
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,153 @@
+"""OutboundQueue против заглушки сессии Bot API: без сети и без настоящих лимитов.
+
+Запуск: python -m pytest -q
+"""
+import asyncio
+import time
+
+import pytest
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import SendMessage
+
+from outbound import PRIORITY_ADMIN, PRIORITY_USER, OutboundQueue
+
+TOKEN = "123456:AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"
+
+
+class StubSession(BaseSession):
+    """Записывает запросы; `delay` — время «ответа» сервера."""
+
+    def __init__(self, delay: float = 0):
+        super().__init__()
+        self.delay = delay
+        self.sent = []
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        self.sent.append((method.chat_id, method.text, time.monotonic()))
+        return True
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+    async def close(self):
+        pass
+
+
+class RetryAfterSession(StubSession):
+    """Отвечает 429 на первые `times` запросов в чат `chat_id`."""
+
+    def __init__(self, chat_id: int, retry_after: int = 1, times: int = 1):
+        super().__init__()
+        self.chat_id = chat_id
+        self.retry_after = retry_after
+        self.times = times
+
+    async def make_request(self, bot, method, timeout=None):
+        if method.chat_id == self.chat_id and self.times:
+            self.times -= 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=self.retry_after)
+        return await super().make_request(bot, method, timeout)
+
+
+def make_queue(session: BaseSession, **kwargs) -> OutboundQueue:
+    return OutboundQueue(Bot(TOKEN, session=session), **kwargs)
+
+
+def test_close_counts_and_cancels_unsent_requests(caplog):
+    async def main():
+        session = StubSession()
+        # Группа: запас в 3 сообщения, дальше одно в 6 секунд
+        queue = make_queue(session, group_per_minute=10)
+        queue.start()
+        futures = [queue.submit(SendMessage(chat_id=-100, text=str(i))) for i in range(6)]
+        await queue.close(timeout=0.2)
+        return session, queue, futures
+
+    session, queue, futures = asyncio.run(main())
+    assert [text for _, text, _ in session.sent] == ["0", "1", "2"]
+    assert queue.stats["dropped"] == 3
+    assert queue.pending() == 0
+    assert all(f.cancelled() for f in futures[3:])
+    assert "unsent requests" in caplog.text
+
+
+def test_user_lane_goes_before_admin_reports():
+    async def main():
+        session = StubSession()
+        queue = make_queue(session, global_rate=1000)
+        # Всё ставится до старта: порядок решает только приоритет
+        for chat_id in (-1, -2, -3):
+            queue.submit(SendMessage(chat_id=chat_id, text="report"), PRIORITY_ADMIN)
+        for chat_id in (1, 2, 3):
+            queue.submit(SendMessage(chat_id=chat_id, text="pm"), PRIORITY_USER)
+        queue.start()
+        await queue.close(timeout=1)
+        return session
+
+    session = asyncio.run(main())
+    assert [text for _, text, _ in session.sent] == ["pm"] * 3 + ["report"] * 3
+
+
+def test_throttled_group_does_not_hold_up_other_chats():
+    async def main():
+        session = StubSession()
+        queue = make_queue(session, global_rate=1000, group_per_minute=20)
+        queue.start()
+        for i in range(6):
+            queue.submit(SendMessage(chat_id=-100, text=f"group{i}"))
+        for chat_id in (1, 2, 3):
+            queue.submit(SendMessage(chat_id=chat_id, text=f"pm{chat_id}"))
+        await asyncio.sleep(0.3)
+        sent = [text for _, text, _ in session.sent]
+        await queue.close(timeout=0)
+        return sent
+
+    sent = asyncio.run(main())
+    # Запас группы — 3 сообщения, дальше одно в 3 секунды; личные уходят сразу
+    assert sorted(sent) == ["group0", "group1", "group2", "pm1", "pm2", "pm3"]
+
+
+def test_retry_after_requeues_first_in_its_chat():
+    async def main():
+        session = RetryAfterSession(chat_id=5, retry_after=1)
+        queue = make_queue(session, global_rate=1000)
+        queue.start()
+        started = time.monotonic()
+        first = queue.submit(SendMessage(chat_id=5, text="a"))
+        await asyncio.sleep(0.05)
+        # Пока чат 5 заблокирован, его следующее сообщение ждёт, а другие чаты — нет
+        second = queue.submit(SendMessage(chat_id=5, text="b"))
+        other = queue.submit(SendMessage(chat_id=6, text="c"))
+        results = await asyncio.gather(first, second, other)
+        await queue.close(timeout=1)
+        return session, queue, results, started
+
+    session, queue, results, started = asyncio.run(main())
+    assert results == [True, True, True]
+    assert [(chat_id, text) for chat_id, text, _ in session.sent] == [(6, "c"), (5, "a"), (5, "b")]
+    retried_at = session.sent[1][2]
+    assert retried_at - started >= 1
+    assert queue.stats == {"sent": 3, "failed": 0, "retry_after": 1, "dropped": 0}
+
+
+def test_retry_after_gives_up_after_max_retries():
+    errors = []
+
+    async def main():
+        session = RetryAfterSession(chat_id=5, retry_after=1, times=10)
+        queue = make_queue(session, global_rate=1000, max_retries=1)
+        queue.start()
+        fut = queue.submit(SendMessage(chat_id=5, text="a"), on_error=errors.append)
+        with pytest.raises(TelegramRetryAfter):
+            await fut
+        await queue.close(timeout=1)
+        return queue
+
+    queue = asyncio.run(main())
+    assert len(errors) == 1 and isinstance(errors[0], TelegramRetryAfter)
+    assert queue.stats["retry_after"] == 2
+    assert queue.stats["failed"] == 1
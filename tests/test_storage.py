@@ -0,0 +1,350 @@
+"""Оба движка против протокола Storage: выдача ровно один раз, повторы, лимит и откаты.
+
+Запуск: python -m pytest -q
+"""
+import asyncio
+import sqlite3
+
+import pytest
+
+from memory_storage import MemoryStorage
+from storage import SqliteStorage
+
+CHAT_ID = -100
+ENGINES = ("sqlite", "sqlite_group_commit", "memory")
+
+
+def make_storage(engine: str, path: str, **kwargs):
+    if engine == "memory":
+        return MemoryStorage(path, snapshot_interval=0, **kwargs)
+    if engine == "sqlite_group_commit":
+        return SqliteStorage(path, group_commit_ms=5, group_commit_max=16, **kwargs)
+    return SqliteStorage(path, **kwargs)
+
+
+async def make_drop(storage, codes) -> int:
+    await storage.add_codes(CHAT_ID, [list(codes)])
+    batch_id = await storage.get_pending_batch(CHAT_ID)
+    drop_id = await storage.create_drop(CHAT_ID, 0, CHAT_ID)
+    assert await storage.attach_batch(drop_id, batch_id, CHAT_ID) == len(codes)
+    return drop_id
+
+
+def run_with(engine: str, path: str, scenario, **kwargs):
+    async def main():
+        storage = make_storage(engine, path, **kwargs)
+        await storage.open()
+        try:
+            return await scenario(storage)
+        finally:
+            await storage.close()
+    return asyncio.run(main())
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_concurrent_claims_never_share_a_code(engine, tmp_path):
+    codes = [f"C{i:03d}" for i in range(50)]
+
+    async def scenario(storage):
+        drop_id = await make_drop(storage, codes)
+        return await asyncio.gather(*(storage.claim(user_id, drop_id) for user_id in range(1, 201)))
+
+    results = run_with(engine, str(tmp_path / "db.sqlite3"), scenario)
+    given = [r.code for r in results if r.code]
+    assert sorted(given) == codes
+    assert sum(r.assigned_now for r in results) == len(codes)
+    assert all(not r.limited for r in results)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_repeat_claim_returns_same_code(engine, tmp_path):
+    async def scenario(storage):
+        drop_id = await make_drop(storage, ["A", "B", "C"])
+        first = await storage.claim(7, drop_id)
+        # Повторные нажатия — и подряд, и одновременно
+        again = await asyncio.gather(*(storage.claim(7, drop_id) for _ in range(5)))
+        left, total, _ = await storage.drop_counts(drop_id)
+        return first, again, left, total
+
+    first, again, left, total = run_with(engine, str(tmp_path / "db.sqlite3"), scenario)
+    assert first.assigned_now and first.code
+    assert {(r.code_id, r.code) for r in again} == {(first.code_id, first.code)}
+    assert not any(r.assigned_now for r in again)
+    assert (left, total) == (2, 3)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_global_limit_returns_limited(engine, tmp_path):
+    async def scenario(storage):
+        first_drop = await make_drop(storage, ["A1", "B1"])
+        second_drop = await make_drop(storage, ["A2", "B2"])
+        return (
+            await storage.claim(5, first_drop),
+            await storage.claim(5, second_drop),
+            await storage.claim(5, first_drop),
+            await storage.claim(6, second_drop),
+        )
+
+    got, limited, repeat, other = run_with(
+        engine, str(tmp_path / "db.sqlite3"), scenario, global_one_per_user=True
+    )
+    assert got.assigned_now
+    assert limited.limited and not limited.code
+    # Код из первого дропа остаётся за пользователем
+    assert repeat.code == got.code and not repeat.limited
+    assert other.assigned_now
+
+
+def test_global_limit_holds_across_processes(tmp_path):
+    """Две SqliteStorage на одном файле — как два процесса за балансировщиком."""
+    path = str(tmp_path / "db.sqlite3")
+
+    async def main():
+        first, second = SqliteStorage(path, global_one_per_user=True), SqliteStorage(path, global_one_per_user=True)
+        await first.open()
+        await second.open()
+        try:
+            drop_a = await make_drop(first, ["A"])
+            drop_b = await make_drop(first, ["B"])
+            return await first.claim(1, drop_a), await second.claim(1, drop_b)
+        finally:
+            await first.close()
+            await second.close()
+
+    got, limited = asyncio.run(main())
+    assert got.assigned_now
+    assert limited.limited
+
+
+class FailingConnection:
+    """Обёртка над соединением потока записи: роняет выбранные запросы."""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+        self.fail_commit = False
+        self.fail_claim_for = set()
+
+    def execute(self, sql, params=()):
+        if self.fail_commit and sql == "COMMIT":
+            self.fail_commit = False
+            raise sqlite3.OperationalError("disk I/O error")
+        if sql.startswith("INSERT INTO claims(") and params[0] in self.fail_claim_for:
+            raise sqlite3.OperationalError("disk I/O error")
+        return self._conn.execute(sql, params)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+
+def failing_storage(path: str, **kwargs):
+    storage = SqliteStorage(path, group_commit_ms=20, group_commit_max=64, **kwargs)
+    connect = storage._connect
+    wrapped = []
+
+    def _connect(read_only: bool = False):
+        conn = connect(read_only)
+        if read_only:
+            return conn
+        wrapped.append(FailingConnection(conn))
+        return wrapped[-1]
+
+    storage._connect = _connect
+    return storage, wrapped
+
+
+def test_rolled_back_batch_returns_codes_to_pool(tmp_path):
+    codes = [f"C{i}" for i in range(10)]
+
+    async def main():
+        storage, wrapped = failing_storage(str(tmp_path / "db.sqlite3"), global_one_per_user=True)
+        await storage.open()
+        try:
+            drop_id = await make_drop(storage, codes)
+            wrapped[0].fail_commit = True
+            failed = await asyncio.gather(*(storage.claim(user_id, drop_id) for user_id in range(1, 6)))
+            left_after_failure = (await storage.drop_counts(drop_id))[0]
+            # Те же пользователи снова: откат не должен был записать их в лимит
+            retried = await asyncio.gather(*(storage.claim(user_id, drop_id) for user_id in range(1, 11)))
+            return failed, left_after_failure, retried
+        finally:
+            await storage.close()
+
+    failed, left_after_failure, retried = asyncio.run(main())
+    assert all(not r.code for r in failed)
+    assert left_after_failure == len(codes)
+    assert sorted(r.code for r in retried) == codes
+    assert all(r.assigned_now for r in retried)
+
+
+def test_savepoint_rollback_keeps_rest_of_batch(tmp_path):
+    codes = [f"C{i}" for i in range(5)]
+
+    async def main():
+        storage, wrapped = failing_storage(str(tmp_path / "db.sqlite3"))
+        await storage.open()
+        try:
+            drop_id = await make_drop(storage, codes)
+            wrapped[0].fail_claim_for = {3}
+            first = await asyncio.gather(*(storage.claim(user_id, drop_id) for user_id in range(1, 6)))
+            wrapped[0].fail_claim_for = set()
+            # Код упавшей выдачи вернулся в пул и достаётся следующему
+            late = await storage.claim(6, drop_id)
+            return first, late, await storage.drop_counts(drop_id)
+        finally:
+            await storage.close()
+
+    first, late, (left, total, _) = asyncio.run(main())
+    assert not first[2].code
+    assert sum(r.assigned_now for r in first) == 4
+    assert late.assigned_now
+    assert sorted([r.code for r in first if r.code] + [late.code]) == codes
+    assert (left, total) == (0, 5)
+
+
+def test_memory_snapshot_opens_in_sqlite(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+
+    async def main():
+        memory = MemoryStorage(path, snapshot_interval=0)
+        await memory.open()
+        drop_id = await make_drop(memory, ["A", "B"])
+        got = await memory.claim(1, drop_id)
+        await memory.close()
+
+        sqlite = SqliteStorage(path)
+        await sqlite.open()
+        try:
+            return got, await sqlite.claim(1, drop_id), await sqlite.claim(2, drop_id), await sqlite.claim(3, drop_id)
+        finally:
+            await sqlite.close()
+
+    got, repeat, other, none_left = asyncio.run(main())
+    assert (repeat.code, repeat.assigned_now) == (got.code, False)
+    assert other.assigned_now and other.code != got.code
+    assert not none_left.code
+
+
+def test_archived_drop_report_reads_archive(tmp_path):
+    path, archive = str(tmp_path / "db.sqlite3"), str(tmp_path / "db.archive.sqlite3")
+    report = str(tmp_path / "report.csv")
+
+    async def main():
+        storage = SqliteStorage(path, archive_path=archive, archive_finished_hours=1e-9)
+        await storage.open()
+        try:
+            old_drop = await make_drop(storage, ["A", "B"])
+            for user_id in (1, 2):
+                await storage.claim(user_id, old_drop)
+            # Последний дроп чата не архивируется — нужен следующий
+            await make_drop(storage, ["C"])
+            done = await storage.maintenance(force=True)
+            return done, await storage.drop_chat(old_drop), await storage.export_report(old_drop, report)
+        finally:
+            await storage.close()
+
+    done, chat_id, counts = asyncio.run(main())
+    assert done.archived_drops == 1
+    assert chat_id == CHAT_ID
+    assert counts == (2, 0)
+    with open(report, encoding="utf-8") as f:
+        assert sorted(line.split(",")[1] for line in f.read().splitlines()[1:]) == ["A", "B"]
+
+
+def test_archiving_keeps_codes_shared_with_live_drop(tmp_path):
+    path, archive = str(tmp_path / "db.sqlite3"), str(tmp_path / "db.archive.sqlite3")
+
+    async def main():
+        storage = SqliteStorage(path, archive_path=archive, archive_after_days=1e-9)
+        await storage.open()
+        try:
+            await storage.add_codes(CHAT_ID, [["A", "B", "C"]])
+            batch_id = await storage.get_pending_batch(CHAT_ID)
+            old_drop = await storage.create_drop(CHAT_ID, 0, CHAT_ID)
+            await storage.attach_batch(old_drop, batch_id, CHAT_ID)
+            # Те же свободные коды во втором, живом дропе
+            live_drop = await storage.create_drop(CHAT_ID, 0, CHAT_ID)
+            await storage.attach_batch(live_drop, batch_id, CHAT_ID)
+            done = await storage.maintenance(force=True)
+            claims = [await storage.claim(user_id, live_drop) for user_id in range(1, 5)]
+            return done, claims
+        finally:
+            await storage.close()
+
+    done, claims = asyncio.run(main())
+    assert done.archived_drops == 1
+    assert sorted(r.code for r in claims if r.code) == ["A", "B", "C"]
+    assert not claims[3].code
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_failed_import_leaves_no_pending_batch(engine, tmp_path):
+    def chunks():
+        yield [f"C{i}" for i in range(12000)]
+        raise OSError("файл оборвался")
+
+    async def scenario(storage):
+        with pytest.raises(OSError):
+            await storage.add_codes(CHAT_ID, chunks())
+        pending = await storage.get_pending_batch(CHAT_ID)
+        # Следующая загрузка работает как обычно
+        drop_id = await make_drop(storage, ["A"])
+        return pending, await storage.drop_counts(drop_id)
+
+    pending, (left, total, _) = run_with(engine, str(tmp_path / "db.sqlite3"), scenario)
+    assert pending is None
+    assert (left, total) == (1, 1)
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_discarded_drop_returns_codes_to_next_drop(engine, tmp_path):
+    async def scenario(storage):
+        await storage.add_codes(CHAT_ID, [["A", "B", "C"]])
+        batch_id = await storage.get_pending_batch(CHAT_ID)
+        unposted = await storage.create_drop(CHAT_ID, 0, CHAT_ID)
+        await storage.attach_batch(unposted, batch_id, CHAT_ID)
+        await storage.discard_drop(unposted, batch_id, CHAT_ID)
+        assert await storage.get_pending_batch(CHAT_ID) == batch_id
+        assert await storage.latest_drop(CHAT_ID) is None
+        live = await storage.create_drop(CHAT_ID, 0, CHAT_ID)
+        attached = await storage.attach_batch(live, batch_id, CHAT_ID)
+        stale = await storage.claim(1, unposted)
+        got = await storage.claim(2, live)
+        return attached, stale, got, await storage.drop_counts(live), await storage.drop_counts(unposted)
+
+    attached, stale, got, (left, total, _), old_counts = run_with(engine, str(tmp_path / "db.sqlite3"), scenario)
+    assert attached == 3
+    assert not stale.code
+    assert got.assigned_now
+    assert (left, total) == (2, 3)
+    assert old_counts[:2] == (0, 0)
+
+
+def test_writes_wait_for_lock_held_by_another_process(tmp_path):
+    path = str(tmp_path / "db.sqlite3")
+
+    async def main():
+        storage = SqliteStorage(path, timeout=5)
+        await storage.open()
+        other = sqlite3.connect(path, isolation_level=None)
+        try:
+            loop = asyncio.get_running_loop()
+            # Другой процесс держит блокировку записи 300 мс — записи ждут, а не падают
+            other.execute("BEGIN IMMEDIATE")
+            loop.call_later(0.3, other.execute, "COMMIT")
+            await storage.bind_chat(1, CHAT_ID)
+            drop_id = await make_drop(storage, ["A"])
+            other.execute("BEGIN IMMEDIATE")
+            loop.call_later(0.3, other.execute, "COMMIT")
+            await storage.discard_drop(drop_id, 1, CHAT_ID)
+            other.execute("BEGIN IMMEDIATE")
+            loop.call_later(0.3, other.execute, "COMMIT")
+            done = await storage.maintenance(force=True, full_vacuum=True)
+            return await storage.get_binding(1), drop_id, done, storage.stats()
+        finally:
+            other.close()
+            await storage.close()
+
+    binding, drop_id, done, stats = asyncio.run(main())
+    assert binding == CHAT_ID and drop_id
+    assert done is not None
+    assert stats["busy_retries"] > 0